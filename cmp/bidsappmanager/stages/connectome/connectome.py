@@ -23,7 +23,7 @@ class ConnectomeConfigUI(ConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gPickle', 'mat', 'cff', 'graphml'
+        'gPickle', 'mat', 'cff', 'graphml', 'npz'
 
     connectivity_metrics : list of string
         A list of connectivity metrics to stored. Valid ``connectivity_metrics`` are
@@ -39,7 +39,7 @@ class ConnectomeConfigUI(ConnectomeConfig):
     """
 
     output_types = List(['gPickle'], editor=CheckListEditor(
-        values=['gPickle', 'mat', 'cff', 'graphml'], cols=4))
+        values=['gPickle', 'mat', 'cff', 'graphml', 'npz'], cols=5))
 
     connectivity_metrics = List(
         ['Fiber number', 'Fiber length', 'Fiber density',
@@ -53,7 +53,13 @@ class ConnectomeConfigUI(ConnectomeConfig):
                            Item('connectivity_metrics',
                                 label='Metrics', style='custom'),
                            Item('compute_curvature'),
-                           label='Connectivity matrix', show_border=True))
+                           label='Connectivity matrix', show_border=True),
+                       Group(
+                           Item('streaming', label='Read tractogram by chunks'),
+                           Item('memory_budget', label='Memory budget (MB)', enabled_when='streaming'),
+                           Item('cache_fiber_features', label='Cache fiber features'),
+                           Item('n_procs', label='Number of processes'),
+                           label='Fiber processing', show_border=True))
 
 
 class ConnectomeStageUI(ConnectomeStage):
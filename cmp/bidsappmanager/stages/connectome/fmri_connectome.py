@@ -22,7 +22,11 @@ class ConnectomeConfigUI(ConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gPickle', 'mat', 'cff', 'graphml'
+        'gPickle', 'mat', 'cff', 'graphml', 'npz'
+
+    connectivity_estimators : list of string
+        A list of connectivity estimators. Valid estimators are
+        'corr', 'lw_cov', 'partial_corr', 'tangent'
 
     traits_view : traits.ui.View
         TraitsUI view that displays the Attributes of this class
@@ -33,12 +37,23 @@ class ConnectomeConfigUI(ConnectomeConfig):
     """
 
     output_types = List(['gPickle'], editor=CheckListEditor(
-        values=['gPickle', 'mat', 'cff', 'graphml'], cols=4))
+        values=['gPickle', 'mat', 'cff', 'graphml', 'npz'], cols=5))
+
+    connectivity_estimators = List(['corr'], minlen=1, editor=CheckListEditor(
+        values=['corr', 'lw_cov', 'partial_corr', 'tangent'], cols=4))
 
     traits_view = View(VGroup('apply_scrubbing',
                               VGroup(Item('FD_thr', label='FD threshold'),
                                      Item('DVARS_thr', label='DVARS threshold'),
-                                     visible_when="apply_scrubbing==True")),
+                                     visible_when="apply_scrubbing==True"),
+                              Item('fisher_z', label='Fisher z-transform'),
+                              Item('connectivity_dtype', label='Precision'),
+                              Item('connectivity_estimators', label='Estimators', style='custom'),
+                              Item('dynamic_connectivity', label='Dynamic connectivity'),
+                              VGroup(Item('window_length', label='Window length (volumes)'),
+                                     Item('window_step', label='Window step (volumes)'),
+                                     visible_when="dynamic_connectivity==True"),
+                              Item('cache_timeseries', label='Cache time-series')),
                        Item('output_types', style='custom'))
 
 
@@ -44,7 +44,15 @@ class FunctionalMRIConfigUI(FunctionalMRIConfig):
         HGroup(
             Item('lowpass_filter', label='Low cutoff (volumes)'),
             Item('highpass_filter', label='High cutoff (volumes)'),
-            label="Bandpass filtering", show_border=True))
+            label="Bandpass filtering", show_border=True),
+        HGroup(
+            Item('fused_postprocessing', label='Fused post-processing'),
+            Item('save_intermediate_volumes', label='Save intermediate volumes',
+                 visible_when='fused_postprocessing'),
+            Item('streaming', label='Process by slabs', visible_when='not fused_postprocessing'),
+            Item('memory_budget', label='Memory budget (MB)',
+                 visible_when='streaming and not fused_postprocessing'),
+            label="Execution", show_border=True))
 
 
 class FunctionalMRIStageUI(FunctionalMRIStage):
@@ -128,6 +128,7 @@ class AnatomicalPipeline(cmp_common.Pipeline):
         self.stages['Segmentation'].config.freesurfer_subject_id = os.path.join(self.output_directory,
                                                                                 'freesurfer', subject_id)
         self.stages['Segmentation'].config.on_trait_change(self.update_parcellation, 'seg_tool')
+        self.stages['Segmentation'].config.on_trait_change(self.update_number_of_threads, 'number_of_threads')
         self.stages['Parcellation'].config.on_trait_change(self.update_segmentation, 'parcellation_scheme')
         self.stages['Parcellation'].config.on_trait_change(self.update_parcellation_scheme, 'parcellation_scheme')
 
@@ -170,6 +171,10 @@ class AnatomicalPipeline(cmp_common.Pipeline):
         else:
             self.stages['Parcellation'].config.parcellation_scheme = self.stages['Parcellation'].config.pre_custom
 
+    def update_number_of_threads(self):
+        """Update self.stages['Parcellation'].config.number_of_threads when ``number_of_threads`` is updated."""
+        self.stages['Parcellation'].config.number_of_threads = self.stages['Segmentation'].config.number_of_threads
+
     def update_segmentation(self):
         """Update self.stages['Segmentation'].config.seg_tool when ``parcellation_scheme`` is updated."""
         if self.stages['Parcellation'].config.parcellation_scheme == 'Custom':
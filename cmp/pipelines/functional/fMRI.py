@@ -699,6 +699,13 @@ class fMRIPipeline(Pipeline):
                 (con_flow, sinker, [
                  ("outputnode.avg_timeseries", "func.@avg_timeseries")])
             ])
+            func_config = self.stages['FunctionalMRI'].config
+            if func_config.fused_postprocessing and not (func_config.lowpass_filter > 0 or
+                                                         func_config.highpass_filter > 0):
+                # Average ROI time-series already computed by the fused post-processing
+                fMRI_flow.connect([
+                    (func_flow, con_flow, [("outputnode.avg_timeseries", "inputnode.avg_timeseries")])
+                ])
 
         return fMRI_flow
 
@@ -31,9 +31,25 @@ class ConnectomeConfig(HasTraits):
     compute_curvature : traits.Bool
         Compute fiber curvature (Default: False)
 
-    output_types : ['gPickle', 'mat', 'graphml']
+    output_types : ['gPickle', 'mat', 'graphml', 'npz']
         Output connectome format
 
+    streaming : traits.Bool
+        Read the tractogram by chunks of fibers instead of
+        loading it in memory (Default: False)
+
+    memory_budget : traits.Int
+        Approximate memory (in MB) used to process a chunk
+        of fibers in streaming mode (Default: 2048)
+
+    cache_fiber_features : traits.Bool
+        Cache the fiber endpoints, lengths and curvature in the
+        stage directory to reuse them in later runs (Default: False)
+
+    n_procs : traits.Int
+        Number of processes used to create the connection
+        matrices of the different resolutions in parallel (Default: 1)
+
     connectivity_metrics : ['Fiber number', 'Fiber length', 'Fiber density', 'Fiber proportion', 'Normalized fiber density', 'ADC', 'gFA']
         Set of connectome maps to compute
 
@@ -57,6 +73,10 @@ class ConnectomeConfig(HasTraits):
     # modality = List(['Deterministic','Probabilistic'])
     compute_curvature = Bool(False)
     output_types = List(['gPickle', 'mat', 'graphml'])
+    streaming = Bool(False)
+    memory_budget = Int(2048)
+    cache_fiber_features = Bool(False)
+    n_procs = Int(1)
     connectivity_metrics = List(
         ['Fiber number', 'Fiber length', 'Fiber density', 'Fiber proportion', 'Normalized fiber density', 'ADC', 'gFA'])
     log_visualization = Bool(True)
@@ -111,6 +131,12 @@ class ConnectomeStage(Stage):
         cmtk_cmat = pe.Node(interface=cmtklib.connectome.CMTK_cmat(), name='compute_matrice')
         cmtk_cmat.inputs.compute_curvature = self.config.compute_curvature
         cmtk_cmat.inputs.output_types = self.config.output_types
+        cmtk_cmat.inputs.streaming = self.config.streaming
+        cmtk_cmat.inputs.memory_budget = self.config.memory_budget
+        if self.config.cache_fiber_features:
+            cmtk_cmat.inputs.fiber_features_cache_dir = os.path.join(self.stage_dir, 'fiber_features_cache')
+        cmtk_cmat.inputs.n_procs = self.config.n_procs
+        cmtk_cmat.n_procs = self.config.n_procs
 
         # Additional maps
         map_merge = pe.Node(interface=util.Merge(
@@ -43,7 +43,40 @@ class ConnectomeConfig(HasTraits):
         DVARS (RMS of variance over voxels) threshold
         (Default: 4.0)
 
-    output_types : ['gPickle', 'mat', 'cff', 'graphml']
+    fisher_z : traits.Bool
+        Apply the Fisher z-transform (arctanh) to the correlation coefficients
+        (Default: False)
+
+    connectivity_dtype : traits.Enum(['float64', 'float32'])
+        Floating point precision of the connectivity matrices
+        (Default: 'float64')
+
+    connectivity_estimators : ['corr', 'lw_cov', 'partial_corr', 'tangent']
+        Connectivity estimators saved as edge attributes: Pearson's correlation,
+        Ledoit-Wolf shrinkage covariance, partial correlation and tangent space.
+        At least one estimator must be selected
+        (Default: ['corr'])
+
+    dynamic_connectivity : traits.Bool
+        Compute also the sliding-window (dynamic) connectivity of each scale,
+        saved as a (windows x edges) float32 array
+        (Default: False)
+
+    window_length : traits.Range
+        Number of timepoints of a window of the dynamic connectivity
+        (Default: 60)
+
+    window_step : traits.Range
+        Number of timepoints between the starts of two consecutive windows
+        (Default: 1)
+
+    cache_timeseries : traits.Bool
+        Cache the average ROI time-series in the stage directory to reuse them
+        in later runs with the same fMRI and parcellation volumes,
+        e.g. when only the scrubbing thresholds or the estimators change
+        (Default: False)
+
+    output_types : ['gPickle', 'mat', 'cff', 'graphml', 'npz']
         Output connectome format
 
     log_visualization : traits.Bool
@@ -65,6 +98,13 @@ class ConnectomeConfig(HasTraits):
     apply_scrubbing = Bool(False)
     FD_thr = Float(0.2)
     DVARS_thr = Float(4.0)
+    fisher_z = Bool(False)
+    connectivity_dtype = Enum('float64', ['float64', 'float32'])
+    connectivity_estimators = List(['corr'], minlen=1)
+    dynamic_connectivity = Bool(False)
+    window_length = Range(low=1, value=60)
+    window_step = Range(low=1, value=1)
+    cache_timeseries = Bool(False)
     output_types = List(['gPickle', 'mat', 'cff', 'graphml'])
     log_visualization = Bool(True)
     circular_layout = Bool(False)
@@ -93,7 +133,7 @@ class ConnectomeStage(Stage):
 
         self.config = ConnectomeConfig()
         self.inputs = ["roi_volumes_registered", "func_file", "FD", "DVARS",
-                       "parcellation_scheme", "atlas_info", "roi_graphMLs"]
+                       "parcellation_scheme", "atlas_info", "roi_graphMLs", "avg_timeseries"]
         self.outputs = ["connectivity_matrices", "avg_timeseries"]
 
     def create_workflow(self, flow, inputnode, outputnode):
@@ -115,12 +155,21 @@ class ConnectomeStage(Stage):
         cmtk_cmat.inputs.apply_scrubbing = self.config.apply_scrubbing
         cmtk_cmat.inputs.FD_th = self.config.FD_thr
         cmtk_cmat.inputs.DVARS_th = self.config.DVARS_thr
+        cmtk_cmat.inputs.fisher_z = self.config.fisher_z
+        cmtk_cmat.inputs.connectivity_dtype = self.config.connectivity_dtype
+        cmtk_cmat.inputs.connectivity_estimators = self.config.connectivity_estimators
+        cmtk_cmat.inputs.dynamic_connectivity = self.config.dynamic_connectivity
+        cmtk_cmat.inputs.window_length = self.config.window_length
+        cmtk_cmat.inputs.window_step = self.config.window_step
+        if self.config.cache_timeseries:
+            cmtk_cmat.inputs.timeseries_cache_dir = os.path.join(self.stage_dir, 'timeseries_cache')
 
         flow.connect([
             (inputnode, cmtk_cmat, [('func_file', 'func_file'), ("FD", "FD"), ("DVARS", "DVARS"),
                                     ('parcellation_scheme',
                                      'parcellation_scheme'), ('atlas_info', 'atlas_info'),
-                                    ('roi_volumes_registered', 'roi_volumes'), ('roi_graphMLs', 'roi_graphmls')]),
+                                    ('roi_volumes_registered', 'roi_volumes'), ('roi_graphMLs', 'roi_graphmls'),
+                                    ('avg_timeseries', 'avg_timeseries')]),
             (cmtk_cmat, outputnode,
              [('connectivity_matrices', 'connectivity_matrices'), ("avg_timeseries", "avg_timeseries")])
         ])
@@ -139,6 +188,8 @@ class ConnectomeStage(Stage):
 
             map_scale = "log" if self.config.log_visualization else "default"
             layout = 'circular' if self.config.circular_layout else 'matrix'
+            estimators = self.config.connectivity_estimators
+            estimator = estimators[0] if estimators and 'corr' not in estimators else 'corr'
             mat = func_outputs['func.@connectivity_matrices']
 
             if isinstance(mat, str):
@@ -148,7 +199,7 @@ class ConnectomeStage(Stage):
                     if os.path.exists(mat):
                         self.inspect_outputs_dict[
                             'ROI-average time-series correlation - Connectome %s' % os.path.basename(mat)] = [
-                            "showmatrix_gpickle", layout, mat, "corr", "False",
+                            "showmatrix_gpickle", layout, mat, estimator, "False",
                             self.config.subject + ' - ' + con_name + ' - Correlation', map_scale]
             else:
                 for mat in mat:
@@ -157,7 +208,7 @@ class ConnectomeStage(Stage):
                             0].split("_")[-1]
                         if os.path.exists(mat):
                             self.inspect_outputs_dict['ROI-average time-series correlation - Connectome %s' % con_name] = [
-                                "showmatrix_gpickle", layout, mat, "corr", "False",
+                                "showmatrix_gpickle", layout, mat, estimator, "False",
                                 self.config.subject + ' - ' + con_name + ' - Correlation', map_scale]
 
             self.inspect_outputs = sorted(
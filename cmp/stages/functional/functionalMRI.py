@@ -19,7 +19,7 @@ from nipype.interfaces import afni
 
 # Own imports
 from cmp.stages.common import Stage
-from cmtklib.functionalMRI import Scrubbing, Detrending, Nuisance_regression
+from cmtklib.functionalMRI import Scrubbing, Detrending, Nuisance_regression, Fused_postprocessing
 
 
 class FunctionalMRIConfig(HasTraits):
@@ -47,7 +47,7 @@ class FunctionalMRIConfig(HasTraits):
         Perform detrending
         (Default: True)
 
-    detrending_mode = Enum("linear", "quadratic")
+    detrending_mode = Enum("linear", "quadratic", "cubic")
         Detrending mode
         (Default: "Linear")
 
@@ -63,6 +63,26 @@ class FunctionalMRIConfig(HasTraits):
         Perform scrubbing
         (Default: True)
 
+    fused_postprocessing = Bool
+        Run scrubbing, detrending and nuisance regression in a single node
+        that reads and writes the fMRI volume only once. The average ROI
+        time-series are also computed there if no bandpass filtering is applied
+        (Default: False)
+
+    save_intermediate_volumes = Bool
+        Save the detrended and nuisance regressed volumes for quality control
+        when ``fused_postprocessing`` is enabled
+        (Default: False)
+
+    streaming = Bool
+        Process the volumes of detrending and nuisance regression by slabs
+        under ``memory_budget`` and write uncompressed volumes
+        (Default: False)
+
+    memory_budget = Int
+        Approximate memory (in MB) used to process a slab in streaming mode
+        (Default: 2048)
+
     See Also
     --------
     cmp.stages.functional.functionalMRI.FunctionalMRIStage
@@ -77,13 +97,19 @@ class FunctionalMRIConfig(HasTraits):
     motion = Bool(True)
 
     detrending = Bool(True)
-    detrending_mode = Enum("linear", "quadratic")
+    detrending_mode = Enum("linear", "quadratic", "cubic")
 
     lowpass_filter = Float(0.01)
     highpass_filter = Float(0.1)
 
     scrubbing = Bool(True)
 
+    fused_postprocessing = Bool(False)
+    save_intermediate_volumes = Bool(False)
+
+    streaming = Bool(False)
+    memory_budget = Int(2048)
+
 
 class FunctionalMRIStage(Stage):
     """Class that represents the post-registration preprocessing stage of the `fMRIPipeline`.
@@ -108,7 +134,7 @@ class FunctionalMRIStage(Stage):
         self.config = FunctionalMRIConfig()
         self.inputs = ["preproc_file", "motion_par_file", "registered_roi_volumes", "registered_wm", "eroded_wm",
                        "eroded_csf", "eroded_brain"]
-        self.outputs = ["func_file", "FD", "DVARS"]
+        self.outputs = ["func_file", "FD", "DVARS", "avg_timeseries"]
 
     def create_workflow(self, flow, inputnode, outputnode):
         """Create the stage worflow.
@@ -124,66 +150,112 @@ class FunctionalMRIStage(Stage):
         outputnode : nipype.interfaces.utility.IdentityInterface
             Identity interface describing the outputs of the stage
         """
-        if self.config.scrubbing:
-            scrubbing = pe.Node(interface=Scrubbing(), name='scrubbing')
-            flow.connect([
-                (inputnode, scrubbing, [("preproc_file", "in_file")]),
-                (inputnode, scrubbing, [("registered_wm", "wm_mask")]),
-                (inputnode, scrubbing, [
-                 ("registered_roi_volumes", "gm_file")]),
-                (inputnode, scrubbing, [
-                 ("motion_par_file", "motion_parameters")]),
-                (scrubbing, outputnode, [("fd_npy", "FD")]),
-                (scrubbing, outputnode, [("dvars_npy", "DVARS")])
-            ])
-
-        detrending_output = pe.Node(interface=util.IdentityInterface(fields=["detrending_output"]),
-                                    name="detrending_output")
-        if self.config.detrending:
-            detrending = pe.Node(interface=Detrending(), name='detrending')
-            detrending.inputs.mode = self.config.detrending_mode
+        apply_filtering = self.config.lowpass_filter > 0 or self.config.highpass_filter > 0
+        regress_nuisance = self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion
+
+        if self.config.fused_postprocessing:
+            # Single node computing scrubbing measures, detrending and nuisance regression in memory,
+            # and the average ROI time-series if no temporal filtering is applied afterwards
+            postprocessing = pe.Node(interface=Fused_postprocessing(), name='fused_postprocessing')
+            postprocessing.inputs.scrubbing = self.config.scrubbing
+            postprocessing.inputs.detrending = self.config.detrending
+            postprocessing.inputs.detrending_mode = self.config.detrending_mode
+            postprocessing.inputs.global_nuisance = self.config.global_nuisance
+            postprocessing.inputs.csf_nuisance = self.config.csf
+            postprocessing.inputs.wm_nuisance = self.config.wm
+            postprocessing.inputs.motion_nuisance = self.config.motion
+            postprocessing.inputs.roi_averaging = not apply_filtering
+            postprocessing.inputs.save_intermediates = self.config.save_intermediate_volumes
             flow.connect([
-                (inputnode, detrending, [("preproc_file", "in_file")]),
-                (inputnode, detrending, [
-                 ("registered_roi_volumes", "gm_file")]),
-                (detrending, detrending_output, [
-                 ("out_file", "detrending_output")])
+                (inputnode, postprocessing, [("preproc_file", "in_file"),
+                                             ("registered_roi_volumes", "gm_file"),
+                                             ("registered_wm", "wm_mask"),
+                                             ("eroded_brain", "brainfile"),
+                                             ("eroded_csf", "csf_file"),
+                                             ("registered_wm", "wm_file")])
             ])
-        else:
+            if self.config.scrubbing or self.config.motion:
+                flow.connect([
+                    (inputnode, postprocessing, [("motion_par_file", "motion_file")])
+                ])
+            if self.config.scrubbing:
+                flow.connect([
+                    (postprocessing, outputnode, [("fd_npy", "FD"), ("dvars_npy", "DVARS")])
+                ])
+            if not apply_filtering:
+                flow.connect([
+                    (postprocessing, outputnode, [("avg_timeseries", "avg_timeseries")])
+                ])
+            nuisance_output = pe.Node(interface=util.IdentityInterface(
+                fields=["nuisance_output"]), name="nuisance_output")
             flow.connect([
-                (inputnode, detrending_output, [
-                 ("preproc_file", "detrending_output")])
-            ])
-
-        nuisance_output = pe.Node(interface=util.IdentityInterface(
-            fields=["nuisance_output"]), name="nuisance_output")
-        if self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
-            nuisance = pe.Node(interface=Nuisance_regression(),
-                               name="nuisance_regression")
-            nuisance.inputs.global_nuisance = self.config.global_nuisance
-            nuisance.inputs.csf_nuisance = self.config.csf
-            nuisance.inputs.wm_nuisance = self.config.wm
-            nuisance.inputs.motion_nuisance = self.config.motion
-            nuisance.inputs.n_discard = self.config.discard_n_volumes
-            flow.connect([
-                (detrending_output, nuisance, [
-                 ("detrending_output", "in_file")]),
-                (inputnode, nuisance, [("eroded_brain", "brainfile")]),
-                (inputnode, nuisance, [("eroded_csf", "csf_file")]),
-                (inputnode, nuisance, [("registered_wm", "wm_file")]),
-                (inputnode, nuisance, [("motion_par_file", "motion_file")]),
-                (inputnode, nuisance, [("registered_roi_volumes", "gm_file")]),
-                (nuisance, nuisance_output, [("out_file", "nuisance_output")])
+                (postprocessing, nuisance_output, [("out_file", "nuisance_output")])
             ])
         else:
-            flow.connect([
-                (detrending_output, nuisance_output, [
-                 ("detrending_output", "nuisance_output")])
-            ])
+            if self.config.scrubbing:
+                scrubbing = pe.Node(interface=Scrubbing(), name='scrubbing')
+                flow.connect([
+                    (inputnode, scrubbing, [("preproc_file", "in_file")]),
+                    (inputnode, scrubbing, [("registered_wm", "wm_mask")]),
+                    (inputnode, scrubbing, [
+                     ("registered_roi_volumes", "gm_file")]),
+                    (inputnode, scrubbing, [
+                     ("motion_par_file", "motion_parameters")]),
+                    (scrubbing, outputnode, [("fd_npy", "FD")]),
+                    (scrubbing, outputnode, [("dvars_npy", "DVARS")])
+                ])
+
+            detrending_output = pe.Node(interface=util.IdentityInterface(fields=["detrending_output"]),
+                                        name="detrending_output")
+            if self.config.detrending:
+                detrending = pe.Node(interface=Detrending(), name='detrending')
+                detrending.inputs.mode = self.config.detrending_mode
+                detrending.inputs.streaming = self.config.streaming
+                detrending.inputs.memory_budget = self.config.memory_budget
+                flow.connect([
+                    (inputnode, detrending, [("preproc_file", "in_file")]),
+                    (inputnode, detrending, [
+                     ("registered_roi_volumes", "gm_file")]),
+                    (detrending, detrending_output, [
+                     ("out_file", "detrending_output")])
+                ])
+            else:
+                flow.connect([
+                    (inputnode, detrending_output, [
+                     ("preproc_file", "detrending_output")])
+                ])
+
+            nuisance_output = pe.Node(interface=util.IdentityInterface(
+                fields=["nuisance_output"]), name="nuisance_output")
+            if regress_nuisance:
+                nuisance = pe.Node(interface=Nuisance_regression(),
+                                   name="nuisance_regression")
+                nuisance.inputs.global_nuisance = self.config.global_nuisance
+                nuisance.inputs.csf_nuisance = self.config.csf
+                nuisance.inputs.wm_nuisance = self.config.wm
+                nuisance.inputs.motion_nuisance = self.config.motion
+                nuisance.inputs.n_discard = self.config.discard_n_volumes
+                nuisance.inputs.streaming = self.config.streaming
+                nuisance.inputs.memory_budget = self.config.memory_budget
+                flow.connect([
+                    (detrending_output, nuisance, [
+                     ("detrending_output", "in_file")]),
+                    (inputnode, nuisance, [("eroded_brain", "brainfile")]),
+                    (inputnode, nuisance, [("eroded_csf", "csf_file")]),
+                    (inputnode, nuisance, [("registered_wm", "wm_file")]),
+                    (inputnode, nuisance, [("motion_par_file", "motion_file")]),
+                    (inputnode, nuisance, [("registered_roi_volumes", "gm_file")]),
+                    (nuisance, nuisance_output, [("out_file", "nuisance_output")])
+                ])
+            else:
+                flow.connect([
+                    (detrending_output, nuisance_output, [
+                     ("detrending_output", "nuisance_output")])
+                ])
 
         filter_output = pe.Node(interface=util.IdentityInterface(
             fields=["filter_output"]), name="filter_output")
-        if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
+        if apply_filtering:
             from cmtklib.interfaces.afni import Bandpass
             filtering = pe.Node(interface=Bandpass(), name='temporal_filter')
             # filtering = pe.Node(interface=afni.Bandpass(),name='temporal_filter')
@@ -220,15 +292,23 @@ class FunctionalMRIStage(Stage):
         It contains a dictionary of stage outputs with corresponding commands for visual inspection.
         """
         if self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
-            res_dir = os.path.join(self.stage_dir, "nuisance_regression")
-            nuis = os.path.join(res_dir, "fMRI_nuisance.nii.gz")
+            if self.config.fused_postprocessing:
+                nuis = os.path.join(self.stage_dir, "fused_postprocessing", "fMRI_nuisance.nii.gz")
+            elif self.config.streaming:
+                nuis = os.path.join(self.stage_dir, "nuisance_regression", "fMRI_nuisance.nii")
+            else:
+                nuis = os.path.join(self.stage_dir, "nuisance_regression", "fMRI_nuisance.nii.gz")
             if os.path.exists(nuis):
                 self.inspect_outputs_dict['Regression output'] = [
                     'fsleyes', '-sdefault', nuis]
 
         if self.config.detrending:
-            res_dir = os.path.join(self.stage_dir, "detrending")
-            detrend = os.path.join(res_dir, "fMRI_detrending.nii.gz")
+            if self.config.fused_postprocessing:
+                detrend = os.path.join(self.stage_dir, "fused_postprocessing", "fMRI_detrending.nii.gz")
+            elif self.config.streaming:
+                detrend = os.path.join(self.stage_dir, "detrending", "fMRI_detrending.nii")
+            else:
+                detrend = os.path.join(self.stage_dir, "detrending", "fMRI_detrending.nii.gz")
             if os.path.exists(detrend):
                 self.inspect_outputs_dict['Detrending output'] = ['fsleyes', '-sdefault', detrend,
                                                                   '-cm', 'brain_colours_blackbdy_iso']
@@ -255,6 +335,9 @@ class FunctionalMRIStage(Stage):
         """
         if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
             return os.path.exists(os.path.join(self.stage_dir, "temporal_filter", "result_temporal_filter.pklz"))
+        elif self.config.fused_postprocessing:
+            return os.path.exists(
+                os.path.join(self.stage_dir, "fused_postprocessing", "result_fused_postprocessing.pklz"))
         elif self.config.detrending:
             return os.path.exists(os.path.join(self.stage_dir, "detrending", "result_detrending.pklz"))
         elif self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
@@ -60,6 +60,12 @@ class ParcellationConfig(HasTraits):
         'Lausanne2018' parcellation
         (Default: True)
 
+    number_of_threads : traits.Int
+        Number of FreeSurfer commands run concurrently to generate
+        the scales of the 'Lausanne2018' parcellation, set to the
+        ``number_of_threads`` of the segmentation stage
+        (Default: 1)
+
     atlas_info : traits.Dict
         Dictionary storing information of atlases in the form
         >>> atlas_info = {atlas_name: {'number_of_regions': number_of_regions,
@@ -78,6 +84,7 @@ class ParcellationConfig(HasTraits):
     ants_precision_type = Enum(['double', 'float'])
     segment_hippocampal_subfields = Bool(True)
     segment_brainstem = Bool(True)
+    number_of_threads = Int(1)
     pre_custom = Str('Lausanne2008')
     number_of_regions = Int()
     atlas_nifti_file = File(exists=True)
@@ -207,6 +214,8 @@ class ParcellationStage(Stage):
             ), name="%s_parcellation" % self.config.parcellation_scheme)
             parc_node.inputs.parcellation_scheme = self.config.parcellation_scheme
             parc_node.inputs.erode_masks = True
+            parc_node.inputs.number_of_threads = self.config.number_of_threads
+            parc_node.n_procs = self.config.number_of_threads
 
             flow.connect([
                 (inputnode, parc_node,
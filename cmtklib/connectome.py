@@ -10,7 +10,8 @@ from os import path as op
 import csv
 import glob
 import os
-import copy
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 
 from traits.api import *
 
@@ -25,10 +26,11 @@ from nipype.interfaces.base import traits, \
     BaseInterfaceInputSpec, isdefined, \
     InputMultiPath, OutputMultiPath
 from nipype.interfaces import cmtk
-from nipype.utils.filemanip import split_filename
+from nipype.utils.filemanip import split_filename, hash_infile
 
-from .util import mean_curvature, length
-from .parcellation import get_parcellation
+from .util import mean_curvature_packed, length_packed
+from .parcellation import get_parcellation, get_roi_stats, get_roi_stats_of_label
+from .functionalMRI import get_voxel_timeseries, compute_roi_timeseries
 
 
 def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
@@ -36,22 +38,56 @@ def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
     print("Perform group level analysis ...")
 
 
+def pack_fibers(fib):
+    """Packs the points of the fibers in a single array.
+
+    Parameters
+    ----------
+    fib : the fibers data
+        List of fibers as returned by ``nibabel.trackvis.read()``
+
+    Returns
+    -------
+    points : numpy.array
+        Float32 array of size [#points, 3] with the points of all the fibers, one after the other
+
+    offsets : numpy.array
+        Array of size [#fibers + 1] with the start of each fiber in `points`
+    """
+    npoints = np.array([len(fi[0]) for fi in fib], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(npoints)))
+    if len(fib) > 0:
+        points = np.concatenate([np.asarray(fi[0])[:, :3] for fi in fib]).astype(np.float32, copy=False)
+    else:
+        points = np.zeros((0, 3), dtype=np.float32)
+    return points, offsets
+
+
 def compute_curvature_array(fib):
     """Computes the curvature array."""
     print("Compute curvature ...")
 
-    n = len(fib)
-    pc = -1
-    meancurv = np.zeros((n, 1))
-    for i, fi in enumerate(fib):
-        # Percent counter
-        pcN = int(round(float(100 * i) / n))
-        if pcN > pc and pcN % 1 == 0:
-            pc = pcN
-            print('%4.0f%%' % pc)
-        meancurv[i, 0] = mean_curvature(fi[0])
+    points, offsets = pack_fibers(fib)
+    return compute_curvature_array_packed(points, offsets)
 
-    return meancurv
+
+def compute_curvature_array_packed(points, offsets):
+    """Computes the curvature array of fibers given as packed points.
+
+    Parameters
+    ----------
+    points : numpy.array
+        Array of size [#points, 3] (see :func:`pack_fibers`)
+
+    offsets : numpy.array
+        Array of size [#fibers + 1] (see :func:`pack_fibers`)
+
+    Returns
+    -------
+    meancurv : numpy.array
+        Array of size [#fibers, 1] with the mean curvature of each fiber
+    """
+    return mean_curvature_packed(points, offsets).reshape(-1, 1)
 
 
 def create_endpoints_array(fib, voxelSize, print_info):
@@ -78,50 +114,604 @@ def create_endpoints_array(fib, voxelSize, print_info):
         print("========================")
         print("create_endpoints_array")
 
-    # Init
-    n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
-    endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
+    points, offsets = pack_fibers(fib)
+    return create_endpoints_array_packed(points, offsets, voxelSize)
 
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
 
-        # Percent counter
-        if print_info:
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 20 == 0:
-                pc = pcN
-                print('%4.0f%%' % pc)
+def create_endpoints_array_packed(points, offsets, voxelSize):
+    """Create the endpoints arrays of fibers given as packed points.
 
-        f = fi[0]
+    Parameters
+    ----------
+    points : numpy.array
+        Array of size [#points, 3] (see :func:`pack_fibers`)
 
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
+    offsets : numpy.array
+        Array of size [#fibers + 1] (see :func:`pack_fibers`)
 
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
+    voxelSize: 3-tuple
+        It contains the voxel size of the ROI image
 
-        # print 'endpoints (mm) : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+    Returns
+    -------
+    (endpoints: matrix of size [#fibers, 2, 3] containing for each fiber the
+               index of its first and last point in the voxelSize volume
+    endpointsmm) : endpoints in milimeter coordinates
+    """
+    if np.any(np.diff(offsets) == 0):
+        raise ValueError('Fibers without any point cannot have endpoints')
 
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
+    # Gather the first and the last point of each fiber
+    endpointsmm = np.zeros((len(offsets) - 1, 2, 3))
+    endpointsmm[:, 0, :] = points[offsets[:-1], :3]
+    endpointsmm[:, 1, :] = points[offsets[1:] - 1, :3]
 
-        # print 'endpoints : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+    # Translate from mm to index
+    endpoints = np.trunc(endpointsmm / np.array([float(v) for v in voxelSize[:3]]))
 
     # Return the matrices
     return endpoints, endpointsmm
 
 
+def compute_fiber_labels(endpoints_vox, roiData, nROIs):
+    """Label the start and end ROIs of all the fibers at once.
+
+    It reproduces the fiber-wise labeling previously done in :func:`cmat`
+    with array operations over the whole set of fiber endpoints.
+
+    Parameters
+    ----------
+    endpoints_vox : numpy.array
+        Integer array of size [#fibers, 2, 3] containing for each fiber
+        the voxel index of its first and last point in the ROI volume
+
+    roiData : numpy.array
+        Data of the parcellation volume
+
+    nROIs : int
+        Number of regions of the parcellation
+
+    Returns
+    -------
+    fiberlabels : numpy.array
+        Array of size [#fibers, 2] with the (start, end) ROI labels of each fiber,
+        set to (-1, 0) for orphan fibers and to (0, 0) for discarded fibers
+
+    final_fiberlabels : numpy.array
+        Array of size [#final fibers, 2] with the (start, end) ROI labels
+        of the fibers kept, with start label <= end label
+
+    final_fibers_idx : numpy.array
+        Indices of the fibers kept
+
+    n_orphans : int
+        Number of fibers that start or terminate in a voxel which is not labeled
+
+    n_outside : int
+        Number of fibers that start or terminate outside the volume
+    """
+    n = endpoints_vox.shape[0]
+    fiberlabels = np.zeros((n, 2))
+
+    # Numpy negative indexing wraps around so indices in [-dim, dim) are accepted
+    shape = np.array(roiData.shape[:3])
+    inside = np.all((endpoints_vox >= -shape) & (endpoints_vox < shape), axis=(1, 2))
+    vox = np.where(inside[:, np.newaxis, np.newaxis], endpoints_vox, 0)
+
+    labels = roiData[vox[..., 0], vox[..., 1], vox[..., 2]].astype(np.int64)
+
+    orphans = inside & ((labels[:, 0] == 0) | (labels[:, 1] == 0))
+    fiberlabels[orphans, 0] = -1
+
+    valid = inside & ~orphans & (labels[:, 0] <= nROIs) & (labels[:, 1] <= nROIs)
+
+    # Switch the rois in order to enforce startROI < endROI
+    final_fiberlabels = np.sort(labels[valid], axis=1)
+    fiberlabels[valid] = final_fiberlabels
+
+    return (fiberlabels, final_fiberlabels.astype(np.int32), np.flatnonzero(valid),
+            int(np.count_nonzero(orphans)), int(n - np.count_nonzero(inside)))
+
+
+def group_fibers_by_edge(final_fiberlabels):
+    """Group the final fibers by their (start, end) ROI pair.
+
+    Parameters
+    ----------
+    final_fiberlabels : numpy.array
+        Array of size [#final fibers, 2] with the (start, end) ROI labels
+        of each fiber, with start label <= end label
+
+    Returns
+    -------
+    edges : numpy.array
+        Array of size [#edges, 2] with the (start, end) ROI labels of each edge
+
+    fiber_order : numpy.array
+        Indices of the final fibers sorted by edge (and by increasing index
+        within an edge) such that the fibers of edge ``e`` are given by
+        ``fiber_order[edge_offsets[e]:edge_offsets[e + 1]]``
+
+    edge_offsets : numpy.array
+        Array of size [#edges + 1] with the start of each edge in `fiber_order`
+    """
+    if final_fiberlabels.shape[0] == 0:
+        return np.zeros((0, 2), dtype=np.int32), np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+
+    edges, inverse, counts = np.unique(final_fiberlabels, axis=0,
+                                       return_inverse=True, return_counts=True)
+    fiber_order = np.argsort(inverse.ravel(), kind='stable')
+    edge_offsets = np.concatenate(([0], np.cumsum(counts)))
+    return edges, fiber_order, edge_offsets
+
+
+def compute_segment_statistics(values, offsets):
+    """Compute the mean, median and standard deviation of contiguous segments of values.
+
+    Parameters
+    ----------
+    values : numpy.array
+        1D array in which the values of each segment are contiguous
+
+    offsets : numpy.array
+        Array of size [#segments + 1] with the start of each segment in `values`
+
+    Returns
+    -------
+    mean, median, std : numpy.array
+        Statistics of each segment (NaN for empty segments)
+    """
+    counts = np.diff(offsets)
+    n_segments = counts.shape[0]
+    mean = np.full(n_segments, np.nan)
+    median = np.full(n_segments, np.nan)
+    std = np.full(n_segments, np.nan)
+
+    nonempty = counts > 0
+    if not np.any(nonempty):
+        return mean, median, std
+
+    # Sort the values within each segment for the median
+    segment_ids = np.repeat(np.arange(n_segments), counts)
+    values = np.asarray(values, dtype=np.float64)[np.lexsort((values, segment_ids))]
+
+    starts = offsets[:-1][nonempty]
+    n = counts[nonempty]
+    mean[nonempty] = np.add.reduceat(values, starts) / n
+    std[nonempty] = np.sqrt(
+        np.add.reduceat((values - np.repeat(mean, counts)) ** 2, starts) / n)
+    median[nonempty] = 0.5 * (values[starts + (n - 1) // 2] + values[starts + n // 2])
+
+    return mean, median, std
+
+
+def compute_edge_fiber_metrics(edges, edge_offsets, fiber_lengths, roi_volumes, total_volume):
+    """Compute the fiber-based metrics of all the edges in one pass.
+
+    Parameters
+    ----------
+    edges : numpy.array
+        Array of size [#edges, 2] with the (start, end) ROI labels of each edge
+
+    edge_offsets : numpy.array
+        Array of size [#edges + 1] with the start of each edge in `fiber_lengths`
+
+    fiber_lengths : numpy.array
+        Lengths of the final fibers sorted by edge (see :func:`group_fibers_by_edge`)
+
+    roi_volumes : numpy.array
+        Volume (number of voxels) of each ROI indexed by ROI label
+
+    total_volume : float
+        Total volume of the ROIs connected by the edges
+
+    Returns
+    -------
+    metrics : dict
+        Dictionary of arrays of size [#edges] for 'number_of_fibers', 'fiber_length_mean',
+        'fiber_length_median', 'fiber_length_std', 'fiber_proportion', 'fiber_density' and
+        'normalized_fiber_density'
+    """
+    number_of_fibers = np.diff(edge_offsets)
+    total_fibers = float(number_of_fibers.sum())
+
+    fiber_length_mean, fiber_length_median, fiber_length_std = compute_segment_statistics(fiber_lengths,
+                                                                                          edge_offsets)
+
+    # Compute density
+    # density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
+    roi_volume_sum = roi_volumes[edges[:, 0]] + roi_volumes[edges[:, 1]]
+    fiber_density = np.zeros(edges.shape[0])
+    normalized_fiber_density = np.zeros(edges.shape[0])
+    positive = fiber_length_mean > 0.0
+    fiber_density[positive] = ((number_of_fibers[positive] / fiber_length_mean[positive]) *
+                               (2.0 / roi_volume_sum[positive]))
+    normalized_fiber_density[positive] = (((number_of_fibers[positive] / total_fibers) /
+                                           fiber_length_mean[positive]) *
+                                          ((2.0 * float(total_volume)) / roi_volume_sum[positive]))
+
+    return {'number_of_fibers': number_of_fibers,
+            'fiber_length_mean': fiber_length_mean,
+            'fiber_length_median': fiber_length_median,
+            'fiber_length_std': fiber_length_std,
+            'fiber_proportion': 100.0 * (number_of_fibers / total_fibers),
+            'fiber_density': fiber_density,
+            'normalized_fiber_density': normalized_fiber_density}
+
+
+def sample_scalar_maps(points, mmapdata):
+    """Sample a set of scalar maps at the voxels of streamline points.
+
+    The points are mapped to voxel indices once for all the maps sharing the same voxel size.
+
+    Parameters
+    ----------
+    points : numpy.array
+        Array of size [#points, 3] with the coordinates of the points in mm (trackvis voxmm space)
+
+    mmapdata : dict
+        Dictionary of (data, voxel size) for each map
+
+    Returns
+    -------
+    samples : dict
+        Dictionary of (values, inside) arrays of size [#points] for each map, where
+        `inside` is False for the points located outside the map volume (with value 0)
+    """
+    voxels = {}
+    samples = {}
+    for k, (mdata, zooms) in list(mmapdata.items()):
+        if tuple(zooms) not in voxels:
+            voxels[tuple(zooms)] = (points / zooms).astype(np.int64)
+        vox = voxels[tuple(zooms)]
+        inside = np.all((vox >= 0) & (vox < mdata.shape[:3]), axis=1)
+        vox = np.where(inside[:, np.newaxis], vox, 0)
+        samples[k] = (mdata[vox[:, 0], vox[:, 1], vox[:, 2]], inside)
+    return samples
+
+
+def compute_scalar_map_edge_statistics(streamlines, edge_fibers, edge_offsets, mmapdata, max_points=2000000):
+    """Compute the mean, median and standard deviation of scalar maps along the fibers of each edge.
+
+    The points of the fibers are concatenated and sampled by chunks of edges so that
+    all the maps are gathered in one vectorized lookup per chunk. A fiber with at least
+    one point outside a map volume is discarded for this map.
+
+    Parameters
+    ----------
+    streamlines : sequence
+        Sequence of arrays of size [#points, 3] with the points of each fiber
+
+    edge_fibers : numpy.array
+        Indices of the fibers sorted by edge (see :func:`group_fibers_by_edge`)
+
+    edge_offsets : numpy.array
+        Array of size [#edges + 1] with the start of each edge in `edge_fibers`
+
+    mmapdata : dict
+        Dictionary of (data, voxel size) for each map
+
+    max_points : int
+        Maximal number of points sampled at once, bounding the memory used
+        (a chunk always contains at least one edge)
+
+    Returns
+    -------
+    stats : dict
+        Dictionary of (mean, median, std) arrays of size [#edges] for each map,
+        set to NaN for the edges without any valid fiber
+
+    n_discarded : dict
+        Number of fibers discarded for each map
+    """
+    n_edges = len(edge_offsets) - 1
+    stats = {k: (np.full(n_edges, np.nan), np.full(n_edges, np.nan), np.full(n_edges, np.nan))
+             for k in mmapdata.keys()}
+    n_discarded = {k: 0 for k in mmapdata.keys()}
+    if n_edges == 0 or len(mmapdata) == 0:
+        return stats, n_discarded
+
+    fiber_npoints = np.array([len(streamlines[i]) for i in edge_fibers], dtype=np.int64)
+    fiber_point_offsets = np.concatenate(([0], np.cumsum(fiber_npoints)))
+    edge_point_offsets = fiber_point_offsets[edge_offsets]
+
+    e0 = 0
+    while e0 < n_edges:
+        # Take as many edges as possible within the maximal number of points
+        e1 = np.searchsorted(edge_point_offsets, edge_point_offsets[e0] + max_points, side='right') - 1
+        e1 = min(max(e1, e0 + 1), n_edges)
+
+        fibers = edge_fibers[edge_offsets[e0]:edge_offsets[e1]]
+        npoints = fiber_npoints[edge_offsets[e0]:edge_offsets[e1]]
+        points = np.concatenate([streamlines[i] for i in fibers])
+
+        point_fiber = np.repeat(np.arange(len(fibers)), npoints)
+        fiber_edge = np.repeat(np.arange(e1 - e0), np.diff(edge_offsets[e0:e1 + 1]))
+
+        for k, (values, inside) in list(sample_scalar_maps(points, mmapdata).items()):
+            fiber_inside = np.bincount(point_fiber[~inside], minlength=len(fibers)) == 0
+            n_discarded[k] += int(np.count_nonzero(~fiber_inside))
+
+            keep = fiber_inside[point_fiber]
+            edge_counts = np.bincount(fiber_edge[point_fiber[keep]], minlength=e1 - e0)
+            mean, median, std = compute_segment_statistics(values[keep],
+                                                           np.concatenate(([0], np.cumsum(edge_counts))))
+            stats[k][0][e0:e1] = mean
+            stats[k][1][e0:e1] = median
+            stats[k][2][e0:e1] = std
+
+        e0 = e1
+
+    return stats, n_discarded
+
+
+class PackedStreamlines:
+    """Sequence of streamlines stored in one packed array of points.
+
+    The points of all the streamlines are stored contiguously in an
+    array of size [#points, 3], which can be a memory-mapped array, and
+    the points of streamline ``i`` are given by ``points[offsets[i]:offsets[i + 1]]``.
+
+    Parameters
+    ----------
+    points : numpy.array
+        Array of size [#points, 3] with the points of all the streamlines
+
+    offsets : numpy.array
+        Array of size [#streamlines + 1] with the start of each streamline in `points`
+    """
+
+    def __init__(self, points, offsets):
+        self.points = points
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+
+def read_tractogram_chunks(intrk, reference, max_points):
+    """Read a tractogram in TRK or TCK format by chunks of fibers.
+
+    The fibers are returned as for ``nibabel.trackvis.read()``, i.e. as tuples of
+    (points, scalars, properties) with points in trackvis voxmm space.
+    The points of TCK tractograms are transformed to the trackvis voxmm space
+    of the reference image.
+
+    Parameters
+    ----------
+    intrk : TRK or TCK file
+        Tractogram to read
+
+    reference : string
+        Path to the reference image used to build the trackvis header of TCK tractograms
+
+    max_points : int
+        Approximate number of points read per chunk
+
+    Returns
+    -------
+    hdr : numpy.array
+        Trackvis header of the tractogram
+
+    chunks : generator
+        Generator of lists of fibers
+    """
+    if nib.streamlines.detect_format(intrk) is nib.streamlines.TckFile:
+        from nibabel.affines import apply_affine
+        from nibabel.orientations import aff2axcodes
+        from nibabel.streamlines import Field
+        from nibabel.streamlines.trk import get_affine_rasmm_to_trackvis
+
+        ref = nib.load(reference)
+        hdr = nib.trackvis.empty_header()
+        hdr['voxel_size'] = ref.header.get_zooms()[:3]
+        hdr['dim'] = ref.shape[:3]
+        hdr['vox_to_ras'] = ref.affine
+        hdr['voxel_order'] = "".join(aff2axcodes(ref.affine))
+
+        rasmm_to_trackvis = get_affine_rasmm_to_trackvis({Field.VOXEL_TO_RASMM: ref.affine,
+                                                          Field.VOXEL_SIZES: ref.header.get_zooms()[:3],
+                                                          Field.DIMENSIONS: ref.shape[:3],
+                                                          Field.VOXEL_ORDER: hdr['voxel_order']})
+        tck = nib.streamlines.load(intrk, lazy_load=True)
+        streams = ((apply_affine(rasmm_to_trackvis, s).astype(np.float32), None, None)
+                   for s in tck.streamlines)
+    else:
+        streams, hdr = nib.trackvis.read(intrk, as_generator=True)
+
+    def chunk_gen():
+        chunk = []
+        n_points = 0
+        for stream in streams:
+            chunk.append(stream)
+            n_points += len(stream[0])
+            if n_points >= max_points:
+                yield chunk
+                chunk = []
+                n_points = 0
+        if len(chunk) > 0:
+            yield chunk
+
+    return hdr, chunk_gen()
+
+
+def compute_fiber_features(chunks, voxelSize, compute_curvature=True, packed_points_file=None):
+    """Compute the endpoints, lengths and curvature of fibers given by chunks.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Iterable of lists of fibers (see :func:`read_tractogram_chunks`)
+
+    voxelSize : 3-tuple
+        It contains the voxel size of the ROI image
+
+    compute_curvature : bool
+        If True, compute the mean curvature of the fibers
+
+    packed_points_file : string
+        If not None, the points of the fibers are appended to this file
+        as float32 so that they can be memory-mapped (see :class:`PackedStreamlines`)
+
+    Returns
+    -------
+    features : dict
+        Dictionary with the `endpoints` and `endpointsmm` arrays (see :func:`create_endpoints_array`),
+        the `lengths` array and the `meancurvature` array (if `compute_curvature` is True)
+
+    offsets : numpy.array
+        Array of size [#fibers + 1] with the start of each fiber in the packed points
+    """
+    endpoints = []
+    endpointsmm = []
+    lengths = []
+    meancurv = []
+    npoints = []
+
+    packed_points = open(packed_points_file, 'wb') if packed_points_file is not None else None
+    try:
+        for chunk in chunks:
+            points, chunk_offsets = pack_fibers(chunk)
+            ep, epmm = create_endpoints_array_packed(points, chunk_offsets, voxelSize)
+            endpoints.append(ep)
+            endpointsmm.append(epmm)
+            lengths.append(length_packed(points, chunk_offsets))
+            npoints.append(np.diff(chunk_offsets))
+            if compute_curvature:
+                meancurv.append(compute_curvature_array_packed(points, chunk_offsets))
+            if packed_points is not None:
+                packed_points.write(points.tobytes())
+    finally:
+        if packed_points is not None:
+            packed_points.close()
+
+    features = {'endpoints': np.concatenate(endpoints) if endpoints else np.zeros((0, 2, 3)),
+                'endpointsmm': np.concatenate(endpointsmm) if endpointsmm else np.zeros((0, 2, 3)),
+                'lengths': np.concatenate(lengths) if lengths else np.zeros(0)}
+    if compute_curvature:
+        features['meancurvature'] = np.concatenate(meancurv) if meancurv else np.zeros((0, 1))
+    npoints = np.concatenate(npoints) if npoints else np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(npoints)))
+
+    return features, offsets
+
+
+def get_fiber_features_key(intrk, reference):
+    """Returns the key of the fiber features of a tractogram in the cache.
+
+    The key is derived from the content of the tractogram and from the geometry
+    of the reference image used to map the fibers to voxel space.
+
+    Parameters
+    ----------
+    intrk : TRK or TCK file
+        Tractogram
+
+    reference : string
+        Path to the reference (ROI) image
+
+    Returns
+    -------
+    key : string
+        MD5 hexdigest identifying the fiber features
+    """
+    ref = nib.load(reference)
+    md5obj = hashlib.md5()
+    md5obj.update(hash_infile(intrk).encode())
+    md5obj.update(np.asarray(ref.header.get_zooms()[:3], dtype=np.float64).tobytes())
+    md5obj.update(np.asarray(ref.affine, dtype=np.float64).tobytes())
+    md5obj.update(np.asarray(ref.shape[:3], dtype=np.int64).tobytes())
+    return md5obj.hexdigest()
+
+
+def load_fiber_features(features_dir, keys):
+    """Loads cached fiber features as memory-mapped arrays.
+
+    Parameters
+    ----------
+    features_dir : string
+        Cache directory of the fiber features of a tractogram
+
+    keys : list
+        Names of the features required
+
+    Returns
+    -------
+    features : dict
+        Dictionary of memory-mapped arrays (including `offsets`),
+        or None if one of the required features is not in the cache
+    """
+    fnames = dict((k, op.join(features_dir, '%s.npy' % k)) for k in list(keys) + ['offsets'])
+    if not all(op.exists(f) for f in fnames.values()):
+        return None
+    print('... load fiber features from cache: %s' % features_dir)
+    return dict((k, np.load(f, mmap_mode='r')) for k, f in fnames.items())
+
+
+def save_fiber_features(features_dir, features, offsets):
+    """Saves fiber features to the cache.
+
+    Each array is first written to a temporary file and then moved
+    so that concurrent runs never read a partially written file.
+
+    Parameters
+    ----------
+    features_dir : string
+        Cache directory of the fiber features of a tractogram
+
+    features : dict
+        Dictionary of features returned by :func:`compute_fiber_features`
+
+    offsets : numpy.array
+        Array of offsets returned by :func:`compute_fiber_features`
+    """
+    if not op.exists(features_dir):
+        os.makedirs(features_dir, exist_ok=True)
+    arrays = dict(features)
+    arrays['offsets'] = offsets
+    for k, v in arrays.items():
+        tmp_fname = op.join(features_dir, '%s.%i.tmp.npy' % (k, os.getpid()))
+        np.save(tmp_fname, v)
+        os.replace(tmp_fname, op.join(features_dir, '%s.npy' % k))
+    print('... fiber features saved to cache: %s' % features_dir)
+
+
+class SelectedFiberChunks:
+    """Iterable over a selection of fibers read by chunks.
+
+    It has a length so that ``nibabel.trackvis.write()`` can store
+    the number of fibers in the header while streaming them.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Iterable of lists of fibers (see :func:`read_tractogram_chunks`)
+
+    indices : list
+        Indices of fibers included
+    """
+
+    def __init__(self, chunks, indices):
+        self.chunks = chunks
+        self.selected = np.zeros(np.max(indices) + 1 if len(indices) > 0 else 0, dtype=bool)
+        self.selected[indices] = True
+        self.n_selected = int(np.count_nonzero(self.selected))
+
+    def __len__(self):
+        return self.n_selected
+
+    def __iter__(self):
+        i = 0
+        for chunk in self.chunks:
+            for fi in chunk:
+                if i < len(self.selected) and self.selected[i]:
+                    yield fi
+                i += 1
+
+
 def save_fibers(oldhdr, oldfib, fname, indices):
     """Stores a new trackvis file fname using only given indices.
 
@@ -131,7 +721,8 @@ def save_fibers(oldhdr, oldfib, fname, indices):
         Tractogram header to use as reference
 
     oldfib : the fibers data
-        Input fibers
+        Input fibers, given as a list or as an iterable of chunks of fibers
+        (see :func:`read_tractogram_chunks`)
 
     fname : string
         Output tractogram filename
@@ -142,9 +733,12 @@ def save_fibers(oldhdr, oldfib, fname, indices):
 
     hdrnew = oldhdr.copy()
 
-    outstreams = []
-    for i in indices:
-        outstreams.append(oldfib[i])
+    if isinstance(oldfib, list):
+        outstreams = []
+        for i in indices:
+            outstreams.append(oldfib[i])
+    else:
+        outstreams = SelectedFiberChunks(oldfib, indices)
 
     n_fib_out = len(outstreams)
     hdrnew['n_count'] = n_fib_out
@@ -153,8 +747,537 @@ def save_fibers(oldhdr, oldfib, fname, indices):
     nib.trackvis.write(fname, outstreams, hdrnew)
 
 
+class Connectome:
+    """Connectome of one parcellation resolution stored in NumPy arrays.
+
+    Node attributes are stored in lists aligned with the list of nodes,
+    and edge attributes in arrays aligned with the array of edges.
+    A networkx graph is created only when the connectome is saved
+    (see :meth:`to_networkx`).
+
+    Attributes
+    ----------
+    nodes : list
+        Node IDs in the order they were added
+
+    node_attributes : dict
+        Dictionary of lists of attribute values aligned with `nodes`
+        (None if a node does not have the attribute)
+
+    edges : numpy.array
+        Array of size [#edges, 2] with the node IDs of the edges, ordered
+        and oriented as networkx iterates over the edges of a graph
+        where they are added in the order given to :meth:`set_edges`
+
+    edge_attributes : dict
+        Dictionary of arrays of size [#edges] aligned with `edges`
+
+    nan_as_missing : bool
+        If True, a NaN edge attribute value means that the edge does not have the attribute.
+        Otherwise NaN values are stored like any other value
+    """
+
+    def __init__(self, nan_as_missing=True):
+        self.nan_as_missing = nan_as_missing
+        self.nodes = []
+        self.node_attributes = {}
+        self.edges = np.zeros((0, 2), dtype=np.int64)
+        self.edge_attributes = {}
+        self._node_index = {}
+        self._edge_order = np.zeros(0, dtype=np.int64)
+
+    def add_node(self, node, attributes=None):
+        """Adds a node with a dictionary of attributes."""
+        self._node_index[node] = len(self.nodes)
+        self.nodes.append(node)
+        for key in self.node_attributes:
+            self.node_attributes[key].append(None)
+        if attributes is not None:
+            for key, value in list(attributes.items()):
+                if key not in self.node_attributes:
+                    self.node_attributes[key] = [None] * len(self.nodes)
+                self.node_attributes[key][-1] = value
+
+    def get_node_attribute(self, node, key):
+        """Returns the value of an attribute of a node, None if not set."""
+        if key not in self.node_attributes:
+            return None
+        return self.node_attributes[key][self._node_index[node]]
+
+    def set_edges(self, edges, edge_rank):
+        """Sets the edges of the connectome.
+
+        Nodes of the edges which do not exist yet are added without attributes.
+
+        Parameters
+        ----------
+        edges : numpy.array
+            Array of size [#edges, 2] with the node IDs of each edge
+
+        edge_rank : numpy.array
+            Rank of each edge in the order the edges would be added to a networkx graph
+        """
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        edge_rank = np.asarray(edge_rank)
+        added_order = np.argsort(edge_rank, kind='stable')
+        for node in edges[added_order].ravel():
+            if int(node) not in self._node_index:
+                self.add_node(int(node))
+
+        # networkx iterates over the edges node by node, each edge being
+        # reported once from its first node, in the order it was added
+        node_position = np.array([self._node_index[int(node)] for node in edges.ravel()],
+                                 dtype=np.int64).reshape(-1, 2)
+        self._edge_order = np.lexsort((edge_rank, np.min(node_position, axis=1)))
+        swap = node_position[:, 1] < node_position[:, 0]
+        oriented = np.where(swap[:, None], edges[:, ::-1], edges)
+        self.edges = oriented[self._edge_order]
+        self.edge_attributes = {}
+
+    def set_edge_attribute(self, key, values):
+        """Sets an attribute of all the edges.
+
+        Parameters
+        ----------
+        key : string
+            Name of the attribute
+
+        values : numpy.array
+            Values of the attribute, in the order of the edges given to :meth:`set_edges`
+        """
+        self.edge_attributes[key] = np.asarray(values)[self._edge_order]
+
+    def to_networkx(self):
+        """Returns the connectome as a ``networkx.Graph``.
+
+        Integer attributes are converted to ``int``, floating-point ones to ``float``,
+        and NaN edge attribute values are not stored if `nan_as_missing` is True.
+        """
+        G = nx.Graph()
+        for i, u in enumerate(self.nodes):
+            G.add_node(u)
+            for key, values in list(self.node_attributes.items()):
+                if values[i] is not None:
+                    G.nodes[u][key] = values[i]
+
+        is_integer = dict((key, np.issubdtype(values.dtype, np.integer))
+                          for key, values in list(self.edge_attributes.items()))
+        for i, (u, v) in enumerate(self.edges.tolist()):
+            G.add_edge(u, v)
+            for key, values in list(self.edge_attributes.items()):
+                if is_integer[key]:
+                    G[u][v][key] = int(values[i])
+                elif not (self.nan_as_missing and np.isnan(values[i])):
+                    G[u][v][key] = float(values[i])
+        return G
+
+    def get_edge_keys(self):
+        """Returns the names of the attributes of the first edge.
+
+        It corresponds to the attributes that were used as the columns
+        of the connectome files when they were written from the networkx graph.
+        """
+        if len(self.edges) == 0:
+            return []
+        return [key for key, values in list(self.edge_attributes.items())
+                if not self.nan_as_missing or np.issubdtype(values.dtype, np.integer) or not np.isnan(values[0])]
+
+    def write_tsv(self, fname):
+        """Writes the edges and their attributes in a TSV file.
+
+        The file has a header line with the `source` and `target` columns
+        followed by the attributes returned by :meth:`get_edge_keys`.
+        Like for ``networkx.write_edgelist()``, missing values are not written.
+
+        Parameters
+        ----------
+        fname : string
+            Output TSV filename
+        """
+        edge_keys = self.get_edge_keys()
+
+        # Format the values column by column (str() of Python int and float as networkx does)
+        columns = [list(map(str, self.edges[:, 0].tolist())),
+                   list(map(str, self.edges[:, 1].tolist()))]
+        has_missing = False
+        for key in edge_keys:
+            values = self.edge_attributes[key]
+            if values.dtype == np.float32:
+                # Shortest representation of single precision values
+                column = values.astype(str).tolist()
+            else:
+                column = list(map(str, values.tolist()))
+            if self.nan_as_missing and not np.issubdtype(values.dtype, np.integer):
+                for i in np.flatnonzero(np.isnan(values)):
+                    column[i] = None
+                    has_missing = True
+            columns.append(column)
+
+        if has_missing:
+            lines = ['\t'.join([value for value in row if value is not None]) for row in zip(*columns)]
+        else:
+            lines = ['\t'.join(row) for row in zip(*columns)]
+
+        with open(fname, 'w', newline='') as out_file:
+            tsv_writer = csv.writer(out_file, delimiter='\t')
+            tsv_writer.writerow(['source', 'target'] + edge_keys)
+            if len(lines) > 0:
+                out_file.write('\n'.join(lines) + '\n')
+
+    def to_mat_dict(self, size_nodes):
+        """Returns the connectome as a dictionary of structures saved in MATLAB format.
+
+        Parameters
+        ----------
+        size_nodes : int
+            Number of nodes of the parcellation
+
+        Returns
+        -------
+        mdict : dict
+            Dictionary with the `sc` structure of connectivity matrices (one per edge attribute)
+            and the `nodes` structure of node attributes
+        """
+        node_index = np.array([self._node_index[int(u)] for u in self.edges.ravel()],
+                              dtype=np.int64).reshape(-1, 2)
+
+        edge_struct = {}
+        for edge_key in self.get_edge_keys():
+            dtype = np.float32 if self.edge_attributes[edge_key].dtype == np.float32 else np.float64
+            values = self.edge_attributes[edge_key].astype(dtype)
+            if self.nan_as_missing:
+                # Missing values were set to 1 by networkx.to_numpy_matrix()
+                values[np.isnan(values)] = 1
+            matrix = np.zeros((len(self.nodes), len(self.nodes)), dtype=dtype)
+            matrix[node_index[:, 0], node_index[:, 1]] = values
+            matrix[node_index[:, 1], node_index[:, 0]] = values
+            edge_struct[edge_key] = matrix
+
+        node_struct = {}
+        if len(self.nodes) > 0:
+            node_keys = [key for key, values in list(self.node_attributes.items()) if values[0] is not None]
+            for node_key in node_keys:
+                if node_key == 'dn_position':
+                    node_arr = np.zeros([size_nodes, 3], dtype=np.float64)
+                else:
+                    node_arr = np.zeros(size_nodes, dtype=np.object_)
+                for node_n, value in enumerate(self.node_attributes[node_key]):
+                    node_arr[node_n] = value
+                node_struct[node_key] = node_arr
+
+        return {'sc': edge_struct, 'nodes': node_struct}
+
+    def write_npz(self, fname):
+        """Writes the node and edge tables in a compressed NumPy ``.npz`` file.
+
+        Each column is stored as a separate array, named ``node_<attribute>``
+        for the node table (with ``node_id``) and ``edge_<attribute>``
+        for the edge table (with ``edge_source`` and ``edge_target``),
+        so that a single column can be loaded without reading the others.
+        Missing node attributes are stored as NaN or empty strings.
+
+        Parameters
+        ----------
+        fname : string
+            Output NPZ filename
+        """
+        tables = {'node_id': np.array(self.nodes, dtype=np.int64),
+                  'edge_source': self.edges[:, 0],
+                  'edge_target': self.edges[:, 1]}
+        for key, values in list(self.node_attributes.items()):
+            defined = [value for value in values if value is not None]
+            if len(defined) > 0 and isinstance(defined[0], (str, bytes)):
+                column = np.array(['' if value is None else value for value in values])
+            elif len(defined) > 0 and np.ndim(defined[0]) == 1:
+                column = np.array([value if value is not None else [np.nan] * len(defined[0])
+                                   for value in values], dtype=np.float64)
+            else:
+                column = np.array([value if value is not None else np.nan for value in values])
+            tables['node_' + key] = column
+        for key, values in list(self.edge_attributes.items()):
+            tables['edge_' + key] = values
+        np.savez_compressed(fname, **tables)
+
+
+def load_additional_maps(additional_maps):
+    """Loads the additional maps sampled along the fibers.
+
+    Parameters
+    ----------
+    additional_maps : dict
+        A dictionary of key/value for each additional map where the value
+        is the path to the map
+
+    Returns
+    -------
+    mmapdata : dict
+        Dictionary of (data, voxel size) for each map, where NaN values are replaced by zero
+    """
+    mmapdata = {}
+    print('  >> Maps to be processed :')
+    for k, v in list(additional_maps.items()):
+        print("     - %s map" % k)
+        da = nib.load(v)
+        mdata = da.get_data()
+        if np.isnan(mdata).any():
+            print("       NaN values replaced by 0")
+        mdata = np.nan_to_num(mdata)
+        mmapdata[k] = (mdata, da.get_header().get_zooms())
+    return mmapdata
+
+
+def cmat_resolution(parkey, parval, roi_volumes, parcellation_scheme, output_types,
+                    endpoints_vox, fiber_lengths, streamlines, mmapdata, max_points=2000000):
+    """Create and save the connection matrix of one resolution of the parcellation.
+
+    Parameters
+    ----------
+    parkey : string
+        Name of the resolution
+
+    parval : dict
+        Resolution information with the `number_of_regions`
+        and the `node_information_graphml` file
+
+    roi_volumes : list
+        List of parcellation files for a given parcellation scheme
+
+    parcellation_scheme : ['NativeFreesurfer','Lausanne2008','Lausanne2018','Custom']
+
+    output_types : ['gPickle','mat','graphml','npz']
+
+    endpoints_vox : numpy.array
+        Integer array of size [#fibers, 2, 3] with the voxel indices of the fiber endpoints
+
+    fiber_lengths : numpy.array
+        Length of each fiber
+
+    streamlines : sequence
+        Points of each fiber used to sample the additional maps (see :class:`PackedStreamlines`)
+
+    mmapdata : dict
+        Additional maps returned by :func:`load_additional_maps`
+
+    max_points : int
+        Maximal number of points sampled at once in the additional maps
+
+    Returns
+    -------
+    final_fibers_idx : numpy.array
+        Indices of the fibers connecting two ROIs
+    """
+    n = len(endpoints_vox)
+
+    # if parval['number_of_regions'] != 83:
+    #    continue
+
+    # print("Resolution = "+parkey)
+
+    print("------------------------")
+    print("Resolution = " + parkey)
+    print("------------------------")
+
+    # Open the corresponding ROI (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
+
+    # print("Open the corresponding ROI")
+    for vol in roi_volumes:
+        # print parkey
+        if (parkey in vol) or (len(roi_volumes) == 1):
+            roi_fname = vol
+            # print roi_fname
+    # roi_fname = roi_volumes[r]
+    # r += 1
+    roi = nib.load(roi_fname)
+    roiData = roi.get_data()
+
+    # affine_vox_to_world = np.matrix(roi.affine[:3, :3])
+
+    # print "roiData shape : %s " % roiData.shape
+    # print "Affine Voxel 2 World transformation : ",affine_vox_to_world
+
+    # affine_world_to_vox = np.linalg.inv(affine_vox_to_world)
+    # origin = np.matrix(roi.affine[:3, 3]).T
+    # print "Affine World 2 Voxel transformation : ",affine_world_to_vox
+
+    # Create the matrix
+    print("  >> Create the connection matrix (%s rois)" %
+          parval['number_of_regions'])
+
+    nROIs = parval['number_of_regions']
+    connectome = Connectome()
+
+    # Centroid and volume of all the ROIs
+    roi_stats = get_roi_stats(roi_fname, roiData)
+
+    # add node information from parcellation
+    gp = nx.read_graphml(parval['node_information_graphml'])
+    n_nodes = len(gp)
+    pc = -1
+    cnt = -1
+
+    thalamic_labels = []
+    for u, d in gp.nodes(data=True):
+
+        # Percent counter
+        cnt += 1
+        pcN = int(round(float(100 * cnt) / n_nodes))
+        if pcN > pc and pcN % 10 == 0:
+            pc = pcN
+            print('%4.0f%%' % pc)
+
+        node_attributes = dict(d)
+        # compute a position for the node based on the mean position of the
+        # ROI in voxel coordinates (segmentation volume )
+        if parcellation_scheme != "Lausanne2018":
+            roi_label = d["dn_correspondence_id"]
+            # Store parcellation labels corresponding to thalamic nuclei
+            # if gp.node[int(u)]['dn_fsname'] == 'thalamus':
+            #     thalamic_labels.append(int(u))
+        else:
+            roi_label = d["dn_multiscaleID"]
+        (node_attributes['dn_position'],
+         node_attributes['roi_volume'], _) = get_roi_stats_of_label(roi_stats, roi_label)
+        connectome.add_node(int(u), node_attributes)
+
+    thalamic_labels = np.array(thalamic_labels)
+    print("  ************************")
+    print('  >> Labels of thalamic nuclei :')
+    print('  {}'.format(thalamic_labels))
+    print("  ************************")
+
+    print("  >> Processing fibers and computing metrics (%s fibers)" % n)
+    (fiberlabels, final_fiberlabels_array,
+     final_fibers_idx, dis, n_outside) = compute_fiber_labels(endpoints_vox, roiData, nROIs)
+
+    if n_outside > 0:
+        print("  ... ERROR: An index error occured for %i fibers. This means that the fiber start or endpoint is outside the volume. Continue." % n_outside)
+
+    # Group the fibers by edge, the edges being created
+    # in the order the fibers are encountered
+    edges, fiber_order, edge_offsets = group_fibers_by_edge(final_fiberlabels_array)
+    edge_rank = np.argsort(np.argsort(fiber_order[edge_offsets[:-1]]))
+    connectome.set_edges(edges, edge_rank)
+
+    print(
+        "  ... INFO - Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (
+            dis, dis * 100.0 / n, n))
+    print("  ... INFO - Valid fibers: %i (%f percent)" %
+          (n - dis, 100 - dis * 100.0 / n))
+
+    # create a final fiber length array
+    final_fiberlength_array = fiber_lengths[final_fibers_idx]
+
+    roi_volume_by_label = np.zeros(max(connectome.nodes + [0]) + 1)
+    for u, roi_volume in zip(connectome.nodes, connectome.node_attributes.get('roi_volume', [])):
+        if roi_volume is not None:
+            roi_volume_by_label[u] = roi_volume
+
+    # Volume of the ROIs that are the source of at least one edge
+    total_volume = 0
+    for u in np.unique(connectome.edges[:, 0]):
+        total_volume += connectome.get_node_attribute(int(u), 'roi_volume')
+
+    # Compute the fiber metrics of all the edges at once
+    edge_metrics = compute_edge_fiber_metrics(edges, edge_offsets,
+                                              final_fiberlength_array[fiber_order],
+                                              roi_volume_by_label, total_volume)
+    # Compute the statistics of the additional maps along the fibers of all the edges at once
+    map_stats, map_n_discarded = compute_scalar_map_edge_statistics(streamlines,
+                                                                    final_fibers_idx[fiber_order],
+                                                                    edge_offsets, mmapdata, max_points)
+    for k, n_discarded in list(map_n_discarded.items()):
+        if n_discarded > 0:
+            print("  ... ERROR - Index error occured when trying extract scalar values for measure", k)
+            print("  ... ERROR - Discard %i fibers" % n_discarded)
+
+    # measures to add here
+    # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
+    connectome.set_edge_attribute('number_of_fibers', edge_metrics['number_of_fibers'])
+    for key in ['fiber_length_mean', 'fiber_length_median', 'fiber_length_std',
+                'fiber_proportion', 'fiber_density', 'normalized_fiber_density']:
+        connectome.set_edge_attribute(key, edge_metrics[key])
+    for k, (mean, median, std) in list(map_stats.items()):
+        # NaN values (no valid fiber) are not stored in the graph
+        connectome.set_edge_attribute(k + '_mean', mean)
+        connectome.set_edge_attribute(k + '_std', std)
+        connectome.set_edge_attribute(k + '_median', median)
+
+    print("  ************************************************")
+    print("  >> Save connectome maps as :")
+
+    # Storing network/graph in TSV format (by default to be BIDS compliant)
+    print('    - connectome_%s.tsv' % parkey)
+    connectome.write_tsv('connectome_%s.tsv' % parkey)
+
+    # Storing network/graph in other formats that might be prefered by the user
+    if 'gPickle' in output_types or 'graphml' in output_types:
+        G_out = connectome.to_networkx()
+    if 'gPickle' in output_types:
+        print('    - connectome_%s.gpickle' % parkey)
+        nx.write_gpickle(G_out, 'connectome_%s.gpickle' % parkey)
+    if 'mat' in output_types:
+        print('    - connectome_%s.mat' % parkey)
+        sio.savemat('connectome_%s.mat' % parkey, long_field_names=True,
+                    mdict=connectome.to_mat_dict(int(parval['number_of_regions'])))
+    if 'npz' in output_types:
+        print('    - connectome_%s.npz' % parkey)
+        connectome.write_npz('connectome_%s.npz' % parkey)
+    if 'graphml' in output_types:
+        g2 = nx.Graph()
+        for u_gml, v_gml, d_gml in G_out.edges(data=True):
+            g2.add_edge(u_gml, v_gml)
+            for key in d_gml:
+                g2[u_gml][v_gml][key] = d_gml[key]
+        for u_gml, d_gml in G_out.nodes(data=True):
+            g2.add_node(u_gml)
+            if parcellation_scheme != "Lausanne2018":
+                g2.nodes[u_gml]['dn_correspondence_id'] = d_gml['dn_correspondence_id']
+            else:
+                g2.nodes[u_gml]['dn_multiscaleID'] = d_gml['dn_multiscaleID']
+            g2.nodes[u_gml]['dn_fsname'] = d_gml['dn_fsname']
+            g2.nodes[u_gml]['dn_hemisphere'] = d_gml['dn_hemisphere']
+            g2.nodes[u_gml]['dn_name'] = d_gml['dn_name']
+            g2.nodes[u_gml]['dn_position_x'] = d_gml['dn_position'][0]
+            g2.nodes[u_gml]['dn_position_y'] = d_gml['dn_position'][1]
+            g2.nodes[u_gml]['dn_position_z'] = d_gml['dn_position'][2]
+            g2.nodes[u_gml]['dn_region'] = d_gml['dn_region']
+            print('    - connectome_%s.graphml' % parkey)
+        nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
+
+    # print("Storing final fiber length array")
+    fiberlabels_fname = 'final_fiberslength_%s.npy' % str(parkey)
+    np.save(fiberlabels_fname, final_fiberlength_array)
+
+    # print("Storing all fiber labels (with orphans)")
+    fiberlabels_fname = 'filtered_fiberslabel_%s.npy' % str(parkey)
+    np.save(fiberlabels_fname, np.array(fiberlabels, dtype=np.int32), )
+
+    # print("Storing final fiber labels (no orphans)")
+    fiberlabels_noorphans_fname = 'final_fiberlabels_%s.npy' % str(parkey)
+    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+
+    return final_fibers_idx
+
+
+def _cmat_resolution_worker(parkey, parval, roi_volumes, parcellation_scheme, output_types,
+                            endpoints_fname, fiber_lengths_fname, offsets_fname, points_fname,
+                            additional_maps, max_points):
+    """Runs :func:`cmat_resolution` in a worker process from memory-mapped fiber features."""
+    endpoints_vox = np.load(endpoints_fname, mmap_mode='r')
+    fiber_lengths = np.load(fiber_lengths_fname, mmap_mode='r')
+    offsets = np.load(offsets_fname, mmap_mode='r')
+    if points_fname is not None and offsets[-1] > 0:
+        points = np.memmap(points_fname, dtype=np.float32, mode='r', shape=(int(offsets[-1]), 3))
+    else:
+        points = np.zeros((0, 3), dtype=np.float32)
+    mmapdata = load_additional_maps(additional_maps)
+    return cmat_resolution(parkey, parval, roi_volumes, parcellation_scheme, output_types,
+                           endpoints_vox, fiber_lengths, PackedStreamlines(points, offsets), mmapdata, max_points)
+
+
 def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvature=True, additional_maps={},
-         output_types=['gPickle'], atlas_info={}):
+         output_types=['gPickle'], atlas_info={}, streaming=False, memory_budget=2048,
+         fiber_features_cache_dir=None, n_procs=1):
     """Create the connection matrix for each resolution using fibers and ROIs.
 
     Parameters
@@ -176,11 +1299,25 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
         A dictionary of key/value for each additional map where the value
         is the path to the map
 
-    output_types : ['gPickle','mat','graphml']
+    output_types : ['gPickle','mat','graphml','npz']
 
     atlas_info : dict
         Dictionary storing information such as path to files related to a
         parcellation atlas / scheme.
+
+    streaming : Boolean
+        If True, read the tractogram (TRK or TCK) by chunks of fibers
+        instead of loading all the fibers in memory
+
+    memory_budget : int
+        Approximate memory (in MB) used to process a chunk of fibers in streaming mode
+
+    fiber_features_cache_dir : string
+        If not None, directory where the endpoints, lengths and curvature of the fibers
+        are cached, keyed by the content of the tractogram, and reused in later runs
+
+    n_procs : int
+        Number of processes used to create the connection matrices of the different resolutions
     """
 
     print("========================")
@@ -193,7 +1330,6 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     curv_fname = 'meancurvature.npy'
     # intrk = op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk')
     print('... tractogram :' + intrk)
-    fib, hdr = nib.trackvis.read(intrk, False)
 
     # print "Header trackvis : ",hdr
     # print "Header trackvis id_string : ",hdr['id_string']
@@ -248,469 +1384,127 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     roiVoxelSize = firstROI.get_header().get_zooms()
 
     # print "roi Voxel Size",roiVoxelSize
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
+    if streaming:
+        # About 64 bytes are used per point (float32 coordinates, int64 voxel indices, map samples, ...)
+        max_points = max(int(memory_budget * 1024 ** 2 / 64), 1)
+        print('... read tractogram by chunks of %i points' % max_points)
+        hdr, chunks = read_tractogram_chunks(intrk, firstROIFile, max_points)
+    else:
+        max_points = 2000000
+        fib, hdr = nib.trackvis.read(intrk, False)
+
+    packed_points_file = None
+    if streaming and len(additional_maps) > 0:
+        # Keep the fiber points on disk for sampling the additional maps
+        packed_points_file = op.abspath('streamlines_points.dat')
+
+    features = None
+    feature_keys = ['endpoints', 'endpointsmm', 'lengths']
+    if compute_curvature:
+        feature_keys.append('meancurvature')
+    if fiber_features_cache_dir is not None:
+        features_dir = op.join(fiber_features_cache_dir, get_fiber_features_key(intrk, firstROIFile))
+        if packed_points_file is not None:
+            packed_points_file = op.join(features_dir, 'points.dat')
+        if packed_points_file is None or op.exists(packed_points_file):
+            features = load_fiber_features(features_dir, feature_keys)
+
+    if features is not None:
+        offsets = features.pop('offsets')
+    else:
+        points_fname = packed_points_file
+        if fiber_features_cache_dir is not None:
+            if not op.exists(features_dir):
+                os.makedirs(features_dir, exist_ok=True)
+            if packed_points_file is not None:
+                points_fname = '%s.%i.tmp' % (packed_points_file, os.getpid())
+        if streaming:
+            features, offsets = compute_fiber_features(chunks, roiVoxelSize, compute_curvature, points_fname)
+        else:
+            features, offsets = compute_fiber_features([fib], roiVoxelSize, compute_curvature)
+        if fiber_features_cache_dir is not None:
+            save_fiber_features(features_dir, features, offsets)
+            if points_fname is not None:
+                os.replace(points_fname, packed_points_file)
+
+    endpoints = features['endpoints']
+    endpointsmm = features['endpointsmm']
+    fiber_lengths = features['lengths']
     np.save(en_fname, endpoints)
     np.save(en_fnamemm, endpointsmm)
 
+    # Voxel indices of the endpoints are shared by all resolutions
+    endpoints_vox = endpoints.astype(np.int64)
+
     # only compute curvature if required
     if compute_curvature:
-        meancurv = compute_curvature_array(fib)
-        np.save(curv_fname, meancurv)
+        np.save(curv_fname, features['meancurvature'])
+
+    # prepare: load the additional maps once for all resolutions
+    if not streaming:
+        streamlines = [c[0] for c in fib]
+    elif packed_points_file is not None and offsets[-1] > 0:
+        streamlines = PackedStreamlines(np.memmap(packed_points_file, dtype=np.float32, mode='r',
+                                                  shape=(int(offsets[-1]), 3)), offsets)
+    else:
+        streamlines = PackedStreamlines(np.zeros((0, 3), dtype=np.float32), offsets)
 
     print("========================")
 
-    n = len(fib)
-
-    # resolution = gconf.parcellation.keys()
-
-    streamline_wrote = False
-    for parkey, parval in list(resolutions.items()):
-        # if parval['number_of_regions'] != 83:
-        #    continue
-
-        # print("Resolution = "+parkey)
-
-        print("------------------------")
-        print("Resolution = " + parkey)
-        print("------------------------")
-
-        # create empty fiber label array
-        fiberlabels = np.zeros((n, 2))
-        final_fiberlabels = []
-        final_fibers_idx = []
-
-        # Open the corresponding ROI (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
-
-        # print("Open the corresponding ROI")
-        for vol in roi_volumes:
-            # print parkey
-            if (parkey in vol) or (len(roi_volumes) == 1):
-                roi_fname = vol
-                # print roi_fname
-        # roi_fname = roi_volumes[r]
-        # r += 1
-        roi = nib.load(roi_fname)
-        roiData = roi.get_data()
-
-        # affine_vox_to_world = np.matrix(roi.affine[:3, :3])
-
-        # print "roiData shape : %s " % roiData.shape
-        # print "Affine Voxel 2 World transformation : ",affine_vox_to_world
-
-        # affine_world_to_vox = np.linalg.inv(affine_vox_to_world)
-        # origin = np.matrix(roi.affine[:3, 3]).T
-        # print "Affine World 2 Voxel transformation : ",affine_world_to_vox
-
-        # Create the matrix
-        print("  >> Create the connection matrix (%s rois)" %
-              parval['number_of_regions'])
-
-        nROIs = parval['number_of_regions']
-        G = nx.Graph()
-
-        # add node information from parcellation
-        gp = nx.read_graphml(parval['node_information_graphml'])
-        n_nodes = len(gp)
-        pc = -1
-        cnt = -1
-
-        thalamic_labels = []
-        for u, d in gp.nodes(data=True):
-
-            # Percent counter
-            cnt += 1
-            pcN = int(round(float(100 * cnt) / n_nodes))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print('%4.0f%%' % pc)
-
-            G.add_node(int(u))
-            for key in d:
-                G.nodes[int(u)][key] = d[key]
-            # compute a position for the node based on the mean position of the
-            # ROI in voxel coordinates (segmentation volume )
-            if parcellation_scheme != "Lausanne2018":
-                G.nodes[int(u)]['dn_position'] = tuple(
-                    np.mean(np.where(roiData == int(d["dn_correspondence_id"])), axis=1))
-                G.nodes[int(u)]['roi_volume'] = np.sum(
-                    roiData == int(d["dn_correspondence_id"]))
-                # print "Add node %g - roi volume : %g " % (int(u),np.sum( roiData== int(d["dn_correspondence_id"]) ))
-                # Store parcellation labels corresponding to thalamic nuclei
-                # if gp.node[int(u)]['dn_fsname'] == 'thalamus':
-                #     thalamic_labels.append(int(u))
+    if n_procs > 1 and len(resolutions) > 1:
+        # Share the fiber features with the workers through memory-mapped files
+        endpoints_vox_fname = op.abspath('fiber_endpoints_vox.npy')
+        fiber_lengths_fname = op.abspath('fiber_lengths.npy')
+        offsets_fname = op.abspath('fiber_offsets.npy')
+        points_fname = None
+        if len(additional_maps) > 0:
+            if streaming:
+                points_fname = packed_points_file
             else:
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-                G.nodes[int(u)]['dn_position'] = tuple(
-                    np.mean(np.where(roiData == int(d["dn_multiscaleID"])), axis=1))
-                G.nodes[int(u)]['roi_volume'] = np.sum(
-                    roiData == int(d["dn_multiscaleID"]))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-                # print "Add node %g - roi volume (2018): %g " % (int(u),np.sum( roiData== int(d["dn_multiscaleID"]) ))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-
-        thalamic_labels = np.array(thalamic_labels)
-        print("  ************************")
-        print('  >> Labels of thalamic nuclei :')
-        print('  {}'.format(thalamic_labels))
-        print("  ************************")
-
-        dis = 0
-
-        # prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype=np.object)
-
-        mmap = additional_maps
-        mmapdata = {}
-        print('  >> Maps to be processed :')
-        for k, v in list(mmap.items()):
-            print("     - %s map" % k)
-            da = nib.load(v)
-            mdata = da.get_data()
-            print(mdata.max())
-            mdata = np.nan_to_num(mdata)
-            print(mdata.max())
-            mmapdata[k] = (mdata, da.get_header().get_zooms())
-
-        # print("mmapdata size : %g " % len(mmapdata.items()))
-
-        print("  ************************")
-
-        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
-        pc = -1
-        for i in range(n):  # n: number of fibers
-
-            # Percent counter
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print('%4.0f%%' % pc)
-
-            # ROI start => ROI end
-            try:
-                startvox = np.zeros((3, 1)).astype(int)
-                startvox[0] = np.int(endpoints[i, 0, 0])
-                startvox[1] = np.int(endpoints[i, 0, 1])
-                startvox[2] = np.int(endpoints[i, 0, 2])
-
-                endvox = np.zeros((3, 1)).astype(int)
-                endvox[0] = np.int(endpoints[i, 1, 0])
-                endvox[1] = np.int(endpoints[i, 1, 1])
-                endvox[2] = np.int(endpoints[i, 1, 2])
-
-                # print "start point : ",startvox
-                # print "end point : ",endvox
-                # print "roi data shape : ",roiData.shape
-
-                # endpoints from create_endpoints_array
-                startROI = int(roiData[startvox[0], startvox[1], startvox[2]])
-                endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
-
-            except IndexError:
-                print(
-                    "... ERROR: An index error occured for fiber %s. This means that the fiber start or endpoint is outside the volume. Continue." % i)
-                continue
-
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i, 0] = -1
-                continue
-
-            if startROI > nROIs or endROI > nROIs:
-                #                print("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                #                print("than is expected by the parcellation node information.")
-                #                print("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                #                print("This needs bugfixing!")
-                continue
-
-            # Switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-
-            # TODO: Refine fibers ending in thalamus
-            # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
-            # Extract all thalamic nuclei the fiber is passing through
-
-            # Refine start/endROI connecting to the most probable nucleus
-
-            # Update fiber label
-            fiberlabels[i, 0] = startROI
-            fiberlabels[i, 1] = endROI
-
-            final_fiberlabels.append([startROI, endROI])
-            final_fibers_idx.append(i)
-
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G[startROI][endROI]['fiblist'].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist=[i])
-
-        print(
-            "  ... INFO - Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (
-                dis, dis * 100.0 / n, n))
-        print("  ... INFO - Valid fibers: %i (%f percent)" %
-              (n - dis, 100 - dis * 100.0 / n))
-
-        # print "roi : ",roi
-        # print "roiData size : ",roiData.size
-        # print "roiData shape : ",roiData.shape
-
-        # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            # compute length of fiber
-            # print('Fiber %i length: %d' % (idx, length(fib[idx][0])))
-            finalfiberlength.append(length(fib[idx][0]))
-
-        # convert to array
-        final_fiberlength_array = np.array(finalfiberlength)
-
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype=np.int32)
-
-        total_fibers = 0
-        total_volume = 0
-        u_old = -1
-        for u, v, d in G.edges(data=True):
-            total_fibers += len(d['fiblist'])
-            if u != u_old:
-                # print("Node %i"%int(u))
-                # print(G.nodes[int(u)])
-                total_volume += G.nodes[int(u)]['roi_volume']
-            u_old = u
-
-        G_out = copy.deepcopy(G)
-
-        # update edges
-        # measures to add here
-        # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
-        for u, v, d in G.edges(data=True):
-            # Check for diagonal elements that raise an error when the edge is visited a second time
-            # print('({}, {}): {}'.format(u, v, list(G[u][v].keys())))
-            G_out.remove_edge(u, v)
-
-            # print("u / v : {} / {}".format(u,v))
-            if len(list(G[u][v].keys())) == 1:
-                di = {'number_of_fibers': len(G[u][v]['fiblist'])}
-
-                # print("G[u][v]['fiblist'] : {}".format(G[u][v]['fiblist']))
-
-                # additional measures
-                # compute mean/std of fiber measure
-                if u <= v:
-                    idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (
-                        final_fiberlabels_array[:, 1] == int(v)))[0]
-                else:
-                    idx = np.where((final_fiberlabels_array[:, 0] == int(v)) & (
-                        final_fiberlabels_array[:, 1] == int(u)))[0]
-
-                # print("idx : {}".format(idx))
-                # print("final_fiberlength_array[idx] : {}".format(final_fiberlength_array[idx]))
-
-                di['fiber_length_mean'] = float(
-                    np.nanmean(final_fiberlength_array[idx]))
-                di['fiber_length_median'] = float(
-                    np.nanmedian(final_fiberlength_array[idx]))
-                di['fiber_length_std'] = float(
-                    np.nanstd(final_fiberlength_array[idx]))
-
-                di['fiber_proportion'] = float(
-                    100.0 * (di['number_of_fibers'] / float(total_fibers)))
-
-                # Compute density
-                # density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
-
-                # print "G.nodes[int(u)]['roi_volume'] : %i / G.nodes[int(v)]['roi_volume'] : %i"
-                #   % (G.nodes[int(u)]['roi_volume'],G.nodes[int(v)]['roi_volume'])
-                # print "di['number_of_fibers'] : %i / di['fiber_length_mean'] : %i" % (di['number_of_fibers'],di['fiber_length_mean'])
-
-                if di['fiber_length_mean'] > 0.0:
-                    di['fiber_density'] = float((float(di['number_of_fibers']) / float(di['fiber_length_mean'])) * float(
-                        2.0 / (G.nodes[int(u)]['roi_volume'] + G.nodes[int(v)]['roi_volume'])))
-                    di['normalized_fiber_density'] = float(
-                        ((float(di['number_of_fibers']) / float(total_fibers)) / float(di['fiber_length_mean'])) * (
-                            (2.0 * float(total_volume)) / (
-                                G.nodes[int(u)]['roi_volume'] + G.nodes[int(v)]['roi_volume'])))
-                else:
-                    di['fiber_density'] = 0.0
-                    di['normalized_fiber_density'] = 0.0
-                # this is indexed into the fibers that are valid in the sense of touching start
-                # and end roi and not going out of the volume
-                if u <= v:
-                    idx_valid = np.where((fiberlabels[:, 0] == int(u)) & (
-                        fiberlabels[:, 1] == int(v)))[0]
-                else:
-                    idx_valid = np.where((fiberlabels[:, 0] == int(v)) & (
-                        fiberlabels[:, 1] == int(u)))[0]
-
-                for k, vv in list(mmapdata.items()):
-                    val = []
-
-                    # print("Processing %s map..." % k)
-                    # print(vv[1])
-                    for i in idx_valid:
-                        # retrieve indices
-                        try:
-                            # print(h[i])
-                            idx2 = (h[i] / vv[1]).astype(np.uint32)
-                            # print "idx2 : ",idx2
-                            val.append(vv[0][idx2[:, 0], idx2[:, 1], idx2[:, 2]])
-                        except IndexError as e:
-                            print(
-                                "  ... ERROR - Index error occured when trying extract scalar values for measure", k)
-                            print("  ... ERROR - Discard fiber with index",
-                                  i, "Exception: ", e)
-
-                    # print(k)
-                    if len(val) > 0:
-                        da = np.concatenate(val)
-                        # print(da.max())
-                        # print(np.median(da))
-
-                        if k == 'shore_rtop':
-                            di[k + '_mean'] = da.astype(np.float64).mean()
-                            di[k + '_std'] = da.astype(np.float64).std()
-                            di[k + '_median'] = np.median(da.astype(np.float64))
-                        else:
-                            di[k + '_mean'] = da.mean().astype(np.float)
-                            di[k + '_std'] = da.std().astype(np.float)
-                            di[k + '_median'] = np.median(da).astype(np.float)
-
-                        # print(di[k + '_median'])
-                        del da
-                        del val
-
-                G_out.add_edge(u, v)
-                for key in di:
-                    G_out[u][v][key] = di[key]
-                # print('({}, {}): {}'.format(u, v, list(G[u][v].keys())))
-
-        # print("  ************************************************************************")
-        # for u, v, d in G.edges(data=True):
-        #     print('({}, {}): {}'.format(u, v, list(d.keys())))
-        #     if 'fiblist' in list(d.keys()):
-        #         print(G[u][v]['fiblist'])
-        del G
-
-        print("  ************************************************")
-        print("  >> Save connectome maps as :")
-        # Get the edge attributes/keys/weights from the first edge and then break.
-        # Change w.r.t networkx2
-        edge_keys = []
-        for u, v, d in G_out.edges(data=True):
-            # print(list(d.keys()))
-            edge_keys = list(d.keys())
-            break
-
-        # Storing network/graph in TSV format (by default to be BIDS compliant)
-        print('    - connectome_%s.tsv' % parkey)
-        # Write header fields
-        with open('connectome_%s.tsv' % parkey, 'w') as out_file:
-            tsv_writer = csv.writer(out_file, delimiter='\t')
-            header = ['source', 'target']
-            header = header + [key for key in edge_keys]
-            tsv_writer.writerow(header)
-        # Write list of graph edges with all connectivity metrics (edge_keys)
-        with open('connectome_%s.tsv' % parkey, 'ab') as out_file:
-            nx.write_edgelist(G_out,
-                              out_file,
-                              comments='#',
-                              delimiter='\t',
-                              data=edge_keys,
-                              encoding='utf-8')
-
-        # Storing network/graph in other formats that might be prefered by the user
-        if 'gPickle' in output_types:
-            print('    - connectome_%s.gpickle' % parkey)
-            nx.write_gpickle(G_out, 'connectome_%s.gpickle' % parkey)
-        if 'mat' in output_types:
-            # edges
-            # size_edges = (int(parval['number_of_regions']), int(
-            #     parval['number_of_regions']))
-
-            edge_struct = {}
-            for edge_key in edge_keys:
-                if edge_key != 'fiblist':
-                    # print('edge key: %s ' % edge_key)
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G_out, weight=edge_key)
-
-            # nodes
-            size_nodes = int(parval['number_of_regions'])
-
-            # Get the node attributes/keys from the first node and then break.
-            # Change w.r.t networkx2
-            for u, d in G_out.nodes(data=True):
-                node_keys = list(d.keys())
-                break
-
-            # print "size_nodes : "
-            # print size_nodes
-            # print "Number of nodes : %i" % len(G)
-
-            node_struct = {}
-            for node_key in node_keys:
-                if node_key == 'dn_position':
-                    node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                else:
-                    node_arr = np.zeros(size_nodes, dtype=np.object_)
-
-                node_n = 0
-                for _, node_data in G_out.nodes(data=True):
-                    node_arr[node_n] = node_data[node_key]
-                    # print " node_arr[%i]:" % node_n
-                    # print node_arr[node_n]
-                    node_n += 1
-                # print('node key: %s ' % node_key)
-                node_struct[node_key] = node_arr
-            print('    - connectome_%s.mat' % parkey)
-            sio.savemat('connectome_%s.mat' % parkey, long_field_names=True,
-                        mdict={'sc': edge_struct,
-                               'nodes': node_struct})
-        if 'graphml' in output_types:
-            g2 = nx.Graph()
-            for u_gml, v_gml, d_gml in G_out.edges(data=True):
-                g2.add_edge(u_gml, v_gml)
-                for key in d_gml:
-                    g2[u_gml][v_gml][key] = d_gml[key]
-            for u_gml, d_gml in G_out.nodes(data=True):
-                g2.add_node(u_gml)
-                if parcellation_scheme != "Lausanne2018":
-                    g2.nodes[u_gml]['dn_correspondence_id'] = d_gml['dn_correspondence_id']
-                else:
-                    g2.nodes[u_gml]['dn_multiscaleID'] = d_gml['dn_multiscaleID']
-                g2.nodes[u_gml]['dn_fsname'] = d_gml['dn_fsname']
-                g2.nodes[u_gml]['dn_hemisphere'] = d_gml['dn_hemisphere']
-                g2.nodes[u_gml]['dn_name'] = d_gml['dn_name']
-                g2.nodes[u_gml]['dn_position_x'] = d_gml['dn_position'][0]
-                g2.nodes[u_gml]['dn_position_y'] = d_gml['dn_position'][1]
-                g2.nodes[u_gml]['dn_position_z'] = d_gml['dn_position'][2]
-                g2.nodes[u_gml]['dn_region'] = d_gml['dn_region']
-                print('    - connectome_%s.graphml' % parkey)
-            nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
-
-        # print("Storing final fiber length array")
-        fiberlabels_fname = 'final_fiberslength_%s.npy' % str(parkey)
-        np.save(fiberlabels_fname, final_fiberlength_array)
-
-        # print("Storing all fiber labels (with orphans)")
-        fiberlabels_fname = 'filtered_fiberslabel_%s.npy' % str(parkey)
-        np.save(fiberlabels_fname, np.array(fiberlabels, dtype=np.int32), )
-
-        # print("Storing final fiber labels (no orphans)")
-        fiberlabels_noorphans_fname = 'final_fiberlabels_%s.npy' % str(parkey)
-        np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
-
-        if not streamline_wrote:
-            print("  > Filtering tractography - keeping only no orphan fibers")
-            finalfibers_fname = 'streamline_final.trk'
-            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+                points_fname = op.abspath('streamlines_points.dat')
+        try:
+            np.save(endpoints_vox_fname, endpoints_vox)
+            np.save(fiber_lengths_fname, fiber_lengths)
+            np.save(offsets_fname, offsets)
+            if points_fname is not None and not streaming:
+                with open(points_fname, 'wb') as f:
+                    f.write(pack_fibers(fib)[0].tobytes())
+
+            n_workers = min(n_procs, len(resolutions))
+            print('  >> Process the %i resolutions with %i processes' % (len(resolutions), n_workers))
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(_cmat_resolution_worker, parkey, parval, roi_volumes,
+                                           parcellation_scheme, output_types, endpoints_vox_fname,
+                                           fiber_lengths_fname, offsets_fname, points_fname,
+                                           additional_maps, max_points)
+                           for parkey, parval in list(resolutions.items())]
+                for future in futures:
+                    final_fibers_idx = future.result()
+        finally:
+            # remove the shared copies even if a resolution failed
+            shared_fnames = [endpoints_vox_fname, fiber_lengths_fname, offsets_fname]
+            if points_fname is not None and not streaming:
+                shared_fnames.append(points_fname)
+            for fname in shared_fnames:
+                if op.exists(fname):
+                    os.remove(fname)
+    else:
+        mmapdata = load_additional_maps(additional_maps)
+        for parkey, parval in list(resolutions.items()):
+            final_fibers_idx = cmat_resolution(parkey, parval, roi_volumes, parcellation_scheme, output_types,
+                                               endpoints_vox, fiber_lengths, streamlines, mmapdata, max_points)
+
+    # The final tractogram keeps the fibers of the last resolution
+    print("  > Filtering tractography - keeping only no orphan fibers")
+    finalfibers_fname = 'streamline_final.trk'
+    if streaming:
+        del streamlines
+        if packed_points_file is not None and fiber_features_cache_dir is None:
+            os.remove(packed_points_file)
+        _, chunks = read_tractogram_chunks(intrk, firstROIFile, max_points)
+        save_fibers(hdr, chunks, finalfibers_fname, final_fibers_idx)
+    else:
+        save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
 
     print("Done.")
     print("========================")
@@ -739,6 +1533,19 @@ class CMTK_cmatInputSpec(BaseInterfaceInputSpec):
     output_types = traits.List(
         Str, desc='Output types of the connectivity matrices')
 
+    streaming = traits.Bool(
+        False, desc='Read the tractogram by chunks of fibers instead of loading it in memory', usedefault=True)
+
+    memory_budget = traits.Int(
+        2048, desc='Approximate memory (in MB) used to process a chunk of fibers in streaming mode', usedefault=True)
+
+    fiber_features_cache_dir = traits.Str(
+        desc='Directory where the fiber endpoints, lengths and curvature are cached and reused across runs')
+
+    n_procs = traits.Int(
+        1, desc='Number of processes used to create the connection matrices of the different resolutions',
+        usedefault=True)
+
     # probtrackx = traits.Bool(False, desc="MUST be set to True if probtrackx was used (Not used anymore in CMP3)")
 
     voxel_connectivity = InputMultiPath(File(exists=True),
@@ -796,12 +1603,21 @@ class CMTK_cmat(BaseInterface):
         else:
             additional_maps = {}
 
+        if isdefined(self.inputs.fiber_features_cache_dir) and self.inputs.fiber_features_cache_dir != '':
+            fiber_features_cache_dir = self.inputs.fiber_features_cache_dir
+        else:
+            fiber_features_cache_dir = None
+
         cmat(intrk=self.inputs.track_file[0], roi_volumes=self.inputs.roi_volumes,
              roi_graphmls=self.inputs.roi_graphmls,
              parcellation_scheme=self.inputs.parcellation_scheme, atlas_info=self.inputs.atlas_info,
              compute_curvature=self.inputs.compute_curvature,
              additional_maps=additional_maps,
-             output_types=self.inputs.output_types)
+             output_types=self.inputs.output_types,
+             streaming=self.inputs.streaming,
+             memory_budget=self.inputs.memory_budget,
+             fiber_features_cache_dir=fiber_features_cache_dir,
+             n_procs=self.inputs.n_procs)
 
         return runtime
 
@@ -823,6 +1639,359 @@ class CMTK_cmat(BaseInterface):
         return outputs
 
 
+def get_roi_timeseries_key(func_hash, roi_file, n_rois):
+    """Returns the key of the average ROI time-series of a resolution in the cache.
+
+    The key is derived from the content of the post-processed fMRI volume
+    (so that any change of the nuisance regression, detrending or filtering
+    settings gives a new key) and of the parcellation volume.
+
+    Parameters
+    ----------
+    func_hash : string
+        MD5 hexdigest of the content of the fMRI volume
+        as given by ``nipype.utils.filemanip.hash_infile()``
+
+    roi_file : string
+        Path to the parcellation volume
+
+    n_rois : int
+        Number of regions of the parcellation
+
+    Returns
+    -------
+    key : string
+        MD5 hexdigest identifying the average ROI time-series
+    """
+    md5obj = hashlib.md5()
+    md5obj.update(func_hash.encode())
+    md5obj.update(hash_infile(roi_file).encode())
+    md5obj.update(np.asarray(n_rois, dtype=np.int64).tobytes())
+    return md5obj.hexdigest()
+
+
+def load_roi_timeseries(timeseries_dir, key):
+    """Loads cached average ROI time-series.
+
+    Parameters
+    ----------
+    timeseries_dir : string
+        Cache directory of the average ROI time-series
+
+    key : string
+        Key returned by :func:`get_roi_timeseries_key`
+
+    Returns
+    -------
+    ts : numpy.array
+        Array of size [#ROIs, #timepoints], or None if not in the cache
+    """
+    fname = op.join(timeseries_dir, '%s.npy' % key)
+    if not op.exists(fname):
+        return None
+    print('... load average time-series from cache: %s' % fname)
+    return np.load(fname)
+
+
+def save_roi_timeseries(timeseries_dir, key, ts):
+    """Saves average ROI time-series to the cache.
+
+    The array is first written to a temporary file and then moved
+    so that concurrent runs never read a partially written file.
+
+    Parameters
+    ----------
+    timeseries_dir : string
+        Cache directory of the average ROI time-series
+
+    key : string
+        Key returned by :func:`get_roi_timeseries_key`
+
+    ts : numpy.array
+        Array of size [#ROIs, #timepoints]
+    """
+    if not op.exists(timeseries_dir):
+        os.makedirs(timeseries_dir, exist_ok=True)
+    tmp_fname = op.join(timeseries_dir, '%s.%i.tmp.npy' % (key, os.getpid()))
+    np.save(tmp_fname, ts)
+    os.replace(tmp_fname, op.join(timeseries_dir, '%s.npy' % key))
+    print('... average time-series saved to cache: %s' % timeseries_dir)
+
+
+def compute_correlation_matrix(ts, fisher_z=False, dtype='float64'):
+    """Computes the Pearson's correlation coefficient between all pairs of time-series.
+
+    The time-series are centered and normalized once so that the correlation
+    matrix is given by a single matrix product.
+
+    Parameters
+    ----------
+    ts : numpy.array
+        Array of size [#ROIs, #timepoints]
+
+    fisher_z : bool
+        If True, apply the Fisher z-transform (arctanh) to the correlation coefficients.
+        They are clipped to +/-(1 - eps) so that perfectly correlated pairs stay finite,
+        and the self-connections (infinite z-value) are set to 0
+
+    dtype : 'float64' or 'float32'
+        Data type of the returned matrix
+
+    Returns
+    -------
+    fmat : numpy.array
+        Correlation matrix of size [#ROIs, #ROIs]. It is NaN for constant time-series
+    """
+    x = np.array(ts, dtype=np.float64)
+    x -= x.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x /= np.sqrt(np.sum(x ** 2, axis=1, keepdims=True))
+    fmat = np.clip(x @ x.T, -1, 1)
+    if fisher_z:
+        fmat = fisher_z_transform(fmat, dtype=dtype)
+    return fmat.astype(dtype)
+
+
+def fisher_z_transform(fmat, dtype='float64'):
+    """Applies the Fisher z-transform (arctanh) to a correlation matrix.
+
+    The coefficients are clipped to +/-(1 - eps) so that perfectly correlated
+    pairs of ROIs stay finite. The z-value of a self-connection is infinite and
+    carries no information, so the diagonal is set to 0 (it is kept NaN for
+    ROIs with constant time-series).
+
+    Parameters
+    ----------
+    fmat : numpy.array
+        Correlation matrix of size [#ROIs, #ROIs]
+
+    dtype : 'float64' or 'float32'
+        Data type whose machine epsilon is used for the clipping
+
+    Returns
+    -------
+    zmat : numpy.array
+        Fisher z-transformed matrix of size [#ROIs, #ROIs]
+    """
+    eps = np.finfo(dtype).eps
+    zmat = np.arctanh(np.clip(fmat, -1 + eps, 1 - eps))
+    diag = np.diag(zmat)
+    np.fill_diagonal(zmat, np.where(np.isnan(diag), np.nan, 0))
+    return zmat
+
+
+def compute_ledoit_wolf_covariance(x):
+    """Computes the Ledoit-Wolf shrinkage estimate of the covariance of centered time-series.
+
+    The empirical covariance is shrunk towards a scaled identity with the
+    optimal shrinkage coefficient of Ledoit and Wolf (2004), computed in closed form
+    from the same matrix product as the empirical covariance.
+
+    Parameters
+    ----------
+    x : numpy.array
+        Centered time-series of size [#ROIs, #timepoints]
+
+    Returns
+    -------
+    cov : numpy.array
+        Shrunk covariance matrix of size [#ROIs, #ROIs]
+
+    shrinkage : float
+        Shrinkage coefficient in [0, 1]
+    """
+    n_features, n_samples = x.shape
+    cov = (x @ x.T) / n_samples
+    mu = np.trace(cov) / n_features
+    x2_sum = np.sum(x ** 2, axis=0)
+    beta = (np.sum(x2_sum ** 2) / n_samples - np.sum(cov ** 2)) / (n_features * n_samples)
+    delta = (np.sum(cov ** 2) - 2 * mu * np.trace(cov) + n_features * mu ** 2) / n_features
+    beta = min(beta, delta)
+    shrinkage = 0. if beta == 0 else beta / delta
+    cov *= 1. - shrinkage
+    cov.flat[::n_features + 1] += shrinkage * mu
+    return cov, shrinkage
+
+
+def compute_connectivity_estimators(ts, estimators=('corr',), fisher_z=False, dtype='float64'):
+    """Computes the connectivity matrices of a set of estimators from the same time-series.
+
+    Available estimators are:
+
+    * ``'corr'``: Pearson's correlation coefficient
+    * ``'lw_cov'``: Ledoit-Wolf shrinkage covariance of the standardized time-series
+    * ``'partial_corr'``: partial correlation given by the inverse of the ``'lw_cov'`` matrix
+    * ``'tangent'``: tangent space projection of the ``'lw_cov'`` matrix at the identity,
+      i.e. its matrix logarithm (log-Euclidean)
+
+    The time-series are standardized once and the shrunk covariance is
+    diagonalized once, its eigendecomposition giving both the precision
+    matrix and the matrix logarithm. ROIs with constant or non-finite
+    time-series are excluded from the model based estimators and get
+    NaN connectivity values.
+
+    Parameters
+    ----------
+    ts : numpy.array
+        Array of size [#ROIs, #timepoints]
+
+    estimators : list of str
+        Estimators to compute
+
+    fisher_z : bool
+        If True, apply the Fisher z-transform (arctanh) to the correlation
+        coefficients (``'corr'`` and ``'partial_corr'``), whose self-connections
+        are then set to 0 (see :func:`fisher_z_transform`)
+
+    dtype : 'float64' or 'float32'
+        Data type of the returned matrices
+
+    Returns
+    -------
+    fmats : dict
+        Connectivity matrices of size [#ROIs, #ROIs] indexed by estimator
+    """
+    fmats = {}
+    if 'corr' in estimators:
+        fmats['corr'] = compute_correlation_matrix(ts, fisher_z=fisher_z, dtype=dtype)
+
+    model_estimators = [e for e in estimators if e != 'corr']
+    if not model_estimators:
+        return fmats
+
+    x = np.array(ts, dtype=np.float64)
+    x -= x.mean(axis=1, keepdims=True)
+    std = np.sqrt(np.mean(x ** 2, axis=1))
+    valid = np.isfinite(std) & (std > 0)
+    x = x[valid] / std[valid, np.newaxis]
+
+    cov, shrinkage = compute_ledoit_wolf_covariance(x)
+    print('  Ledoit-Wolf shrinkage: %.4f' % shrinkage)
+    if 'partial_corr' in model_estimators or 'tangent' in model_estimators:
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        # without shrinkage, the covariance of fewer timepoints than ROIs is singular:
+        # floor the eigenvalues so that the inverse and the logarithm stay finite
+        eigvals = np.maximum(eigvals, np.finfo(np.float64).eps * max(eigvals.max(), 1.))
+
+    n_rois = len(valid)
+    valid_idx = np.ix_(valid, valid)
+    for estimator in model_estimators:
+        if estimator == 'lw_cov':
+            fmat = cov
+        elif estimator == 'partial_corr':
+            precision = (eigvecs / eigvals) @ eigvecs.T
+            d = np.sqrt(np.diag(precision))
+            fmat = - precision / np.outer(d, d)
+            np.fill_diagonal(fmat, 1)
+            if fisher_z:
+                fmat = fisher_z_transform(fmat, dtype=dtype)
+        elif estimator == 'tangent':
+            fmat = (eigvecs * np.log(eigvals)) @ eigvecs.T
+        else:
+            raise ValueError('Unknown connectivity estimator: %s' % estimator)
+        fmats[estimator] = np.full((n_rois, n_rois), np.nan, dtype=dtype)
+        fmats[estimator][valid_idx] = fmat
+    return fmats
+
+
+def compute_dynamic_correlation(ts, window_length, window_step=1, fisher_z=False, out=None):
+    """Computes the sliding-window Pearson's correlation between all pairs of time-series.
+
+    The sums and cross-products of the time-series over a window are updated
+    incrementally when the window slides (timepoints entering minus timepoints leaving)
+    instead of recomputing the correlation of each window.
+
+    Parameters
+    ----------
+    ts : numpy.array
+        Array of size [#ROIs, #timepoints]
+
+    window_length : int
+        Number of timepoints of a window
+
+    window_step : int
+        Number of timepoints between the starts of two consecutive windows
+
+    fisher_z : bool
+        If True, apply the Fisher z-transform (arctanh) to the correlation coefficients.
+        They are clipped to +/-(1 - eps) so that perfectly correlated pairs stay finite
+        (self-connections are not part of the edges)
+
+    out : numpy.array
+        Optional float32 array of size [#windows, #edges] (e.g. a memory-mapped array)
+        where the result is written
+
+    Returns
+    -------
+    dfc : numpy.array
+        float32 array of size [#windows, #edges] where the edges are the pairs (i, j)
+        with i < j in the order of ``numpy.triu_indices(#ROIs, k=1)``.
+        It is NaN for time-series that are constant in a window
+
+    window_starts : numpy.array
+        Index of the first timepoint of each window
+    """
+    x = np.array(ts, dtype=np.float64)
+    # centering over the whole series limits the cancellation in the covariance
+    x -= x.mean(axis=1, keepdims=True)
+    n_rois, tp = x.shape
+    window_starts = get_window_starts(tp, window_length, window_step)
+    i_idx, j_idx = np.triu_indices(n_rois, k=1)
+    edges = i_idx * n_rois + j_idx
+    dfc = out if out is not None else np.empty((len(window_starts), len(edges)), dtype=np.float32)
+
+    cross_products = np.empty((n_rois, n_rois))
+    corr = np.empty((n_rois, n_rois))
+    for w, start in enumerate(window_starts):
+        stop = start + window_length
+        if w == 0 or start - window_starts[w - 1] >= window_length:
+            # windows without overlap: sums over the whole window
+            sums = x[:, start:stop].sum(axis=1)
+            np.matmul(x[:, start:stop], x[:, start:stop].T, out=cross_products)
+        else:
+            leaving = x[:, window_starts[w - 1]:start]
+            entering = x[:, window_starts[w - 1] + window_length:stop]
+            sums += entering.sum(axis=1) - leaving.sum(axis=1)
+            # entering @ entering.T - leaving @ leaving.T in a single product
+            cross_products += np.hstack((entering, leaving)) @ np.hstack((entering, -leaving)).T
+
+        # corr = (cross_products - sums sums^T / n) / (std std^T)
+        np.multiply.outer(sums, sums / window_length, out=corr)
+        np.subtract(cross_products, corr, out=corr)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            inv_std = 1 / np.sqrt(np.diag(corr).copy())
+        corr *= inv_std[:, np.newaxis]
+        corr *= inv_std[np.newaxis, :]
+        values = np.clip(np.take(corr, edges), -1, 1)
+        if fisher_z:
+            eps = np.finfo(np.float32).eps
+            values = np.arctanh(np.clip(values, -1 + eps, 1 - eps))
+        dfc[w] = values
+    return dfc, window_starts
+
+
+def get_window_starts(tp, window_length, window_step=1):
+    """Returns the index of the first timepoint of each sliding window.
+
+    Parameters
+    ----------
+    tp : int
+        Number of timepoints
+
+    window_length : int
+        Number of timepoints of a window
+
+    window_step : int
+        Number of timepoints between the starts of two consecutive windows
+
+    Returns
+    -------
+    window_starts : numpy.array
+        Start of the windows fully included in the time-series
+    """
+    return np.arange(0, tp - window_length + 1, window_step)
+
+
 class rsfmri_conmat_InputSpec(BaseInterfaceInputSpec):
     func_file = File(exists=True, mandatory=True, desc="fMRI volume")
 
@@ -848,9 +2017,37 @@ class rsfmri_conmat_InputSpec(BaseInterfaceInputSpec):
 
     DVARS_th = Float(desc="DVARS threshold")
 
+    avg_timeseries = InputMultiPath(File(exists=True),
+                                    desc='Average ROI time-series (.npy) precomputed by '
+                                         'cmtklib.functionalMRI.Fused_postprocessing '
+                                         '(matched to each resolution by file name)')
+
     output_types = traits.List(Str,
                                desc='Output types of the connectivity matrices')
 
+    fisher_z = Bool(False, usedefault=True,
+                    desc="Apply the Fisher z-transform to the correlation coefficients")
+
+    connectivity_dtype = traits.Enum('float64', ['float64', 'float32'], usedefault=True,
+                                     desc="Data type of the connectivity values")
+
+    timeseries_cache_dir = traits.Str(
+        desc='Directory where the average ROI time-series are cached and reused across runs')
+
+    connectivity_estimators = traits.List(traits.Enum('corr', 'lw_cov', 'partial_corr', 'tangent'), ['corr'],
+                                          minlen=1, usedefault=True,
+                                          desc="Connectivity estimators, each saved as an edge attribute "
+                                               "(see cmtklib.connectome.compute_connectivity_estimators)")
+
+    dynamic_connectivity = Bool(False, usedefault=True,
+                                desc="Compute also the sliding-window (dynamic) connectivity")
+
+    window_length = traits.Range(low=1, value=60, usedefault=True,
+                                 desc="Number of timepoints of a window of the dynamic connectivity")
+
+    window_step = traits.Range(low=1, value=1, usedefault=True,
+                               desc="Number of timepoints between two windows of the dynamic connectivity")
+
 
 class rsfmri_conmat_OutputSpec(TraitedSpec):
     avg_timeseries = OutputMultiPath(File(exists=True),
@@ -868,6 +2065,8 @@ class rsfmri_conmat(BaseInterface):
 
     It applies scrubbing (if enabled), computes the average GM ROI time-series and computes
     the Pearson's correlation coefficient between each GM ROI time-series poir.
+    Shrinkage covariance, partial correlation and tangent space estimators
+    can be computed in addition (``connectivity_estimators``).
 
     Examples
     --------
@@ -898,9 +2097,18 @@ class rsfmri_conmat(BaseInterface):
         print("Compute average rs-fMRI signal for each cortical ROI")
         print("====================================================")
 
-        fdata = nib.load(self.inputs.func_file).get_data()
+        tp = nib.load(self.inputs.func_file).shape[3]
 
-        tp = fdata.shape[3]
+        # 2D view of the 4D data shared by all the resolutions,
+        # loaded only if some time-series are not precomputed
+        voxel_ts = None
+        avg_timeseries = self.inputs.avg_timeseries if isdefined(self.inputs.avg_timeseries) else []
+
+        if isdefined(self.inputs.timeseries_cache_dir) and self.inputs.timeseries_cache_dir != '':
+            timeseries_cache_dir = self.inputs.timeseries_cache_dir
+            func_hash = hash_infile(self.inputs.func_file)
+        else:
+            timeseries_cache_dir = None
 
         # OLD
         # if self.inputs.parcellation_scheme != "Custom":
@@ -982,12 +2190,25 @@ class rsfmri_conmat(BaseInterface):
             # nROIs: number of ROIs for current resolution
             nROIs = parval['number_of_regions']
 
-            # matrix number of rois vs timepoints
-            ts = np.zeros((nROIs, tp), dtype=np.float32)
-
-            # loop throughout all the ROIs (current resolution)
-            for i in range(1, nROIs + 1):
-                ts[i - 1, :] = fdata[mask == i].mean(axis=0)
+            # matrix number of rois vs timepoints, computed in one pass over the labels
+            precomputed = [f for f in avg_timeseries if parkey in os.path.basename(f)]
+            if precomputed:
+                print("Load precomputed time-series %s" % precomputed[0])
+                ts = np.load(precomputed[0])[:nROIs]
+                # labels without voxels have NaN time-series
+                ts = np.vstack((ts, np.full((nROIs - ts.shape[0], tp), np.nan, dtype=np.float32)))
+            else:
+                ts = None
+                if timeseries_cache_dir is not None:
+                    key = get_roi_timeseries_key(func_hash, roi_fname, nROIs)
+                    ts = load_roi_timeseries(timeseries_cache_dir, key)
+                if ts is None:
+                    if voxel_ts is None:
+                        fdata = nib.load(self.inputs.func_file).get_data()
+                        voxel_ts, voxel_order = get_voxel_timeseries(fdata)
+                    ts = compute_roi_timeseries(voxel_ts, mask, nROIs, order=voxel_order)
+                    if timeseries_cache_dir is not None:
+                        save_roi_timeseries(timeseries_cache_dir, key, ts)
             print("ts_shape:", ts.shape)
 
             np.save(os.path.abspath('averageTimeseries_%s.npy' % parkey), ts)
@@ -1016,34 +2237,21 @@ class rsfmri_conmat(BaseInterface):
 
             # Create matrix, add node information from parcellation and recover ROI indexes
             print("Create the connection matrix (%s rois)" % nROIs)
-            G = nx.Graph()
+            connectome = Connectome(nan_as_missing=False)
             gp = nx.read_graphml(parval['node_information_graphml'])
+            roi_stats = get_roi_stats(roi_fname, roiData)
             ROI_idx = []
             for u, d in gp.nodes(data=True):
-                G.add_node(int(u))
-                for key in d:
-                    G.nodes[int(u)][key] = d[key]
+                node_attributes = dict(d)
                 # compute a position for the node based on the mean position of the
                 # ROI in voxel coordinates (segmentation volume )
                 if self.inputs.parcellation_scheme != "Lausanne2018":
-                    G.nodes[int(u)]['dn_position'] = tuple(
-                        np.mean(np.where(mask == int(d["dn_correspondence_id"])), axis=1))
-                    ROI_idx.append(int(d["dn_correspondence_id"]))
+                    roi_label = int(d["dn_correspondence_id"])
                 else:
-                    G.nodes[int(u)]['dn_position'] = tuple(
-                        np.mean(np.where(mask == int(d["dn_multiscaleID"])), axis=1))
-                    ROI_idx.append(int(d["dn_multiscaleID"]))
-            # # matrix number of rois vs timepoints
-            # ts = np.zeros( (nROIs,tp), dtype = np.float32 )
-            #
-            # # loop throughout all the ROIs (current resolution)
-            # roi_line = 0
-            # for i in ROI_idx:
-            #     ts[roi_line,:] = fdata[roiData==i].mean( axis = 0 )
-            #     roi_line += 1
-            #
-            # np.save( os.path.abspath('averageTimeseries_%s.npy' % parkey), ts )
-            # sio.savemat( os.path.abspath('averageTimeseries_%s.mat' % parkey), {'TCS':ts} )
+                    roi_label = int(d["dn_multiscaleID"])
+                node_attributes['dn_position'], _, _ = get_roi_stats_of_label(roi_stats, roi_label)
+                connectome.add_node(int(u), node_attributes)
+                ROI_idx.append(roi_label)
 
             # Censoring time-series
             if self.inputs.apply_scrubbing:
@@ -1072,97 +2280,30 @@ class rsfmri_conmat(BaseInterface):
                 ts = ts_after_scrubbing
                 print('ts.shape : ', ts.shape)
 
-                # initialize connectivity matrix
-                nnodes = ts.shape[0]
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in range(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s_after_scrubbing.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(),
-                #    'fconnectome_%s_after_scrubbing.mat' % s), {'fmat':fmat} )
-            else:
-                nnodes = ts.shape[0]
-
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in range(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(), 'fconnectome_%s.mat' % s), {'fmat':fmat} )
-
-            # Get the edge attributes/keys/weights from the first edge and then break.
-            # Change w.r.t networkx2
-            edge_keys = []
-            for _, _, d in G.edges(data=True):
-                # print(list(d.keys()))
-                edge_keys = list(d.keys())
-                break
+            # Connectivity between all the pairs of ROI time-series (including self-connections)
+            fmats = compute_connectivity_estimators(ts, estimators=self.inputs.connectivity_estimators,
+                                                    fisher_z=self.inputs.fisher_z,
+                                                    dtype=self.inputs.connectivity_dtype)
+            nnodes = ts.shape[0]
+            i_idx, j_idx = np.triu_indices(nnodes)
+            ROI_idx = np.array(ROI_idx[:nnodes], dtype=np.int64)
+            connectome.set_edges(np.stack((ROI_idx[i_idx], ROI_idx[j_idx]), axis=1), np.arange(len(i_idx)))
+            for estimator in self.inputs.connectivity_estimators:
+                connectome.set_edge_attribute(estimator, fmats[estimator][i_idx, j_idx])
 
             print('    - connectome_%s.tsv' % parkey)
-
-            with open('connectome_%s.tsv' % parkey, 'w') as out_file:
-                tsv_writer = csv.writer(out_file, delimiter='\t')
-                header = ['source', 'target']
-                header = header + [key for key in edge_keys]
-                tsv_writer.writerow(header)
-
-            with open('connectome_%s.tsv' % parkey, 'ab') as out_file:
-                nx.write_edgelist(G,
-                                  out_file,
-                                  comments='#',
-                                  delimiter='\t',
-                                  data=edge_keys,
-                                  encoding='utf-8')
+            connectome.write_tsv('connectome_%s.tsv' % parkey)
 
             # storing network
+            if 'gPickle' in self.inputs.output_types or 'graphml' in self.inputs.output_types:
+                G = connectome.to_networkx()
             if 'gPickle' in self.inputs.output_types:
                 nx.write_gpickle(G, 'connectome_%s.gpickle' % parkey)
             if 'mat' in self.inputs.output_types:
-                # edges
-                # size_edges = (int(parval['number_of_regions']), int(
-                #     parval['number_of_regions']))
-
-                edge_struct = {}
-                for edge_key in edge_keys:
-                    edge_struct[edge_key] = nx.to_numpy_matrix(
-                        G, weight=edge_key)
-
-                # nodes
-                size_nodes = int(parval['number_of_regions'])
-
-                # Get the node attributes/keys from the first node and then break.
-                # Change w.r.t networkx2
-                for u, d in G.nodes(data=True):
-                    node_keys = list(d.keys())
-                    break
-
-                node_struct = {}
-                for node_key in node_keys:
-                    if node_key == 'dn_position':
-                        node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                    else:
-                        node_arr = np.zeros(size_nodes, dtype=np.object_)
-                    node_n = 0
-                    for _, node_data in G.nodes(data=True):
-                        node_arr[node_n] = node_data[node_key]
-                        node_n += 1
-                    node_struct[node_key] = node_arr
-
-                sio.savemat('connectome_%s.mat' % parkey, mdict={
-                            'sc': edge_struct, 'nodes': node_struct})
+                sio.savemat('connectome_%s.mat' % parkey,
+                            mdict=connectome.to_mat_dict(int(parval['number_of_regions'])))
+            if 'npz' in self.inputs.output_types:
+                connectome.write_npz('connectome_%s.npz' % parkey)
             if 'graphml' in self.inputs.output_types:
                 g2 = nx.Graph()
                 # Create graph nodes
@@ -1182,13 +2323,44 @@ class rsfmri_conmat(BaseInterface):
                 # Create graph edges
                 for u_gml, v_gml, d_gml in G.edges(data=True):
                     g2.add_edge(u_gml, v_gml)
-                    g2[u_gml][v_gml]['corr'] = float(d_gml['corr'])
+                    for estimator in self.inputs.connectivity_estimators:
+                        g2[u_gml][v_gml][estimator] = float(d_gml[estimator])
                 # Save the graph
                 nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
 
+            if self.inputs.dynamic_connectivity:
+                self._write_dynamic_connectome(parkey, ts, ROI_idx)
+
         print("[ DONE ]")
         return runtime
 
+    def _write_dynamic_connectome(self, parkey, ts, ROI_idx):
+        """Write the sliding-window connectivity of a resolution in ``connectome_<parkey>_dynamic.npz``.
+
+        The file contains the float32 array ``corr`` of size [#windows, #edges],
+        the ROI labels ``edge_source`` and ``edge_target`` of the edges,
+        ``window_start`` and ``window_length``.
+        """
+        window_starts = get_window_starts(ts.shape[1], self.inputs.window_length, self.inputs.window_step)
+        if len(window_starts) == 0:
+            print('  WARNING: no dynamic connectivity for %s as the time-series (%i timepoints) '
+                  'are shorter than the window length (%i)' % (parkey, ts.shape[1], self.inputs.window_length))
+            return
+        nnodes = ts.shape[0]
+        i_idx, j_idx = np.triu_indices(nnodes, k=1)
+        print('    - connectome_%s_dynamic.npz (%i windows)' % (parkey, len(window_starts)))
+        # written to a memory-mapped array to not hold all the windows in memory
+        tmp_fname = os.path.abspath('dynamic_corr_%s.npy' % parkey)
+        dfc = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=np.float32,
+                                        shape=(len(window_starts), len(i_idx)))
+        compute_dynamic_correlation(ts, self.inputs.window_length, self.inputs.window_step,
+                                    fisher_z=self.inputs.fisher_z, out=dfc)
+        np.savez('connectome_%s_dynamic.npz' % parkey, corr=dfc,
+                 edge_source=ROI_idx[i_idx], edge_target=ROI_idx[j_idx],
+                 window_start=window_starts, window_length=self.inputs.window_length)
+        del dfc
+        os.remove(tmp_fname)
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['connectivity_matrices'] = glob.glob(
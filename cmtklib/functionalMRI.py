@@ -12,7 +12,514 @@ import os
 import numpy as np
 import nibabel as nib
 import scipy.io as sio
-from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, InputMultiPath
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, InputMultiPath, \
+    OutputMultiPath
+import scipy.sparse
+
+
+def get_voxel_timeseries(data):
+    """Return a 2D (voxels x timepoints) view of a 4D fMRI data array.
+
+    The voxels are ordered in the memory layout of ``data``
+    such that no copy of the 4D data is made.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D fMRI data array
+
+    Returns
+    -------
+    voxel_ts : numpy.ndarray
+        2D array of shape (number of voxels, number of timepoints)
+
+    order : 'C' or 'F'
+        Order in which the voxels are flattened, to be used
+        to flatten the 3D volumes indexing the voxels
+    """
+    order = 'F' if (data.flags.f_contiguous and not data.flags.c_contiguous) else 'C'
+    voxel_ts = data.reshape((-1, data.shape[3]), order=order)
+    return voxel_ts, order
+
+
+def compute_roi_timeseries(voxel_ts, roi_data, n_rois, order='C'):
+    """Compute the average time-series of all the ROIs of a parcellation in one pass.
+
+    The parcellation is flattened once and the voxel time-series are
+    aggregated by a single sparse (ROIs x voxels) matrix product, instead of
+    building a boolean mask of the whole volume for each ROI.
+
+    Parameters
+    ----------
+    voxel_ts : numpy.ndarray
+        2D array (voxels x timepoints) returned by :func:`get_voxel_timeseries`
+
+    roi_data : numpy.ndarray
+        3D parcellation array, with ROI labels from 1 to ``n_rois``
+
+    n_rois : int
+        Number of ROIs
+
+    order : 'C' or 'F'
+        Order in which the voxels of ``voxel_ts`` are flattened
+
+    Returns
+    -------
+    ts : numpy.ndarray
+        Array of shape (``n_rois``, timepoints) of float32 values,
+        where the row ``i - 1`` is the average time-series of the ROI labeled ``i``
+        (NaN for labels without voxels)
+    """
+    n_rois = int(n_rois)
+    labels = np.asarray(roi_data).ravel(order=order)
+    voxels = np.flatnonzero(np.isin(labels, np.arange(1, n_rois + 1)))
+    rows = labels[voxels].astype(np.int64) - 1
+
+    counts = np.bincount(rows, minlength=n_rois)
+    aggregation = scipy.sparse.csr_matrix((np.ones(len(voxels)), (rows, np.arange(len(voxels)))),
+                                          shape=(n_rois, len(voxels)))
+    sums = aggregation @ np.asarray(voxel_ts[voxels], dtype=np.float64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ts = sums / counts[:, np.newaxis]
+    return ts.astype(np.float32)
+
+
+def regress_out(voxel_ts, X, voxels=None, chunk_size=20000):
+    """Replace in place the voxel time-series by the residuals of a GLM fit.
+
+    The ordinary least squares solution is obtained for all voxels at once
+    by applying the pseudo-inverse of the design matrix to chunks of
+    ``chunk_size`` voxels, which bounds the memory used by the float64 copies.
+
+    Parameters
+    ----------
+    voxel_ts : numpy.ndarray
+        2D array (voxels x timepoints) returned by :func:`get_voxel_timeseries`
+
+    X : numpy.ndarray
+        Design matrix of shape (timepoints, regressors)
+
+    voxels : numpy.ndarray
+        Indices of the rows of ``voxel_ts`` to process.
+        All the voxels are processed if None
+
+    chunk_size : int
+        Number of voxels processed at once
+    """
+    X = np.asarray(X, dtype=np.float64)
+    pinv_X = np.linalg.pinv(X)
+    n_voxels = voxel_ts.shape[0] if voxels is None else len(voxels)
+    for start in range(0, n_voxels, chunk_size):
+        if voxels is None:
+            rows = slice(start, start + chunk_size)
+        else:
+            rows = voxels[start:start + chunk_size]
+        Y = np.asarray(voxel_ts[rows], dtype=np.float64)
+        voxel_ts[rows] = Y - (Y @ pinv_X.T) @ X.T
+
+
+def create_detrending_regressors(tp, mode='linear', spline_knots_spacing=1000):
+    """Create the regressors of the trend removed by :class:`Detrending`.
+
+    Parameters
+    ----------
+    tp : int
+        Number of timepoints
+
+    mode : 'linear', 'quadratic' or 'cubic'
+        Linear or quadratic polynomial, or cubic spline trend
+
+    spline_knots_spacing : int
+        Number of timepoints between two interior knots of the cubic spline.
+        If larger than the number of timepoints, the spline has no interior
+        knot and reduces to a cubic polynomial
+
+    Returns
+    -------
+    X : numpy.ndarray
+        Regressors of shape (``tp``, number of regressors)
+    """
+    t = np.linspace(-1, 1, tp)
+    if mode == 'linear':
+        return np.vander(t, 2, increasing=True)
+    if mode == 'quadratic':
+        return np.vander(t, 3, increasing=True)
+
+    # Cubic B-spline basis with interior knots every spline_knots_spacing timepoints
+    from scipy.interpolate import BSpline
+    interior_knots = t[np.arange(spline_knots_spacing, tp - 1, spline_knots_spacing)]
+    knots = np.concatenate(([t[0]] * 4, interior_knots, [t[-1]] * 4))
+    n_basis = len(knots) - 4
+    return BSpline(knots, np.eye(n_basis), 3)(t)
+
+
+def iter_volume_chunks(dataimg, stop=None, chunk_size=32, overlap=0):
+    """Iterate over chunks of consecutive volumes of a 4D image without loading the whole series.
+
+    The volumes are read through the array proxy of the image, which is
+    memory-mapped for uncompressed NIfTI files. A ``.nii.gz`` file is decompressed
+    from its start for each chunk, so compressed inputs should first be
+    decompressed with :func:`get_uncompressed_image`.
+
+    Parameters
+    ----------
+    dataimg : nibabel.Nifti1Image
+        4D image
+
+    stop : int
+        Index of the volume where to stop (excluded). All the volumes are read if None
+
+    chunk_size : int
+        Number of new volumes in each chunk
+
+    overlap : int
+        Number of volumes of the previous chunk repeated at the beginning of each chunk
+
+    Yields
+    ------
+    start : int
+        Index of the first volume of the chunk
+
+    chunk : numpy.ndarray
+        4D array of the volumes of the chunk
+    """
+    if stop is None:
+        stop = dataimg.shape[3]
+    start = 0
+    while start < stop:
+        first = max(start - overlap, 0)
+        end = min(start + chunk_size, stop)
+        yield first, np.asanyarray(dataimg.dataobj[..., first:end])
+        start = end
+
+
+def compute_dvars(dataimg, mask, stop=None, chunk_size=32):
+    """Compute the DVARS series of a 4D image in chunks of volumes.
+
+    Parameters
+    ----------
+    dataimg : nibabel.Nifti1Image
+        4D fMRI image
+
+    mask : numpy.ndarray
+        3D boolean mask of the voxels used to compute DVARS
+
+    stop : int
+        Index of the last volume used (excluded). All the volumes are used if None
+
+    chunk_size : int
+        Number of volumes read at once
+
+    Returns
+    -------
+    dvars : numpy.ndarray
+        Root mean square over the masked voxels of the difference
+        between each volume and the next one, of length ``stop - 1``
+    """
+    dvars = []
+    for _, chunk in iter_volume_chunks(dataimg, stop=stop, chunk_size=chunk_size, overlap=1):
+        diff = np.diff(np.asarray(chunk[mask], dtype=np.float64), axis=1)
+        dvars.append(np.sqrt(np.mean(diff ** 2, axis=0)))
+    return np.concatenate(dvars)
+
+
+def get_uncompressed_image(in_file, out_file=None):
+    """Return an image whose data can be memory-mapped, decompressing ``.nii.gz`` files if needed.
+
+    Parameters
+    ----------
+    in_file : string
+        Path to a 4D NIfTI image
+
+    out_file : string
+        Path of the decompressed copy of a ``.nii.gz`` image
+        (Default: ``uncompressed_<basename>.nii`` in the current directory)
+
+    Returns
+    -------
+    dataimg : nibabel.Nifti1Image
+        Image read from an uncompressed file. The caller removes the decompressed
+        copy once it is done with it
+    """
+    if not in_file.endswith('.gz'):
+        return nib.load(in_file)
+    import gzip
+    import shutil
+    if out_file is None:
+        out_file = os.path.abspath('uncompressed_%s' % os.path.basename(in_file)[:-3])
+    # decompressed by blocks to not hold the whole series in memory
+    try:
+        with gzip.open(in_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 16 * 1024 ** 2)
+        return nib.load(out_file)
+    except Exception:
+        # do not leave a partial copy behind
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        raise
+
+
+def create_memmap_nifti(out_file, ref_img, dtype):
+    """Create an uncompressed NIfTI file and return its memory-mapped data array.
+
+    The data of the new image can then be written incrementally by slabs.
+
+    Parameters
+    ----------
+    out_file : string
+        Path to the output ``.nii`` file
+
+    ref_img : nibabel.Nifti1Image
+        Image giving the shape, affine and header of the output image
+
+    dtype : numpy.dtype
+        Data type of the output image, stored without scaling
+
+    Returns
+    -------
+    out_data : numpy.memmap
+        4D memory-mapped array of the output image data
+    """
+    hdr = ref_img.header.copy()
+    hdr.set_data_dtype(dtype)
+    hdr.set_slope_inter(None, None)
+    hdr['magic'] = b'n+1'
+    vox_offset = hdr.single_vox_offset
+    hdr['vox_offset'] = vox_offset
+    out_dtype = hdr.get_data_dtype()
+    n_bytes = int(np.prod(ref_img.shape)) * out_dtype.itemsize
+    with open(out_file, 'wb') as f:
+        f.write(hdr.binaryblock)
+        # no header extension
+        f.write(b'\x00' * (vox_offset - len(hdr.binaryblock)))
+        f.seek(vox_offset + n_bytes - 1)
+        f.write(b'\x00')
+    return np.memmap(out_file, dtype=out_dtype, mode='r+', offset=vox_offset,
+                     shape=ref_img.shape, order='F')
+
+
+def get_data_dtype(dataimg):
+    """Return the data type of the array returned by ``dataimg.get_data()`` without loading it."""
+    return np.asanyarray(dataimg.dataobj[:1, :1, :1, :1]).dtype
+
+
+def iter_slabs(dataimg, memory_budget=2048):
+    """Iterate over slabs of consecutive slices of a 4D image under a memory budget.
+
+    Each slab contains all the timepoints of a range of slices along the last
+    spatial axis, which is the slowest varying spatial axis on disk. Slabs are read
+    through the array proxy of the image, which is memory-mapped for uncompressed files
+    (see :func:`get_uncompressed_image`).
+
+    Parameters
+    ----------
+    dataimg : nibabel.Nifti1Image
+        4D image
+
+    memory_budget : int
+        Approximate memory (in MB) used to process a slab, accounting for its copy
+        and for the float64 arrays of the computation
+
+    Yields
+    ------
+    slices : slice
+        Range of slices along the third axis
+
+    slab : numpy.ndarray
+        4D array of the slab
+    """
+    shape = dataimg.shape
+    dtype = get_data_dtype(dataimg)
+    bytes_per_slice = shape[0] * shape[1] * shape[3] * (2 * dtype.itemsize + 3 * 8)
+    n_slices = max(int(memory_budget * 1024 ** 2 // bytes_per_slice), 1)
+    for start in range(0, shape[2], n_slices):
+        slices = slice(start, min(start + n_slices, shape[2]))
+        yield slices, np.array(dataimg.dataobj[:, :, slices, :], dtype=dtype, order='F')
+
+
+def compute_scrubbing_measures(dataimg, mask, move):
+    """Compute the framewise displacement (FD) and DVARS series used for scrubbing.
+
+    Parameters
+    ----------
+    dataimg : nibabel.Nifti1Image
+        4D fMRI image
+
+    mask : numpy.ndarray
+        3D boolean mask of the voxels used to compute DVARS
+
+    move : numpy.ndarray
+        Motion parameters (timepoints x 6)
+
+    Returns
+    -------
+    FD : numpy.ndarray
+        Array of shape (timepoints - 1, 1) whose first value is 0
+
+    DVARS : numpy.ndarray
+        Array of shape (timepoints - 1, 1) whose first value is 0
+    """
+    tp = dataimg.shape[3]
+
+    # initialize motion measures
+    FD = np.zeros((tp - 1, 1))
+    DVARS = np.zeros((tp - 1, 1))
+
+    # FD: sum of the absolute differences of the motion parameters
+    # between consecutive time points (the first value is set to 0)
+    FD[1:, 0] = np.absolute(np.diff(move[:tp - 1, :], axis=0)).sum(axis=1)
+
+    # DVARS: RMS over the masked voxels of the differences between
+    # consecutive volumes, read by chunks of volumes
+    DVARS[1:, 0] = compute_dvars(dataimg, mask, stop=tp - 1)
+    return FD, DVARS
+
+
+def save_scrubbing_measures(FD, DVARS):
+    """Save the FD and DVARS series in ``.npy`` and ``.mat`` formats."""
+    np.save(os.path.abspath('FD.npy'), FD)
+    np.save(os.path.abspath('DVARS.npy'), DVARS)
+    sio.savemat(os.path.abspath('FD.mat'), {'FD': FD})
+    sio.savemat(os.path.abspath('DVARS.mat'), {'DVARS': DVARS})
+
+
+def create_motion_regressors(motion_file, nuisance_motion_nb_reg=36):
+    """Create the motion nuisance regressors from the head motion parameters.
+
+    Parameters
+    ----------
+    motion_file : string
+        Path to the file of motion parameters (one row of 6 parameters per time point)
+
+    nuisance_motion_nb_reg : int
+        Number of motion regressors
+
+    Returns
+    -------
+    move : numpy.ndarray
+        Array of motion regressors (timepoints x regressors)
+    """
+    move = np.genfromtxt(motion_file)
+    move = move - np.mean(move, 0)
+
+    # Update
+    move_der1 = np.concatenate(
+        (np.zeros([1, 6]), move[0:-1, :]), axis=0)
+    move_der2 = np.concatenate(
+        (np.zeros([2, 6]), move[0:-2, :]), axis=0)
+    move_sq = np.square(move)
+    move_der1_sq = np.square(move_der1)
+    move_der2_sq = np.square(move_der2)
+
+    move_der1 = move_der1 - np.mean(move_der1)
+    move_der2 = move_der2 - np.mean(move_der2)
+    move_der1_sq = move_der1_sq - np.mean(move_der1_sq)
+    move_der2_sq = move_der2_sq - np.mean(move_der2_sq)
+    move_sq = move_sq - np.mean(move_sq)
+
+    if nuisance_motion_nb_reg == '12' or nuisance_motion_nb_reg == '24' or nuisance_motion_nb_reg == '36':
+        move = np.hstack((move, move_sq))
+    if nuisance_motion_nb_reg == '24' or nuisance_motion_nb_reg == '36':
+        move = np.hstack((move, move_der1))
+        move = np.hstack((move, move_der1_sq))
+    if nuisance_motion_nb_reg == '36':
+        move = np.hstack((move, move_der2))
+        move = np.hstack((move, move_der2_sq))
+
+    return move
+
+
+def compute_average_signal(data, mask):
+    """Return the demeaned average signal of the voxels in a mask.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D fMRI data array, or 2D (voxels x timepoints) array
+
+    mask : numpy.ndarray
+        Boolean mask over the voxels of ``data``
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Average signal minus its temporal mean
+    """
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    # accumulated in float64 so that the result does not depend on the voxel order
+    values = data[mask].mean(axis=0, dtype=np.float64).astype(dtype)
+    return values - np.mean(values)
+
+
+def compute_average_signals_by_slabs(dataimg, masks, memory_budget=2048):
+    """Return the demeaned average signals of several masks, reading the image by slabs.
+
+    Parameters
+    ----------
+    dataimg : nibabel.Nifti1Image
+        4D fMRI image
+
+    masks : dict
+        Dictionary of 3D boolean masks indexed by name
+
+    memory_budget : int
+        Approximate memory (in MB) used to process a slab (see :func:`iter_slabs`)
+
+    Returns
+    -------
+    signals : dict
+        Dictionary of average signals minus their temporal mean indexed by name,
+        as computed by :func:`compute_average_signal`
+    """
+    tp = dataimg.shape[3]
+    sums = {name: np.zeros(tp) for name in masks}
+    counts = {name: 0 for name in masks}
+    dtype = None
+    for slices, slab in iter_slabs(dataimg, memory_budget):
+        dtype = slab.dtype if np.issubdtype(slab.dtype, np.floating) else np.float64
+        for name, mask in masks.items():
+            sums[name] += slab[mask[:, :, slices]].sum(axis=0, dtype=np.float64)
+            counts[name] += np.count_nonzero(mask[:, :, slices])
+    signals = {}
+    for name in masks:
+        values = (sums[name] / counts[name]).astype(dtype)
+        signals[name] = values - np.mean(values)
+    return signals
+
+
+def create_nuisance_design_matrix(tp, regressors):
+    """Stack the nuisance regressors with a constant term in a design matrix.
+
+    Parameters
+    ----------
+    tp : int
+        Number of timepoints
+
+    regressors : list of numpy.ndarray
+        Nuisance regressors, each of length ``tp`` or of shape (``tp``, n)
+
+    Returns
+    -------
+    X : numpy.ndarray
+        Design matrix of shape (``tp``, number of regressors + 1)
+    """
+    import statsmodels.api as sm
+    X = np.hstack([np.reshape(r, (tp, -1)) for r in regressors])
+    return sm.add_constant(X)
+
+
+def save_nuisance_signals(signals):
+    """Save the average nuisance signals in ``.npy`` and ``.mat`` formats.
+
+    Parameters
+    ----------
+    signals : dict
+        Dictionary of average signals indexed by name ('Global', 'CSF' or 'WM')
+    """
+    for name, values in signals.items():
+        np.save(os.path.abspath('average%s.npy' % name), values)
+        sio.savemat(os.path.abspath('average%s.mat' % name), {'avg%s' % name: values})
 
 
 class Discard_tp_InputSpec(BaseInterfaceInputSpec):
@@ -90,6 +597,13 @@ class Nuisance_InputSpec(BaseInterfaceInputSpec):
     n_discard = Int(
         desc='Number of volumes discarded from the fMRI sequence during preprocessing')
 
+    streaming = Bool(False, usedefault=True,
+                     desc='If `True` process the volume by slabs under `memory_budget` '
+                          'and write an uncompressed output volume')
+
+    memory_budget = Int(2048, usedefault=True,
+                        desc='Approximate memory (in MB) used to process a slab in streaming mode')
+
 
 class Nuisance_OutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Output fMRI Volume")
@@ -140,154 +654,75 @@ class Nuisance_regression(BaseInterface):
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        # Extract whole brain average signal
         dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
+        tp = dataimg.shape[3]
+
+        # Load the eroded brain, CSF and WM masks
+        masks = {}
         if self.inputs.global_nuisance:
-            brainfile = self.inputs.brainfile  # load eroded whole brain mask
-            brain = nib.load(brainfile).get_data().astype(np.uint32)
-            global_values = data[brain == 1].mean(axis=0)
-            global_values = global_values - np.mean(global_values)
-            np.save(os.path.abspath('averageGlobal.npy'), global_values)
-            sio.savemat(os.path.abspath('averageGlobal.mat'),
-                        {'avgGlobal': global_values})
-
-        # Extract CSF average signal
+            brain = nib.load(self.inputs.brainfile).get_data().astype(np.uint32)
+            masks['Global'] = brain == 1
         if self.inputs.csf_nuisance:
-            csffile = self.inputs.csf_file  # load eroded CSF mask
-            csf = nib.load(csffile).get_data().astype(np.uint32)
-            csf_values = data[csf == 1].mean(axis=0)
-            csf_values = csf_values - np.mean(csf_values)
-            np.save(os.path.abspath('averageCSF.npy'), csf_values)
-            sio.savemat(os.path.abspath('averageCSF.mat'),
-                        {'avgCSF': csf_values})
-
-        # Extract WM average signal
+            csf = nib.load(self.inputs.csf_file).get_data().astype(np.uint32)
+            masks['CSF'] = csf == 1
         if self.inputs.wm_nuisance:
-            WMfile = self.inputs.wm_file  # load eroded WM mask
-            WM = nib.load(WMfile).get_data().astype(np.uint32)
-            wm_values = data[WM == 1].mean(axis=0)
-            wm_values = wm_values - np.mean(wm_values)
-            np.save(os.path.abspath('averageWM.npy'), wm_values)
-            sio.savemat(os.path.abspath('averageWM.mat'), {'avgWM': wm_values})
-
-        # Import parameters from head motion estimation
-        if self.inputs.motion_nuisance:
-            move = np.genfromtxt(self.inputs.motion_file)
-            move = move - np.mean(move, 0)
-
-            # Update
-            move_der1 = np.concatenate(
-                (np.zeros([1, 6]), move[0:-1, :]), axis=0)
-            move_der2 = np.concatenate(
-                (np.zeros([2, 6]), move[0:-2, :]), axis=0)
-            move_sq = np.square(move)
-            move_der1_sq = np.square(move_der1)
-            move_der2_sq = np.square(move_der2)
-
-            move_der1 = move_der1 - np.mean(move_der1)
-            move_der2 = move_der2 - np.mean(move_der2)
-            move_der1_sq = move_der1_sq - np.mean(move_der1_sq)
-            move_der2_sq = move_der2_sq - np.mean(move_der2_sq)
-            move_sq = move_sq - np.mean(move_sq)
-
-            if self.inputs.nuisance_motion_nb_reg == '12' or self.inputs.nuisance_motion_nb_reg == '24' or self.inputs.nuisance_motion_nb_reg == '36':
-                move = np.hstack((move, move_sq))
-            if self.inputs.nuisance_motion_nb_reg == '24' or self.inputs.nuisance_motion_nb_reg == '36':
-                move = np.hstack((move, move_der1))
-                move = np.hstack((move, move_der1_sq))
-            if self.inputs.nuisance_motion_nb_reg == '36':
-                move = np.hstack((move, move_der2))
-                move = np.hstack((move, move_der2_sq))
-
-        # GLM: regress out nuisance covariates
-        new_data = data.copy()
-
-        # s = gconf.parcellation.keys()[0]
-
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
-        # if float(self.inputs.n_discard) > 0:
-        #     n_discard = int(self.inputs.n_discard) - 1
-        #     if self.inputs.motion_nuisance:
-        #         move = move[n_discard:-1,:]
-
-        # build regressors matrix
-        if self.inputs.global_nuisance:
-            X = np.hstack(global_values.reshape(tp, 1))
-            print('> Detrend global average signal')
-            if self.inputs.csf_nuisance:
-                X = np.hstack((X.reshape(tp, 1), csf_values.reshape(tp, 1)))
-                print('... Detrend CSF average signal')
-                if self.inputs.wm_nuisance:
-                    X = np.hstack((X, wm_values.reshape(tp, 1)))
-                    print('... ... Detrend WM average signal')
-                    if self.inputs.motion_nuisance:
-                        print('... ... ... pre-Detrend motion average signals')
-                        X = np.hstack((X, move))
-                        print('... ... ... Detrend motion average signals')
-                elif self.inputs.motion_nuisance:
-                    X = np.hstack((X, move))
-                    print('... ... Detrend motion average signals')
-            elif self.inputs.wm_nuisance:
-                X = np.hstack((X.reshape(tp, 1), wm_values.reshape(tp, 1)))
-                print('... Detrend WM average signal')
-                if self.inputs.motion_nuisance:
-                    X = np.hstack((X, move))
-                    print('... ... Detrend motion average signals')
-            elif self.inputs.motion_nuisance:
-                X = np.hstack((X.reshape(tp, 1), move))
-                print('... Detrend motion average signals')
-        elif self.inputs.csf_nuisance:
-            X = np.hstack((csf_values.reshape(tp, 1)))
-            print('> Detrend CSF average signal')
-            if self.inputs.wm_nuisance:
-                X = np.hstack((X.reshape(tp, 1), wm_values.reshape(tp, 1)))
-                print('... Detrend WM average signal')
-                if self.inputs.motion_nuisance:
-                    X = np.hstack((X, move))
-                    print('... ... Detrend motion average signals')
-            elif self.inputs.motion_nuisance:
-                X = np.hstack((X.reshape(tp, 1), move))
-                print('... Detrend motion average signals')
-        elif self.inputs.wm_nuisance:
-            X = np.hstack((wm_values.reshape(tp, 1)))
-            print('> Detrend WM average signal')
+            WM = nib.load(self.inputs.wm_file).get_data().astype(np.uint32)
+            masks['WM'] = WM == 1
+
+        if self.inputs.streaming:
+            dataimg = get_uncompressed_image(ref_path)
+        try:
+            # Extract the average signals of the masks
+            if self.inputs.streaming:
+                signals = compute_average_signals_by_slabs(dataimg, masks, self.inputs.memory_budget)
+            else:
+                # Fresh copy of the data that is modified in place
+                data = np.asanyarray(dataimg.dataobj)
+                signals = {name: compute_average_signal(data, mask) for name, mask in masks.items()}
+            save_nuisance_signals(signals)
+
+            # build regressors matrix
+            regressors = []
+            for name in ['Global', 'CSF', 'WM']:
+                if name in signals:
+                    print('> Detrend %s average signal' % name)
+                    regressors.append(signals[name])
             if self.inputs.motion_nuisance:
-                print('... pre-Detrend motion average signals')
-                # print('... move shape :',move.shape)
-                # print('... X shape :',X.shape)
-                Y = X.reshape(tp, 1)
-                # print('... Y shape :',Y.shape)
-                X = np.hstack((Y, move))
-                print('... Detrend motion average signals')
-        elif self.inputs.motion_nuisance:
-            X = move
-            print('> Detrend motion average signals')
-
-        import statsmodels.api as sm
-        X = sm.add_constant(X)
-        # print('Shape X GLM')
-        # print(X.shape)
-
-        # loop throughout all GM voxels
-        for index, _ in np.ndenumerate(gm):
-            Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
-            gls_model = sm.GLS(Y, X)
-            gls_results = gls_model.fit()
-            # new_data[index[0],index[1],index[2],:] = gls_results.resid
-            new_data[index[0], index[1], index[2],
-                     :] = gls_results.resid  # + gls_results.params[8]
-
-        img = nib.Nifti1Image(
-            new_data, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath('fMRI_nuisance.nii.gz'))
+                print('> Detrend motion average signals')
+                regressors.append(create_motion_regressors(self.inputs.motion_file,
+                                                           self.inputs.nuisance_motion_nb_reg))
+            X = create_nuisance_design_matrix(tp, regressors)
+
+            # GLM: regress out nuisance covariates for all the voxels
+            if self.inputs.streaming:
+                out_data = create_memmap_nifti(self._get_out_fname(), dataimg, get_data_dtype(dataimg))
+                for slices, slab in iter_slabs(dataimg, self.inputs.memory_budget):
+                    voxel_ts, _ = get_voxel_timeseries(slab)
+                    regress_out(voxel_ts, X)
+                    out_data[:, :, slices, :] = slab
+                out_data.flush()
+                del out_data
+            else:
+                voxel_ts, _ = get_voxel_timeseries(data)
+                regress_out(voxel_ts, X)
+                img = nib.Nifti1Image(
+                    data, dataimg.get_affine(), dataimg.get_header())
+                nib.save(img, self._get_out_fname())
+        finally:
+            if self.inputs.streaming and ref_path.endswith('.gz'):
+                # remove the decompressed copy of the input
+                os.remove(dataimg.get_filename())
 
         return runtime
 
+    def _get_out_fname(self):
+        if self.inputs.streaming:
+            return os.path.abspath('fMRI_nuisance.nii')
+        return os.path.abspath('fMRI_nuisance.nii.gz')
+
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs["out_file"] = os.path.abspath("fMRI_nuisance.nii.gz")
+        outputs["out_file"] = self._get_out_fname()
         if self.inputs.global_nuisance:
             outputs["averageGlobal_npy"] = os.path.abspath('averageGlobal.npy')
             outputs["averageGlobal_mat"] = os.path.abspath('averageGlobal.mat')
@@ -308,6 +743,17 @@ class Detrending_InputSpec(BaseInterfaceInputSpec):
 
     mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
 
+    spline_knots_spacing = Int(1000, usedefault=True,
+                               desc="Number of timepoints between two interior knots "
+                                    "of the spline in cubic detrending")
+
+    streaming = Bool(False, usedefault=True,
+                     desc='If `True` process the volume by slabs under `memory_budget` '
+                          'and write an uncompressed output volume')
+
+    memory_budget = Int(2048, usedefault=True,
+                        desc='Approximate memory (in MB) used to process a slab in streaming mode')
+
 
 class Detrending_OutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Detrended fMRI volume")
@@ -335,7 +781,7 @@ class Detrending(BaseInterface):
     output_spec = Detrending_OutputSpec
 
     def _run_interface(self, runtime):
-        print("Linear detrending")
+        print("%s detrending" % self.inputs.mode.capitalize())
         print("=================")
 
         # Output from previous preprocessing step
@@ -343,69 +789,47 @@ class Detrending(BaseInterface):
 
         # Load data
         dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
-
-        # GLM: regress out nuisance covariates
-        new_data_det = data.copy()
+        tp = dataimg.shape[3]
         gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
-
-        from scipy import signal
-
-        for index, value in np.ndenumerate(gm):
-            if value == 0:
-                continue
-
-            Ydet = signal.detrend(
-                data[index[0], index[1], index[2], :].reshape(tp, 1), axis=0)
-            new_data_det[index[0], index[1], index[2], :] = Ydet[:, 0]
-
-        img = nib.Nifti1Image(
-            new_data_det, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-
-        if self.inputs.mode == 'quadratic':
-            print("Quadratic detrending")
-            print("=================")
-            from obspy.signal.detrend import polynomial
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = polynomial(
-                    new_data_det2[index[0], index[1], index[2], :], order=2)
-
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-
-        if self.inputs.mode == 'cubic':
-            print("Cubic-spline detrending")
-            print("=================")
-            from obspy.signal.detrend import spline
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = spline(
-                    new_data_det2[index[0], index[1], index[2], :], order=3)
-
+        X = create_detrending_regressors(tp, self.inputs.mode, self.inputs.spline_knots_spacing)
+
+        # Remove the trend of all the GM voxels at once
+        if self.inputs.streaming:
+            dataimg = get_uncompressed_image(ref_path)
+            try:
+                out_data = create_memmap_nifti(self._get_out_fname(), dataimg, get_data_dtype(dataimg))
+                for slices, slab in iter_slabs(dataimg, self.inputs.memory_budget):
+                    voxel_ts, order = get_voxel_timeseries(slab)
+                    regress_out(voxel_ts, X, voxels=np.flatnonzero(gm[:, :, slices].ravel(order=order)))
+                    out_data[:, :, slices, :] = slab
+                out_data.flush()
+                del out_data
+            finally:
+                if ref_path.endswith('.gz'):
+                    # remove the decompressed copy of the input
+                    os.remove(dataimg.get_filename())
+        else:
+            # Fresh copy of the data that is modified in place
+            data = np.asanyarray(dataimg.dataobj)
+            voxel_ts, order = get_voxel_timeseries(data)
+            regress_out(voxel_ts, X, voxels=np.flatnonzero(gm.ravel(order=order)))
             img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
+                data, dataimg.get_affine(), dataimg.get_header())
+            nib.save(img, self._get_out_fname())
 
         print("[ DONE ]")
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs["out_file"] = os.path.abspath("fMRI_detrending.nii.gz")
+        outputs["out_file"] = self._get_out_fname()
         return outputs
 
+    def _get_out_fname(self):
+        if self.inputs.streaming:
+            return os.path.abspath('fMRI_detrending.nii')
+        return os.path.abspath('fMRI_detrending.nii.gz')
+
 
 class Scrubbing_InputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="fMRI volume to scrubb")
@@ -455,48 +879,26 @@ class Scrubbing(BaseInterface):
     def _run_interface(self, runtime):
         print("Precompute FD and DVARS for scrubbing")
         print("=====================================")
-        import scipy.io as sio
 
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
         WMfile = self.inputs.wm_mask
         WM = nib.load(WMfile).get_data().astype(np.uint32)
         GM = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         mask = WM + GM
         move = np.genfromtxt(self.inputs.motion_parameters)
 
-        # initialize motion measures
-        FD = np.zeros((tp - 1, 1))
-        DVARS = np.zeros((tp - 1, 1))
-
-        # loop throughout all the time points
-        FD[0] = 0
-        DVARS[0] = 0
-        for i in range(1, tp - 1):
-            # FD
-            move0 = move[i - 1, :]
-            move1 = move[i, :]
-            this_move = move1 - move0
-            this_move = np.absolute(this_move)
-            FD[i] = this_move.sum()
-
-            # DVARS
-            # extract current and following time points
-            temp0 = data[:, :, :, i - 1]
-            temp1 = data[:, :, :, i]
-            temp = temp1 - temp0
-            temp = np.power(temp, 2)
-            temp = temp[mask > 0]
-            DVARS[i] = np.power(temp.mean(), 0.5)
-
-        np.save(os.path.abspath('FD.npy'), FD)
-        np.save(os.path.abspath('DVARS.npy'), DVARS)
-        sio.savemat(os.path.abspath('FD.mat'), {'FD': FD})
-        sio.savemat(os.path.abspath('DVARS.mat'), {'DVARS': DVARS})
+        # DVARS reads the series by chunks of volumes: decompress it once
+        # instead of decompressing a .nii.gz from its start for each chunk
+        dataimg = get_uncompressed_image(ref_path)
+        try:
+            FD, DVARS = compute_scrubbing_measures(dataimg, mask > 0, move)
+        finally:
+            if ref_path.endswith('.gz'):
+                # remove the decompressed copy of the input
+                os.remove(dataimg.get_filename())
+        save_scrubbing_measures(FD, DVARS)
 
         print("[ DONE ]")
         return runtime
@@ -508,3 +910,213 @@ class Scrubbing(BaseInterface):
         outputs["fd_npy"] = os.path.abspath("FD.npy")
         outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
         return outputs
+
+
+class Fused_postprocessing_InputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="Input 4D fMRI image")
+
+    gm_file = InputMultiPath(File(exists=True), mandatory=True,
+                             desc='ROI volumes registered to fMRI space')
+
+    wm_mask = File(exists=True, desc='WM mask registered to fMRI space (scrubbing)')
+
+    motion_file = File(exists=True, desc='Motion parameters from preprocessing stage')
+
+    scrubbing = Bool(False, usedefault=True, desc='If `True` compute FD and DVARS for scrubbing')
+
+    detrending = Bool(False, usedefault=True, desc='If `True` perform detrending')
+
+    detrending_mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
+
+    spline_knots_spacing = Int(1000, usedefault=True,
+                               desc="Number of timepoints between two interior knots "
+                                    "of the spline in cubic detrending")
+
+    brainfile = File(desc='Eroded brain mask registered to fMRI space')
+
+    csf_file = File(desc='Eroded CSF mask registered to fMRI space')
+
+    wm_file = File(desc='Eroded WM mask registered to fMRI space')
+
+    global_nuisance = Bool(False, usedefault=True, desc='If `True` perform global nuisance regression')
+
+    csf_nuisance = Bool(False, usedefault=True, desc='If `True` perform CSF nuisance regression')
+
+    wm_nuisance = Bool(False, usedefault=True, desc='If `True` perform WM nuisance regression')
+
+    motion_nuisance = Bool(False, usedefault=True, desc='If `True` perform motion nuisance regression')
+
+    nuisance_motion_nb_reg = Int('36', desc="Number of reg to use in motion nuisance regression")
+
+    roi_averaging = Bool(True, usedefault=True,
+                         desc='If `True` compute the average time-series of each ROI volume')
+
+    save_output = Bool(True, usedefault=True,
+                       desc='If `True` save the post-processed fMRI volume')
+
+    save_intermediates = Bool(False, usedefault=True,
+                              desc='If `True` save the detrended and nuisance regressed '
+                                   'fMRI volumes for quality control')
+
+
+class Fused_postprocessing_OutputSpec(TraitedSpec):
+    out_file = File(desc="Post-processed fMRI volume")
+
+    detrending_file = File(desc="Detrended fMRI volume (if intermediates are saved)")
+
+    nuisance_file = File(desc="Nuisance regressed fMRI volume (if intermediates are saved)")
+
+    fd_npy = File(desc="FD in .npy format")
+
+    dvars_npy = File(desc="DVARS in .npy format")
+
+    fd_mat = File(desc="FD matrix for scrubbing")
+
+    dvars_mat = File(desc="DVARS matrix for scrubbing")
+
+    avg_timeseries = OutputMultiPath(File(), desc="Average time-series of each ROI volume in `.npy` format")
+
+
+class Fused_postprocessing(BaseInterface):
+    """Run scrubbing measures, detrending, nuisance regression and ROI averaging in memory.
+
+    The 4D fMRI image is read only once and the steps of :class:`Scrubbing`,
+    :class:`Detrending` and :class:`Nuisance_regression` are applied in this order,
+    in place, on the (voxels x timepoints) matrix, before averaging the time-series
+    of each ROI volume as :class:`~cmtklib.connectome.rsfmri_conmat` does.
+    Intermediate volumes are written only if ``save_intermediates`` is True.
+    If no volume has to be saved, only the voxels of the ROIs
+    and of the nuisance masks are processed.
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import Fused_postprocessing
+    >>> postproc = Fused_postprocessing()
+    >>> postproc.inputs.base_dir = '/my_directory'
+    >>> postproc.inputs.in_file = '/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz'
+    >>> postproc.inputs.gm_file = ['/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale1_dseg.nii.gz',
+    >>>                            '/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale2_dseg.nii.gz']
+    >>> postproc.inputs.wm_mask = '/path/to/sub-01_space-meanBOLD_label-WM_dseg.nii.gz'
+    >>> postproc.inputs.motion_file = '/path/to/sub-01_motions.par'
+    >>> postproc.inputs.scrubbing = True
+    >>> postproc.inputs.detrending = True
+    >>> postproc.inputs.detrending_mode = 'linear'
+    >>> postproc.inputs.wm_file = '/path/to/sub-01_space-meanBOLD_label-WM_desc-eroded_dseg.nii.gz'
+    >>> postproc.inputs.csf_file = '/path/to/sub-01_space-meanBOLD_label-CSF_desc-eroded_dseg.nii.gz'
+    >>> postproc.inputs.csf_nuisance = True
+    >>> postproc.inputs.wm_nuisance = True
+    >>> postproc.run() # doctest: +SKIP
+    """
+
+    input_spec = Fused_postprocessing_InputSpec
+    output_spec = Fused_postprocessing_OutputSpec
+
+    def _run_interface(self, runtime):
+        print("Fused fMRI post-processing")
+        print("==========================")
+
+        dataimg = nib.load(self.inputs.in_file)
+        # Fresh copy of the data that is modified in place
+        data = np.asanyarray(dataimg.dataobj)
+        tp = data.shape[3]
+        voxel_ts, order = get_voxel_timeseries(data)
+
+        roi_data = [nib.load(roi_fname).get_data() for roi_fname in self.inputs.gm_file]
+        gm = roi_data[0].astype(np.uint32).ravel(order=order)
+
+        nuisance_masks = {}
+        if self.inputs.global_nuisance:
+            nuisance_masks['Global'] = nib.load(self.inputs.brainfile).get_data().astype(np.uint32)
+        if self.inputs.csf_nuisance:
+            nuisance_masks['CSF'] = nib.load(self.inputs.csf_file).get_data().astype(np.uint32)
+        if self.inputs.wm_nuisance:
+            nuisance_masks['WM'] = nib.load(self.inputs.wm_file).get_data().astype(np.uint32)
+        nuisance_masks = {name: mask.ravel(order=order) == 1 for name, mask in nuisance_masks.items()}
+
+        if self.inputs.scrubbing:
+            print("> Compute FD and DVARS")
+            WM = nib.load(self.inputs.wm_mask).get_data().astype(np.uint32)
+            move = np.genfromtxt(self.inputs.motion_file)
+            # computed on the input data before any modification
+            FD, DVARS = compute_scrubbing_measures(nib.Nifti1Image(data, dataimg.affine),
+                                                   (WM + roi_data[0].astype(np.uint32)) > 0, move)
+            save_scrubbing_measures(FD, DVARS)
+
+        save_volumes = self.inputs.save_output or self.inputs.save_intermediates
+        if save_volumes:
+            # all the voxels are processed in place
+            voxels = None
+            ts = voxel_ts
+        else:
+            # only the voxels of the ROIs and of the nuisance masks are processed
+            in_use = np.zeros(voxel_ts.shape[0], dtype=bool)
+            for roi in roi_data:
+                in_use |= np.asarray(roi).ravel(order=order) > 0
+            for mask in nuisance_masks.values():
+                in_use |= mask
+            voxels = np.flatnonzero(in_use)
+            ts = voxel_ts[voxels]
+            gm = gm[voxels]
+            nuisance_masks = {name: mask[voxels] for name, mask in nuisance_masks.items()}
+
+        if self.inputs.detrending:
+            print("> %s detrending" % self.inputs.detrending_mode.capitalize())
+            X = create_detrending_regressors(tp, self.inputs.detrending_mode, self.inputs.spline_knots_spacing)
+            regress_out(ts, X, voxels=np.flatnonzero(gm))
+            if self.inputs.save_intermediates:
+                nib.save(nib.Nifti1Image(data, dataimg.affine, dataimg.header),
+                         os.path.abspath('fMRI_detrending.nii.gz'))
+
+        if nuisance_masks or self.inputs.motion_nuisance:
+            print("> Nuisance regression")
+            signals = {name: compute_average_signal(ts, mask) for name, mask in nuisance_masks.items()}
+            save_nuisance_signals(signals)
+            regressors = [signals[name] for name in ['Global', 'CSF', 'WM'] if name in signals]
+            if self.inputs.motion_nuisance:
+                regressors.append(create_motion_regressors(self.inputs.motion_file,
+                                                           self.inputs.nuisance_motion_nb_reg))
+            regress_out(ts, create_nuisance_design_matrix(tp, regressors))
+            if self.inputs.save_intermediates:
+                nib.save(nib.Nifti1Image(data, dataimg.affine, dataimg.header),
+                         os.path.abspath('fMRI_nuisance.nii.gz'))
+
+        if self.inputs.save_output:
+            nib.save(nib.Nifti1Image(data, dataimg.affine, dataimg.header),
+                     os.path.abspath('fMRI_postprocessed.nii.gz'))
+
+        if self.inputs.roi_averaging:
+            print("> Compute average ROI time-series")
+            for roi_fname, roi in zip(self.inputs.gm_file, roi_data):
+                labels = np.asarray(roi).ravel(order=order)
+                if voxels is not None:
+                    labels = labels[voxels]
+                roi_ts = compute_roi_timeseries(ts, labels, int(labels.max()))
+                np.save(self._get_timeseries_fname(roi_fname), roi_ts)
+
+        print("[ DONE ]")
+        return runtime
+
+    @staticmethod
+    def _get_timeseries_fname(roi_fname):
+        base = os.path.basename(roi_fname).split('.')[0]
+        return os.path.abspath('averageTimeseries_%s.npy' % base)
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if self.inputs.save_output:
+            outputs["out_file"] = os.path.abspath("fMRI_postprocessed.nii.gz")
+        if self.inputs.save_intermediates:
+            if self.inputs.detrending:
+                outputs["detrending_file"] = os.path.abspath("fMRI_detrending.nii.gz")
+            if self.inputs.global_nuisance or self.inputs.csf_nuisance or \
+                    self.inputs.wm_nuisance or self.inputs.motion_nuisance:
+                outputs["nuisance_file"] = os.path.abspath("fMRI_nuisance.nii.gz")
+        if self.inputs.scrubbing:
+            outputs["fd_mat"] = os.path.abspath("FD.mat")
+            outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
+            outputs["fd_npy"] = os.path.abspath("FD.npy")
+            outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+        if self.inputs.roi_averaging:
+            outputs["avg_timeseries"] = [self._get_timeseries_fname(roi_fname)
+                                         for roi_fname in self.inputs.gm_file]
+        return outputs
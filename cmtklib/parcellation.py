@@ -13,7 +13,7 @@ import os.path as op
 import pkg_resources
 import subprocess
 import shutil
-import math
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import nibabel as ni
 import networkx as nx
@@ -123,13 +123,7 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                 "-------------------------------------------------------")
 
             iflogger.info("  > Load {}...".format(roi_fname))
-            roiImg = ni.load(roi_fname)
-            roiData = roiImg.get_data()
-
-            # Compute the volume of the voxel
-            voxel_dimX, voxel_dimY, voxel_dimZ = roiImg.header.get_zooms()
-            voxel_volume = voxel_dimX * voxel_dimY * voxel_dimZ
-            iflogger.info("    ... Voxel volume = {} mm3".format(roi_fname))
+            roi_stats = get_roi_stats(roi_fname)
 
             # Initialize the TSV file used to store the parcellation volumetry resulty
             volumetry_file = op.abspath('roi_stats_{}.tsv'.format(parkey))
@@ -177,9 +171,8 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                 # Get the name of the parcel
                 parcel_name = d["dn_name"]
 
-                # Compute the parcel/ROI volume
-                parcel_volumetry = np.sum(roiData == int(
-                    parcel_label)) * voxel_volume
+                # Get the parcel/ROI volume
+                _, _, parcel_volumetry = get_roi_stats_of_label(roi_stats, parcel_label)
 
                 f_volumetry.write(
                     '{:<4}, {:<55}, {:<10}, {:>10} \n'.format(parcel_label, parcel_name, parcel_type, parcel_volumetry))
@@ -490,6 +483,52 @@ class CombineParcellationsOutputSpec(TraitedSpec):
     graphML_files = OutputMultiPath(File(exists=True), desc="Parcellation node description files in `graphml` format")
 
 
+def _write_structure_entries(f_color_lut, f_graphml, header, labels, names, colors, region, fsnames, hemisphere,
+                             fs_ids):
+    """Writes a group of structures to the color LUT and `graphml` files of a parcellation.
+
+    Parameters
+    ----------
+    f_color_lut : file object
+        Color LUT file (None if not created)
+
+    f_graphml : file object
+        `graphml` file (None if not created)
+
+    header : string
+        Comment line introducing the group in the color LUT file
+
+    labels, names, colors, fsnames, fs_ids : list
+        Label, name, (R, G, B) color, `dn_fsname` and `dn_fsID` of each structure
+
+    region : string
+        Region type (``cortical`` or ``subcortical``)
+
+    hemisphere : string
+        Hemisphere (``right``, ``left`` or ``central``)
+    """
+    if f_color_lut is not None:
+        f_color_lut.write(header)
+
+    for label, name, (r, g, b), fsname, fs_id in zip(labels, names, colors, fsnames, fs_ids):
+        if f_color_lut is not None:
+            f_color_lut.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(label), name, r, g, b))
+
+        if f_graphml is not None:
+            node_lines = ['{} \n'.format('    <node id="%i">' % (int(label))),
+                          '{} \n'.format('      <data key="d0">%s</data>' % region),
+                          '{} \n'.format('      <data key="d1">%s</data>' % fsname),
+                          '{} \n'.format('      <data key="d2">%s</data>' % hemisphere),
+                          '{} \n'.format('      <data key="d3">%i</data>' % (int(label))),
+                          '{} \n'.format('      <data key="d4">%s</data>' % name),
+                          '{} \n'.format('      <data key="d5">%i</data>' % (int(fs_id))),
+                          '{} \n'.format('    </node>')]
+            f_graphml.writelines(node_lines)
+
+    if f_color_lut is not None:
+        f_color_lut.write("\n")
+
+
 class CombineParcellations(BaseInterface):
     """Creates the final parcellation.
 
@@ -524,13 +563,36 @@ class CombineParcellations(BaseInterface):
     input_spec = CombineParcellationsInputSpec
     output_spec = CombineParcellationsOutputSpec
 
-    def ismember(a, b):
-        bind = {}
-        for i, elt in enumerate(b):
-            if elt not in bind:
-                bind[elt] = i
-        # None can be replaced by any other "not in b" value
-        return [bind.get(itm, None) for itm in a]
+    def _read_cortical_annotation(self, scale, hemi):
+        """Returns the names and colors of the cortical regions of a scale for the color LUT and graphml files.
+
+        Parameters
+        ----------
+        scale : string
+            Parcellation scale (``scale1`` to ``scale5``)
+
+        hemi : string
+            Hemisphere (``lh`` or ``rh``)
+
+        Returns
+        -------
+        names : list of string
+            Region names (``ctx-<hemi>-<name>``)
+
+        colors : list of tuple
+            (R, G, B) colors of the regions, black for the first one
+        """
+        if not (self.inputs.create_colorLUT or self.inputs.create_graphml):
+            return [], []
+        annot_file = '%s.lausanne2008.%s.annot' % (hemi, scale)
+        iflogger.info("  > Load {}".format(annot_file))
+        annot = ni.freesurfer.io.read_annot(
+            op.join(self.inputs.subjects_dir, self.inputs.subject_id, 'label', annot_file))
+        names = ['ctx-{}-{}'.format(hemi, name.decode()) for name in annot[2][1:]]
+        colors = [tuple(rgb) for rgb in annot[1][1:, 0:3]]
+        if len(colors) > 0:
+            colors[0] = (0, 0, 0)
+        return names, colors
 
     def _run_interface(self, runtime):
 
@@ -728,74 +790,45 @@ class CombineParcellations(BaseInterface):
             print(proc_stdout)
 
         tmp = ni.load(third_vent_dil).get_data()
-        indrhypothal = np.where((tmp == 1) & (img_data == right_ventral))
-        indlhypothal = np.where((tmp == 1) & (img_data == left_ventral))
+        # Hypothalamus masks, labeled with the ventral DC ID as source of the relabeling
+        img_data_rhypothal = _integer_labels(np.where((tmp == 1) & (img_data == right_ventral), right_ventral, 0))
+        img_data_lhypothal = _integer_labels(np.where((tmp == 1) & (img_data == left_ventral), left_ventral, 0))
         del tmp
 
+        # The volumes of the extra structures are the same for all the scales:
+        # convert them once to integer labels and list the labels they contain
+        if thalamus_nuclei_defined:
+            img_data_thal = _integer_labels(img_data_thal)
+            present_thal = _present_labels(img_data_thal)
+        if rh_subfield_defined:
+            img_data_subrh = _integer_labels(img_data_subrh)
+            present_subrh = _present_labels(img_data_subrh)
+        if lh_subfield_defined:
+            img_data_sublh = _integer_labels(img_data_sublh)
+            present_sublh = _present_labels(img_data_sublh)
+        if brainstem_defined:
+            img_data_stem = _integer_labels(img_data_stem)
+            present_stem = _present_labels(img_data_stem)
+        present_rhypothal = _present_labels(img_data_rhypothal)
+        present_lhypothal = _present_labels(img_data_lhypothal)
+
+        extra_structures_defined = (thalamus_nuclei_defined or brainstem_defined or
+                                    (lh_subfield_defined and rh_subfield_defined))
+
         f_color_lut = None
         f_graphml = None
 
         print("create color look up table : ", self.inputs.create_colorLUT)
 
-        for roi_index, roi in enumerate(self.inputs.input_rois):
-            # colorLUT creation if enabled
-            if self.inputs.create_colorLUT:
-                outprefix_name = roi.split(".")[0]
-                outprefix_name = outprefix_name.split("/")[-1:][0]
-                color_lut_file = op.abspath(
-                    '{}_FreeSurferColorLUT.txt'.format(outprefix_name))
-                print("Create colorLUT file as %s" % color_lut_file)
-                f_color_lut = open(color_lut_file, 'w+')
-                time_now = strftime("%a, %d %b %Y %H:%M:%S", localtime())
-                hdr_lines = ['#$Id: {}_FreeSurferColorLUT.txt {} \n \n'.format(outprefix_name, time_now),
-                             '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.", "Label Name:", "R", "G", "B",
-                                                                              "A")]
-                f_color_lut.writelines(hdr_lines)
-                del hdr_lines
-
-            # Create GraphML if enabled
-            if self.inputs.create_graphml:
-                outprefix_name = roi.split(".")[0]
-                outprefix_name = outprefix_name.split("/")[-1:][0]
-                graphml_file = op.abspath('{}.graphml'.format(outprefix_name))
-                print("Create graphml_file as %s" % graphml_file)
-                f_graphml = open(graphml_file, 'w+')
-
-                hdr_lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
-                             '{} \n'.format(
-                                 '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-                                 'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />'),
-                             '{} \n'.format('  <graph edgedefault="undirected" id="">'), ]
-                f_graphml.writelines(hdr_lines)
-                del hdr_lines
-
-            # Reading Cortical Parcellation
-            img_v = ni.load(roi)
-            img_data = img_v.get_data()
-
-            # Replacing the brain stem (Stem is replaced by its own parcellation.
-            # Mismatch between both global volumes, mainly due to partial volume
-            # effect in the global stem parcellation)
-            indrep = np.where(img_data == 16)
-            img_data[indrep] = 0
-
         for roi_index, roi in sorted(enumerate(self.inputs.input_rois)):
+            outprefix_name = roi.split(".")[0]
+            outprefix_name = outprefix_name.split("/")[-1:][0]
+            for elem in outprefix_name.split("_"):
+                if "scale" in elem:
+                    scale = elem
+
             # colorLUT creation if enabled
             if self.inputs.create_colorLUT:
-                outprefix_name = roi.split(".")[0]
-                outprefix_name = outprefix_name.split("/")[-1:][0]
                 color_lut_file = op.abspath(
                     '{}_FreeSurferColorLUT.txt'.format(outprefix_name))
                 iflogger.info("  > Create colorLUT file as %s" % color_lut_file)
@@ -809,8 +842,6 @@ class CombineParcellations(BaseInterface):
 
             # Create GraphML if enabled
             if self.inputs.create_graphml:
-                outprefix_name = roi.split(".")[0]
-                outprefix_name = outprefix_name.split("/")[-1:][0]
                 graphml_file = op.abspath('{}.graphml'.format(outprefix_name))
                 iflogger.info(
                     "  > Create graphml_file as {}".format(graphml_file))
@@ -840,656 +871,164 @@ class CombineParcellations(BaseInterface):
 
             # Reading Cortical Parcellation
             img_v = ni.load(roi)
-            img_data = img_v.get_data()
-
-            # Replacing the brain stem (Stem is replaced by its own parcellation.
-            # Mismatch between both global volumes, mainly due to partial volume
-            # effect in the global stem parcellation)
-            indrep = np.where(img_data == 16)
-            img_data[indrep] = 0
-
-            # Processing Right Hemisphere
-
-            # Relabelling Right hemisphere
-            img_data_out = np.zeros(img_data.shape, dtype=np.int16)
-            ind = np.where((img_data >= 2000) & (img_data < 3000))
-            img_data_out[ind] = (img_data[ind] - 2000)
-            nlabel = img_data_out.max()
-
-            # ColorLUT (cortical)
-            if self.inputs.create_colorLUT or self.inputs.create_graphml:
-                f_color_lut.write("# Right Hemisphere. Cortical Structures \n")
-                outprefix_name = roi.split(".")[0]
-                outprefix_name = outprefix_name.split("/")[-1:][0]
-                for elem in outprefix_name.split("_"):
-                    if "scale" in elem:
-                        scale = elem
-                rh_annot_file = 'rh.lausanne2008.%s.annot' % scale
-                iflogger.info("  > Load {}".format(rh_annot_file))
-                rh_annot = ni.freesurfer.io.read_annot(
-                    op.join(self.inputs.subjects_dir, self.inputs.subject_id, 'label', rh_annot_file))
-                rgb_table = rh_annot[1][1:, 0:3]
-                roi_names = rh_annot[2][1:]
-                # roi_labels = rh_annot[0][1:]
-
-                for label, name in enumerate(roi_names):
-                    name = 'ctx-rh-{}'.format(name.decode())
-                    if self.inputs.create_colorLUT:
-                        r = rgb_table[label, 0]
-                        g = rgb_table[label, 1]
-                        b = rgb_table[label, 2]
-
-                        if label == 0:
-                            r = 0
-                            g = 0
-                            b = 0
-
-                        f_color_lut.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(
-                            label + 1, name, r, g, b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (label + 1)),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "cortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % name),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "right"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (label + 1)),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % name),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(label + 2000 + 1))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
-
-            # Relabelling Thalamic Nuclei
+            img_data = _integer_labels(img_v.get_data())
+            present = _present_labels(img_data)
+
+            rh_names, rh_colors = self._read_cortical_annotation(scale, 'rh')
+            lh_names, lh_colors = self._read_cortical_annotation(scale, 'lh')
+
+            # Table of the structures of the final parcellation, in the order of relabeling.
+            # Each structure relabels the voxels of `source` equal to `values`, and its new labels
+            # (`offsets`) and color LUT / graphml entries (`entry_offsets`) are numbered from the
+            # highest label of the final parcellation so far (`nlabel`)
+            structures = []
+
+            # Right hemisphere: cortical structures (2001-2999 -> 1-999)
+            structures.append(dict(header="# Right Hemisphere. Cortical Structures \n",
+                                   source=img_data, present=present,
+                                   values=np.arange(2001, 3000), offsets=np.arange(1, 1000),
+                                   entry_offsets=np.arange(1, len(rh_names) + 1), names=rh_names,
+                                   colors=rh_colors, region="cortical", fsnames=rh_names, hemisphere="right",
+                                   fs_ids=np.arange(len(rh_names)) + 2000 + 1, log=False))
             if thalamus_nuclei_defined:
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write(
-                        "# Right Hemisphere. Subcortical Structures (Thalamic Nuclei) \n")
-
-                new_labels = np.arange(
-                    nlabel + 1, nlabel + 1 + right_thalNuclei.shape[0])
-
-                i = 0
-                for lab in right_thalNuclei:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info(
-                            "  > Update right thalamic nucleus label ({} -> {})".format(lab, new_labels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = right_thalNuclei_colors_r[i]
-                        g = right_thalNuclei_colors_g[i]
-                        b = right_thalNuclei_colors_b[i]
-                        f_color_lut.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[i]), right_thalNuclei_names[i],
-                                                                         r, g, b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "subcortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % "thalamus"),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "right"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % (right_thalNuclei_names[i])),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(49))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                    ind = np.where(img_data_thal == lab)
-                    img_data_out[ind] = new_labels[i]
-                    i += 1
-                nlabel = img_data_out.max()
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
-
-            # Relabelling Subcortical Structures
-            if self.inputs.create_colorLUT:
-                f_color_lut.write(
-                    "# Right Hemisphere. Subcortical Structures \n")
-
-            new_labels = np.arange(nlabel + 1, nlabel + 1 + left_subc_labels.shape[0])
-
-            i = 0
-            for lab in right_subc_labels:
-                if self.inputs.verbose_level == 2:
-                    iflogger.info(
-                        "  > Update right subcortical label ({} -> {})".format(lab, new_labels[i]))
-
-                if self.inputs.create_colorLUT:
-                    r = right_subc_ids_2018_colors_r[i]
-                    g = right_subc_ids_2018_colors_g[i]
-                    b = right_subc_ids_2018_colors_b[i]
-                    f_color_lut.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[i]), right_subcort_names[i], r, g,
-                                                                     b))
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[i]))),
-                                  '{} \n'.format(
-                                      '      <data key="d0">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d1">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d2">%s</data>' % "right"),
-                                  '{} \n'.format(
-                                      '      <data key="d3">%i</data>' % (int(new_labels[i]))),
-                                  '{} \n'.format(
-                                      '      <data key="d4">%s</data>' % (right_subcort_names[i])),
-                                  '{} \n'.format(
-                                      '      <data key="d5">%i</data>' % (int(lab))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphml.writelines(node_lines)
-
-                ind = np.where(img_data == lab)
-                img_data_out[ind] = new_labels[i]
-                i += 1
-            nlabel = img_data_out.max()
-
-            if self.inputs.create_colorLUT:
-                f_color_lut.write("\n")
-
-            # Relabelling Subfields
+                structures.append(dict(header="# Right Hemisphere. Subcortical Structures (Thalamic Nuclei) \n",
+                                       source=img_data_thal, present=present_thal,
+                                       values=right_thalNuclei, names=right_thalNuclei_names,
+                                       colors=list(zip(right_thalNuclei_colors_r, right_thalNuclei_colors_g,
+                                                       right_thalNuclei_colors_b)),
+                                       region="subcortical", fsnames="thalamus", hemisphere="right",
+                                       fs_ids=[49] * right_thalNuclei.shape[0], log=True))
+            structures.append(dict(header="# Right Hemisphere. Subcortical Structures \n",
+                                   source=img_data, present=present,
+                                   values=right_subc_labels, names=right_subcort_names,
+                                   colors=list(zip(right_subc_ids_2018_colors_r, right_subc_ids_2018_colors_g,
+                                                   right_subc_ids_2018_colors_b)),
+                                   region="subcortical", fsnames="subcortical", hemisphere="right",
+                                   fs_ids=right_subc_labels, log=True))
             if rh_subfield_defined:
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write(
-                        "# Right Hemisphere. Subcortical Structures (Hippocampal Subfields) \n")
-
-                new_labels = np.arange(
-                    nlabel + 1, nlabel + 1 + hippo_subf.shape[0])
-                i = 0
-                for lab in hippo_subf:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info(
-                            "  > Update right hippo subfield label ({} -> {})".format(lab, new_labels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        # if len(ind) > 0:
-                        r = hippo_subf_colors_r[i]
-                        g = hippo_subf_colors_g[i]
-                        b = hippo_subf_colors_b[i]
-                        f_color_lut.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[i]), right_hippo_subf_names[i],
-                                                                         r, g, b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "subcortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % "hippocampus"),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "right"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % (right_hippo_subf_names[i])),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                    ind = np.where(img_data_subrh == lab)
-                    img_data_out[ind] = new_labels[i]
-                    i += 1
-                nlabel = img_data_out.max()
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
-
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
-                # Relabelling Right VentralDC
-                new_labels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info(
-                        "  > Update right ventral DC label ({} -> {})".format(right_ventral, new_labels[0]))
-                ind = np.where(img_data == right_ventral)
-                img_data_out[ind] = new_labels[0]
-                nlabel = img_data_out.max()
-
-                # ColorLUT (right ventral DC)
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write(
-                        "# Right Hemisphere. Ventral Diencephalon \n")
-                    r = right_ventral_colors_r
-                    g = right_ventral_colors_g
-                    b = right_ventral_colors_b
-                    f_color_lut.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[0]), right_ventral_names[0], r, g,
-                                                                     b))
-                    f_color_lut.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d0">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d1">%s</data>' % "ventral-diencephalon"),
-                                  '{} \n'.format(
-                                      '      <data key="d2">%s</data>' % "right"),
-                                  '{} \n'.format(
-                                      '      <data key="d3">%i</data>' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d4">%s</data>' % (right_ventral_names[0])),
-                                  '{} \n'.format(
-                                      '      <data key="d5">%i</data>' % (int(right_ventral))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphml.writelines(node_lines)
-
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
-                # Relabelling Right Hypothalamus
-                new_labels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info(
-                        "  > Update right hypothalamus label ({} -> {})".format(right_ventral, new_labels[0]))
-                img_data_out[indrhypothal] = new_labels[0]
-                nlabel = img_data_out.max()
-
-                # ColorLUT (right hypothalamus)
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("# Right Hemisphere. Hypothalamus \n")
-                    r = hypothal_colors_r
-                    g = hypothal_colors_g
-                    b = hypothal_colors_b
-                    f_color_lut.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[0]), right_hypothal_names[0], r, g,
-                                                                     b))
-                    f_color_lut.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d0">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d1">%s</data>' % "hypothalamus"),
-                                  '{} \n'.format(
-                                      '      <data key="d2">%s</data>' % "right"),
-                                  '{} \n'.format(
-                                      '      <data key="d3">%i</data>' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d4">%s</data>' % (right_hypothal_names[0])),
-                                  '{} \n'.format(
-                                      '      <data key="d5">%i</data>' % (-1)),
-                                  '{} \n'.format('    </node>')]
-                    f_graphml.writelines(node_lines)
-
-            # Processing Left Hemisphere
-            # Relabelling Left hemisphere
-            ind = np.where((img_data > 1000) & (img_data < 2000))
-            img_data_out[ind] = (img_data[ind] - 1000 + nlabel)
-            old_nlabel = nlabel
-            nlabel = img_data_out.max()
-
-            # ColorLUT (cortical)
-            if self.inputs.create_colorLUT or self.inputs.create_graphml:
-                f_color_lut.write("# Left Hemisphere. Cortical Structures \n")
-                outprefix_name = roi.split(".")[0]
-                outprefix_name = outprefix_name.split("/")[-1:][0]
-                for elem in outprefix_name.split("_"):
-                    if "scale" in elem:
-                        scale = elem
-                lh_annot_file = 'lh.lausanne2008.%s.annot' % scale
-                iflogger.info("  > Load {}".format(lh_annot_file))
-                lh_annot = ni.freesurfer.io.read_annot(
-                    op.join(self.inputs.subjects_dir, self.inputs.subject_id, 'label', lh_annot_file))
-                rgb_table = lh_annot[1][1:, 0:3]
-                roi_names = lh_annot[2][1:]
-
-                for label, name in enumerate(roi_names):
-                    name = 'ctx-lh-{}'.format(name.decode())
-
-                    if self.inputs.create_colorLUT:
-                        r = rgb_table[label, 0]
-                        g = rgb_table[label, 1]
-                        b = rgb_table[label, 2]
-
-                        if label == 0:
-                            r = 0
-                            g = 0
-                            b = 0
-
-                        f_color_lut.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(label + old_nlabel + 1), name, r, g, b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(label + old_nlabel + 1))),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "cortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % name),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "left"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (int(label + old_nlabel + 1))),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % name),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(label + 1000 - old_nlabel))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
-
-            # Relabelling Thalamic Nuclei
+                structures.append(dict(header="# Right Hemisphere. Subcortical Structures (Hippocampal Subfields) \n",
+                                       source=img_data_subrh, present=present_subrh,
+                                       values=hippo_subf, names=right_hippo_subf_names,
+                                       colors=list(zip(hippo_subf_colors_r, hippo_subf_colors_g,
+                                                       hippo_subf_colors_b)),
+                                       region="subcortical", fsnames="hippocampus", hemisphere="right",
+                                       fs_ids=hippo_subf, log=True))
+            if extra_structures_defined:
+                structures.append(dict(header="# Right Hemisphere. Ventral Diencephalon \n",
+                                       source=img_data, present=present,
+                                       values=[right_ventral], names=right_ventral_names,
+                                       colors=[(right_ventral_colors_r, right_ventral_colors_g,
+                                                right_ventral_colors_b)],
+                                       region="subcortical", fsnames="ventral-diencephalon", hemisphere="right",
+                                       fs_ids=[right_ventral], log=True))
+                structures.append(dict(header="# Right Hemisphere. Hypothalamus \n",
+                                       source=img_data_rhypothal, present=present_rhypothal,
+                                       values=[right_ventral], names=right_hypothal_names,
+                                       colors=[(hypothal_colors_r, hypothal_colors_g, hypothal_colors_b)],
+                                       region="subcortical", fsnames="hypothalamus", hemisphere="right",
+                                       fs_ids=[-1], log=True))
+
+            # Left hemisphere: cortical structures (1001-1999 -> nlabel + 1-999)
+            structures.append(dict(header="# Left Hemisphere. Cortical Structures \n",
+                                   source=img_data, present=present,
+                                   values=np.arange(1001, 2000), offsets=np.arange(1, 1000),
+                                   entry_offsets=np.arange(1, len(lh_names) + 1), names=lh_names,
+                                   colors=lh_colors, region="cortical", fsnames=lh_names, hemisphere="left",
+                                   # dn_fsID of the left cortical regions is shifted by nlabel
+                                   fs_ids=np.arange(len(lh_names)) + 1000, fs_ids_minus_nlabel=True,
+                                   log=False))
             if thalamus_nuclei_defined:
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write(
-                        "# Left Hemisphere. Subcortical Structures (Thalamic Nuclei) \n")
-
-                new_labels = np.arange(
-                    nlabel + 1, nlabel + 1 + left_thalNuclei.shape[0])
-                i = 0
-                for lab in left_thalNuclei:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info(
-                            "  > Update left thalamic nucleus label ({} -> {})".format(lab, new_labels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = left_thalNuclei_colors_r[i]
-                        g = left_thalNuclei_colors_g[i]
-                        b = left_thalNuclei_colors_b[i]
-                        f_color_lut.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[i]), left_thalNuclei_names[i], r,
-                                                                         g, b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "subcortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % "thalamus"),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "left"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % (left_thalNuclei_names[i])),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(10))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                    ind = np.where(img_data_thal == lab)
-                    img_data_out[ind] = new_labels[i]
-                    i += 1
-                nlabel = img_data_out.max()
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
-
-            # Relabelling Subcortical Structures
-            if self.inputs.create_colorLUT:
-                f_color_lut.write(
-                    "# Left Hemisphere. Subcortical Structures \n")
-
-            new_labels = np.arange(nlabel + 1, nlabel + 1 + left_subc_labels.shape[0])
-
-            i = 0
-            for lab in left_subc_labels:
-                if self.inputs.verbose_level == 2:
-                    iflogger.info(
-                        "  > Update left subcortical label ({} -> {})".format(lab, new_labels[i]))
-
-                if self.inputs.create_colorLUT:
-                    r = left_subc_ids_2018_colors_r[i]
-                    g = left_subc_ids_2018_colors_g[i]
-                    b = left_subc_ids_2018_colors_b[i]
-                    f_color_lut.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[i]), left_subcort_names[i], r, g, b))
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[i]))),
-                                  '{} \n'.format(
-                                      '      <data key="d0">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d1">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d2">%s</data>' % "left"),
-                                  '{} \n'.format(
-                                      '      <data key="d3">%i</data>' % (int(new_labels[i]))),
-                                  '{} \n'.format(
-                                      '      <data key="d4">%s</data>' % (left_subcort_names[i])),
-                                  '{} \n'.format(
-                                      '      <data key="d5">%i</data>' % (int(lab))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphml.writelines(node_lines)
-
-                ind = np.where(img_data == lab)
-                img_data_out[ind] = new_labels[i]
-                i += 1
-            nlabel = img_data_out.max()
-
-            if self.inputs.create_colorLUT:
-                f_color_lut.write("\n")
-
-            # Relabelling Subfields
+                structures.append(dict(header="# Left Hemisphere. Subcortical Structures (Thalamic Nuclei) \n",
+                                       source=img_data_thal, present=present_thal,
+                                       values=left_thalNuclei, names=left_thalNuclei_names,
+                                       colors=list(zip(left_thalNuclei_colors_r, left_thalNuclei_colors_g,
+                                                       left_thalNuclei_colors_b)),
+                                       region="subcortical", fsnames="thalamus", hemisphere="left",
+                                       fs_ids=[10] * left_thalNuclei.shape[0], log=True))
+            structures.append(dict(header="# Left Hemisphere. Subcortical Structures \n",
+                                   source=img_data, present=present,
+                                   values=left_subc_labels, names=left_subcort_names,
+                                   colors=list(zip(left_subc_ids_2018_colors_r, left_subc_ids_2018_colors_g,
+                                                   left_subc_ids_2018_colors_b)),
+                                   region="subcortical", fsnames="subcortical", hemisphere="left",
+                                   fs_ids=left_subc_labels, log=True))
             if lh_subfield_defined:
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write(
-                        "# Left Hemisphere. Subcortical Structures (Hippocampal Subfields) \n")
-
-                new_labels = np.arange(
-                    nlabel + 1, nlabel + 1 + hippo_subf.shape[0])
-                i = 0
-                for lab in hippo_subf:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info(
-                            "  > Update left hippo subfield label ({} -> {})".format(lab, new_labels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = hippo_subf_colors_r[i]
-                        g = hippo_subf_colors_g[i]
-                        b = hippo_subf_colors_b[i]
-                        f_color_lut.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[i]), left_hippo_subf_names[i], r,
-                                                                         g, b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "subcortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % "hippocampus"),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "left"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % (left_hippo_subf_names[i])),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                    ind = np.where(img_data_sublh == lab)
-                    img_data_out[ind] = new_labels[i]
-                    i += 1
-                nlabel = img_data_out.max()
-                # newIds_LH_subFields = new_labels
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
-
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
-                # Relabelling Left VentralDC
-                new_labels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info(
-                        "  > Update left ventral DC label ({} -> {})".format(left_ventral, new_labels[0]))
-                ind = np.where(img_data == left_ventral)
-                img_data_out[ind] = new_labels[0]
-                nlabel = img_data_out.max()
-                # newIds_LH_ventralDC = new_labels
-
-                # ColorLUT (left ventral DC)
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write(
-                        "# Left Hemisphere. Ventral Diencephalon \n")
-                    r = left_ventral_colors_r
-                    g = left_ventral_colors_g
-                    b = left_ventral_colors_b
-                    f_color_lut.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[0]), left_ventral_names[0], r, g, b))
-                    f_color_lut.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d0">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d1">%s</data>' % "ventral-diencephalon"),
-                                  '{} \n'.format(
-                                      '      <data key="d2">%s</data>' % "left"),
-                                  '{} \n'.format(
-                                      '      <data key="d3">%i</data>' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d4">%s</data>' % (left_ventral_names[0])),
-                                  '{} \n'.format(
-                                      '      <data key="d5">%i</data>' % (int(left_ventral))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphml.writelines(node_lines)
-
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
-                # Relabelling Left Hypothalamus
-                new_labels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info(
-                        "  > Update left hypothalamus label ({} -> {})".format(-1, new_labels[0]))
-                img_data_out[indlhypothal] = new_labels[0]
-                nlabel = img_data_out.max()
-
-                # ColorLUT (right hypothalamus)
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("# Left Hemisphere. Hypothalamus \n")
-                    r = hypothal_colors_r
-                    g = hypothal_colors_g
-                    b = hypothal_colors_b
-                    f_color_lut.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[0]), left_hypothal_names[0], r, g,
-                                                                     b))
-                    f_color_lut.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d0">%s</data>' % "subcortical"),
-                                  '{} \n'.format(
-                                      '      <data key="d1">%s</data>' % "hypothalamus"),
-                                  '{} \n'.format(
-                                      '      <data key="d2">%s</data>' % "left"),
-                                  '{} \n'.format(
-                                      '      <data key="d3">%i</data>' % (int(new_labels[0]))),
-                                  '{} \n'.format(
-                                      '      <data key="d4">%s</data>' % (left_hypothal_names[0])),
-                                  '{} \n'.format(
-                                      '      <data key="d5">%i</data>' % (-1)),
-                                  '{} \n'.format('    </node>')]
-                    f_graphml.writelines(node_lines)
-
-            # Relabelling Brain Stem
+                structures.append(dict(header="# Left Hemisphere. Subcortical Structures (Hippocampal Subfields) \n",
+                                       source=img_data_sublh, present=present_sublh,
+                                       values=hippo_subf, names=left_hippo_subf_names,
+                                       colors=list(zip(hippo_subf_colors_r, hippo_subf_colors_g,
+                                                       hippo_subf_colors_b)),
+                                       region="subcortical", fsnames="hippocampus", hemisphere="left",
+                                       fs_ids=hippo_subf, log=True))
+            if extra_structures_defined:
+                structures.append(dict(header="# Left Hemisphere. Ventral Diencephalon \n",
+                                       source=img_data, present=present,
+                                       values=[left_ventral], names=left_ventral_names,
+                                       colors=[(left_ventral_colors_r, left_ventral_colors_g,
+                                                left_ventral_colors_b)],
+                                       region="subcortical", fsnames="ventral-diencephalon", hemisphere="left",
+                                       fs_ids=[left_ventral], log=True))
+                structures.append(dict(header="# Left Hemisphere. Hypothalamus \n",
+                                       source=img_data_lhypothal, present=present_lhypothal,
+                                       values=[left_ventral], names=left_hypothal_names,
+                                       colors=[(hypothal_colors_r, hypothal_colors_g, hypothal_colors_b)],
+                                       region="subcortical", fsnames="hypothalamus", hemisphere="left",
+                                       fs_ids=[-1], log=True))
+
+            # Brain stem: replaced by its own parcellation if any (mismatch between both
+            # global volumes, mainly due to partial volume effect in the global stem parcellation)
             if brainstem_defined:
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("# Brain Stem Structures \n")
-
-                new_labels = np.arange(
-                    nlabel + 1, nlabel + 1 + brainstem.shape[0])
-                i = 0
-                for lab in brainstem:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info(
-                            "  > Update brainstem parcellation label ({} -> {})".format(lab, new_labels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = brainstem_colors_r[i]
-                        g = brainstem_colors_g[i]
-                        b = brainstem_colors_b[i]
-                        f_color_lut.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[i]), brainstem_names[i], r, g,
-                                                                         b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "subcortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % "brainstem"),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "central"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (int(new_labels[i]))),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % (brainstem_names[i])),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                    ind = np.where(img_data_stem == lab)
-                    img_data_out[ind] = new_labels[i]
-                    i += 1
-                # nlabel = img_data_out.max()
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
+                structures.append(dict(header="# Brain Stem Structures \n",
+                                       source=img_data_stem, present=present_stem,
+                                       values=brainstem, names=brainstem_names,
+                                       colors=list(zip(brainstem_colors_r, brainstem_colors_g,
+                                                       brainstem_colors_b)),
+                                       region="subcortical", fsnames="brainstem", hemisphere="central",
+                                       fs_ids=brainstem, log=True))
             else:
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("# Brain Stem \n")
-
-                new_labels = np.arange(nlabel + 1, nlabel + 2)
-                img_data_out[indrep] = new_labels[0]
-
-                if self.inputs.verbose_level == 2:
-                    iflogger.info(
-                        "  > Update brainstem parcellation label ({} -> {})".format(lab, new_labels[0]))
-
-                if self.inputs.create_colorLUT:
-                    r = 119
-                    g = 159
-                    b = 176
-                    f_color_lut.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(new_labels[0]), 'brainstem', r, g, b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(new_labels[0]))),
-                                      '{} \n'.format(
-                                          '      <data key="d0">%s</data>' % "subcortical"),
-                                      '{} \n'.format(
-                                          '      <data key="d1">%s</data>' % "brainstem"),
-                                      '{} \n'.format(
-                                          '      <data key="d2">%s</data>' % "central"),
-                                      '{} \n'.format(
-                                          '      <data key="d3">%i</data>' % (int(new_labels[0]))),
-                                      '{} \n'.format(
-                                          '      <data key="d4">%s</data>' % "brainstem"),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphml.writelines(node_lines)
-
-                # nlabel = img_data_out.max()
-
-                if self.inputs.create_colorLUT:
-                    f_color_lut.write("\n")
+                # dn_fsID is the FreeSurfer ID of the last left subcortical structure
+                structures.append(dict(header="# Brain Stem \n",
+                                       source=img_data, present=present,
+                                       values=[16], names=["brainstem"], colors=[(119, 159, 176)],
+                                       region="subcortical", fsnames="brainstem", hemisphere="central",
+                                       fs_ids=[hippo_subf[-1] if lh_subfield_defined else left_subc_labels[-1]],
+                                       log=True))
+
+            # Relabel all the structures with one lookup table per source volume
+            layers = []
+            nlabel = 0
+            for structure in structures:
+                values = np.asarray(structure['values'])
+                labels = nlabel + structure.get('offsets', np.arange(1, values.shape[0] + 1))
+                entry_labels = nlabel + structure.get('entry_offsets', np.arange(1, values.shape[0] + 1))
+                fs_ids = np.asarray(structure['fs_ids'])
+                if structure.get('fs_ids_minus_nlabel', False):
+                    fs_ids = fs_ids - nlabel
+
+                if self.inputs.verbose_level == 2 and structure['log']:
+                    for value, label, name in zip(values, labels, structure['names']):
+                        iflogger.info("  > Update {} label ({} -> {})".format(name, value, label))
+
+                fsnames = structure['fsnames']
+                if isinstance(fsnames, str):
+                    fsnames = [fsnames] * len(structure['names'])
+                _write_structure_entries(f_color_lut, f_graphml, structure['header'],
+                                         entry_labels, structure['names'], structure['colors'],
+                                         structure['region'], fsnames, structure['hemisphere'], fs_ids)
+
+                layers.append((structure['source'], values, labels))
+                # Highest label of the final parcellation, i.e. the highest new label of the
+                # structure among the ones present in the source volume (if any)
+                present_labels = labels[np.isin(values, structure['present'])]
+                if present_labels.shape[0] > 0:
+                    nlabel = present_labels.max()
+
+            img_data_out = relabel_volume(img_data.shape, layers, dtype=np.int16)
 
             # Fix negative values
             img_data_out[img_data_out < 0] = 0
 
             # Saving the new parcellation
-            outprefix_name = roi.split(".")[0]
-            outprefix_name = outprefix_name.split("/")[-1:][0]
             output_roi = op.abspath('{}_final.nii.gz'.format(outprefix_name))
             hdr = img_v.get_header()
             hdr2 = hdr.copy()
@@ -1535,7 +1074,7 @@ class CombineParcellations(BaseInterface):
         img_data_aparcaseg = img_aparcaseg.get_data()
 
         # Refine aparc+aseg.mgz with new subcortical and/or structures (if any)
-        if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
+        if extra_structures_defined:
             iflogger.info(
                 "  > Correct and save Freesurfer-generated aparc+aseg.mgz in native space...")
 
@@ -1544,28 +1083,17 @@ class CombineParcellations(BaseInterface):
             # Thalamus (aparc+aseg labels: 10 and 49)
             if thalamus_nuclei_defined:
 
-                ind = np.where(img_data_aparcaseg == 10)
-                mask_aparc_lh = np.zeros(img_data_aparcaseg.shape)
-                mask_aparc_lh[ind] = 1
+                mask_aparc_lh = (img_data_aparcaseg == 10).astype(np.float64)
+                mask_aparc_rh = (img_data_aparcaseg == 49).astype(np.float64)
 
-                ind = np.where(img_data_aparcaseg == 49)
-                mask_aparc_rh = np.zeros(img_data_aparcaseg.shape)
-                mask_aparc_rh[ind] = 1
-
-                mask_thal_lh = np.zeros(img_data_aparcaseg.shape)
-                for lab in left_thalNuclei:
-                    ind = np.where(img_data_thal == lab)
-                    mask_thal_lh[ind] = 1
+                mask_thal_lh = np.isin(img_data_thal, left_thalNuclei).astype(np.float64)
 
                 # Identify voxels not included by thalamic Nuclei - should set to 2 (Gm) or 0
                 tmp = mask_aparc_lh - mask_thal_lh
-                ind = np.where(tmp > 0)
-                img_data_aparcaseg_new[ind] = 2
+                img_data_aparcaseg_new[tmp > 0] = 2
 
                 # Identify voxels not included by freesurfer thalamic mask
-                tmp = mask_aparc_lh - mask_thal_lh
-                ind = np.where(tmp < 0)
-                img_data_aparcaseg_new[ind] = 10
+                img_data_aparcaseg_new[tmp < 0] = 10
 
                 out_tmp = op.join(fs_dir, 'tmp', 'aparc-thal.lh.native.nii.gz')
                 iflogger.info("    ... Save tmp image to {}".format(out_tmp))
@@ -1573,20 +1101,14 @@ class CombineParcellations(BaseInterface):
                     tmp, img_aparcaseg.get_affine(), img_aparcaseg.get_header())
                 ni.save(img_tmp, out_tmp)
 
-                mask_thal_rh = np.zeros(img_data_aparcaseg.shape)
-                for lab in right_thalNuclei:
-                    ind = np.where(img_data_thal == lab)
-                    mask_thal_rh[ind] = 1
+                mask_thal_rh = np.isin(img_data_thal, right_thalNuclei).astype(np.float64)
 
                 # Identify voxels not included by thalamic Nuclei - should set to 41 (Gm) or 0
                 tmp = mask_aparc_rh - mask_thal_rh
-                ind = np.where(tmp > 0)
-                img_data_aparcaseg_new[ind] = 41
+                img_data_aparcaseg_new[tmp > 0] = 41
 
                 # Identify voxels not included by freesurfer thalamic mask
-                tmp = mask_aparc_rh - mask_thal_rh
-                ind = np.where(tmp < 0)
-                img_data_aparcaseg_new[ind] = 49
+                img_data_aparcaseg_new[tmp < 0] = 49
 
                 out_tmp = op.join(fs_dir, 'tmp', 'aparc-thal.rh.native.nii.gz')
                 iflogger.info("    ... Save tmp image to {}".format(out_tmp))
@@ -1804,41 +1326,45 @@ class ParcellateThalamus(BaseInterface):
         # Load jacobian file
         img_data_jacob = ni.load(jacobian_file).get_data()  # numpy.ndarray
 
-        # Load probability maps in native space after applying estimated transform and deformation
+        # Load probability maps in native space after applying estimated transform and deformation.
+        # The 4D maps are only loaded once: they are clipped in place, then processed nucleus
+        # by nucleus or in the bounding box of the voxels of interest, without full 4D copies
         img_spams = ni.load(output_maps)
         img_data_vspams = img_spams.get_data()  # numpy.ndarray
-        img_data_vspams[img_data_vspams < 0] = 0
-        img_data_vspams[img_data_vspams > 1] = 1
+        np.clip(img_data_vspams, 0, 1, out=img_data_vspams)
 
         thresh = 0.05
+        nb_spams = img_data_vspams.shape[3]
+
         # Creating max_prob
-        img_data_spams = img_data_vspams.copy()
-        img_data_spams[img_data_spams < thresh] = 0
-        ind = np.where(np.sum(img_data_spams, axis=3) == 0)
-        max_prob = img_data_spams.argmax(axis=3) + 1
-        max_prob[ind] = 0
+        support = np.zeros(img_data_vspams.shape[:3], dtype=bool)
+        for nuc in np.arange(nb_spams):
+            support |= img_data_vspams[:, :, :, nuc] >= thresh
+        max_prob = _max_probability_labels(img_data_vspams, support)
         # ?max_prob = imfill(max_prob,'holes');
 
-        del img_data_spams
-
         debug_file = op.abspath('{}_class-thalamus_dtissue_after_ants.nii.gz'.format(outprefix_name))
         print("Save output image to %s" % debug_file)
         img = ni.Nifti1Image(max_prob, img_atlas.get_affine(), hdr2)
         ni.save(img, debug_file)
 
         # Take into account jacobian to correct the probability maps after interpolation
-        img_data_spams = np.zeros(img_data_vspams.shape)
-        for nuc in np.arange(img_data_vspams.shape[3]):
-            temp_image = img_data_vspams[:, :, :, nuc]
-            t = np.multiply(temp_image, img_data_jacob)
-            img_data_spams[:, :, :, nuc] = t / t.max()
-        del temp_image, t, img_data_vspams, img_data_jacob
+        # (each corrected map is normalized by its maximum over the whole volume)
+        jacob_max = []
+        support[:] = False
+        for nuc in np.arange(nb_spams):
+            t = np.multiply(img_data_vspams[:, :, :, nuc], img_data_jacob)
+            jacob_max.append(t.max())
+            support |= t / jacob_max[nuc] >= thresh
+        del t
 
         # Creating max_prob
-        img_data_spams[img_data_spams < thresh] = 0
-        ind = np.where(np.sum(img_data_spams, axis=3) == 0)
-        max_prob = img_data_spams.argmax(axis=3) + 1
-        max_prob[ind] = 0
+        bbox = _bounding_box(support)
+        max_prob = np.zeros(support.shape, dtype=np.int64)
+        if bbox is not None:
+            max_prob[bbox] = _max_probability_labels(
+                _jacobian_corrected_maps(img_data_vspams, img_data_jacob, jacob_max, bbox, thresh), support[bbox])
+        del support
         # ?max_prob = imfill(max_prob,'holes');
 
         debug_file = op.abspath('{}_class-thalamus_dtissue_after_jacobiancorr.nii.gz'.format(outprefix_name))
@@ -1851,7 +1377,11 @@ class ParcellateThalamus(BaseInterface):
         # fs_string = 'export SUBJECTS_DIR=' + self.inputs.subjects_dir
         iflogger.info('- New FreeSurfer SUBJECTS_DIR:\n  {}\n'.format(self.inputs.subjects_dir))
 
-        # Extract indices of left/right thalamus mask from aparc+aseg volume
+        # Extract indices of left/right thalamus mask from aparc+aseg volume, in the bounding box of the thalamus
+        bbox = _bounding_box((img_data_atlas == 10) | (img_data_atlas == 49))
+        if bbox is None:
+            bbox = (slice(None), slice(None), slice(None))
+        img_data_atlas = img_data_atlas[bbox]
         indl = np.where(img_data_atlas == 10)
         indr = np.where(img_data_atlas == 49)
 
@@ -1894,11 +1424,11 @@ class ParcellateThalamus(BaseInterface):
             del struct, temp_i
 
         # Creating Thalamic Mask (1: Left, 2:Right)
-        img_data_thal = np.zeros(img_data_atlas.shape)
-        img_data_thal[indl] = 1
-        img_data_thal[indr] = 2
+        img_data_thal = np.zeros(img_atlas.shape[:3])
+        img_data_thal[bbox][indl] = 1
+        img_data_thal[bbox][indr] = 2
 
-        del indl, indr
+        del indl, indr, img_data_atlas
 
         # TODO: Masking according to csf
         # unzip_nifti([freesDir filesep subjId filesep 'tmp' filesep 'T1native.nii.gz']);
@@ -1922,77 +1452,49 @@ class ParcellateThalamus(BaseInterface):
 
         del hdr, hdr2, img_thal
 
-        nb_spams = img_data_spams.shape[3]
-        thresh = 0.05
+        # Mask the corrected probability maps of the left (resp. right) nuclei using the left
+        # (resp. right) thalamus mask, in the bounding box of the thalamus
+        half_spams = int(nb_spams / 2)
+        img_data_spams = _jacobian_corrected_maps(img_data_vspams, img_data_jacob, jacob_max, bbox, thresh)
+        img_data_spams[img_data_thal[bbox] != 1, 0:half_spams] = 0
+        img_data_spams[img_data_thal[bbox] != 2, half_spams:nb_spams] = 0
 
-        use_thalamus_mask = True
-        if use_thalamus_mask:
-            img_data_thal_lh = np.zeros(img_data_thal.shape)
-            indl = np.where(img_data_thal == 1)
-            img_data_thal_lh[indl] = 1
-            del indl
-
-            img_data_thal_rh = np.zeros(img_data_thal.shape)
-            indr = np.where(img_data_thal == 2)
-            img_data_thal_rh[indr] = 1
-
-            del img_data_thal
-
-            # Mask probability maps using the left-hemisphere thalamus mask
-            tmp_thal_lh = np.zeros(
-                (img_data_thal_lh.shape[0], img_data_thal_lh.shape[1], img_data_thal_lh.shape[2], 1))
-            tmp_thal_lh[:, :, :, 0] = img_data_thal_lh
-            temp_m = np.repeat(tmp_thal_lh, int(nb_spams / 2), axis=3)
-            del tmp_thal_lh
-            img_data_spam_lh = np.multiply(img_data_spams[:, :, :, 0:int(nb_spams / 2)], temp_m)
-            # print('img_data_spam_lh shape:', img_data_spam_lh.shape)
-            del temp_m
-
-            # Creating max_prob
-            img_data_spam_lh[img_data_spam_lh < thresh] = 0
-            ind = np.where(np.sum(img_data_spam_lh, axis=3) == 0)
-            # max_prob_l = img_data_spam_lh.max(axis=3)
-            max_prob_l = np.argmax(img_data_spam_lh, axis=3) + 1
-            max_prob_l[ind] = 0
-            # max_prob_l[ind] = 0
-            # ?max_prob_l = ndimage.binary_fill_holes(max_prob_l)
-            # ?max_prob_l = Atlas_Corr(img_data_thal_lh,max_prob_l)
-
-            # Mask probability maps using the right-hemisphere thalamus mask
-            tmp_thal_rh = np.zeros(
-                (img_data_thal_rh.shape[0], img_data_thal_rh.shape[1], img_data_thal_rh.shape[2], 1))
-            tmp_thal_rh[:, :, :, 0] = img_data_thal_rh
-            temp_m = np.repeat(tmp_thal_rh, int(nb_spams / 2), axis=3)
-            del tmp_thal_rh
-            img_data_spam_rh = np.multiply(img_data_spams[:, :, :, int(nb_spams / 2):int(nb_spams)], temp_m)
-            # print('img_data_spam_rh shape:', img_data_spam_rh.shape)
-            del temp_m
-
-            # Creating max_prob
-            img_data_spam_rh[img_data_spam_rh < thresh] = 0
-            ind = np.where(np.sum(img_data_spam_rh, axis=3) == 0)
-            # max_prob_r = img_data_spam_rh.max(axis=3)
-            max_prob_r = np.argmax(img_data_spam_rh, axis=3) + 1
-            # ?max_prob_r = imfill(max_prob_r,'holes');
-            # ?max_prob_r = Atlas_Corr(img_data_thal_rh,max_prob_r);
-            max_prob_r[indr] = max_prob_r[indr] + int(nb_spams / 2)
-            max_prob_r[ind] = 0
-
-            del indr
-
-            img_data_spams[:, :, :, 0:int(nb_spams / 2)] = img_data_spam_lh
-            img_data_spams[:, :, :, int(nb_spams / 2):nb_spams] = img_data_spam_rh
-
-        # Save corrected probability maps of thalamic nuclei
+        # Creating max_prob
+        max_prob_l = _max_probability_labels(img_data_spams[:, :, :, 0:half_spams],
+                                             img_data_spams[:, :, :, 0:half_spams].max(axis=3) > 0)
+        # ?max_prob_l = ndimage.binary_fill_holes(max_prob_l)
+        # ?max_prob_l = Atlas_Corr(img_data_thal_lh,max_prob_l)
+        max_prob_r = _max_probability_labels(img_data_spams[:, :, :, half_spams:nb_spams],
+                                             img_data_spams[:, :, :, half_spams:nb_spams].max(axis=3) > 0)
+        # ?max_prob_r = imfill(max_prob_r,'holes');
+        # ?max_prob_r = Atlas_Corr(img_data_thal_rh,max_prob_r);
+        max_prob_r[max_prob_r > 0] += half_spams
+
+        max_prob = np.zeros(img_data_thal.shape, dtype=np.int64)
+        max_prob[bbox] = max_prob_l + max_prob_r
+        del max_prob_l, max_prob_r
+
+        del img_data_thal, img_data_jacob
+
+        # Save corrected probability maps of thalamic nuclei, null outside the thalamus
         # update the header
         hdr = img_spams.get_header()
         hdr2 = hdr.copy()
         hdr2.set_data_dtype(np.uint16)
+        affine = img_spams.get_affine()
+        spams_shape = img_data_vspams.shape
+
+        # The loaded maps (cached by the image) are released before allocating the output volume
+        del img_spams, img_data_vspams
+        img_data_spams_out = np.zeros(spams_shape)
+        img_data_spams_out[bbox] = img_data_spams
+        del img_data_spams
+
         print("Save output image to %s" % output_maps)
-        img = ni.Nifti1Image(img_data_spams, img_spams.get_affine(), hdr2)
+        img = ni.Nifti1Image(img_data_spams_out, affine, hdr2)
         ni.save(img, output_maps)
 
-        del hdr, img, img_spams
+        del hdr, img, img_data_spams_out
 
         # Save Maxprob
         # update the header
@@ -2001,18 +1503,6 @@ class ParcellateThalamus(BaseInterface):
         hdr2 = hdr.copy()
         hdr2.set_data_dtype(np.uint16)
 
-        if use_thalamus_mask:
-            max_prob = max_prob_l + max_prob_r
-        else:
-            # Creating max_prob
-            img_data_spams[img_data_spams < thresh] = 0
-            ind = np.where(np.sum(img_data_spams, axis=3) == 0)
-            max_prob = img_data_spams.argmax(axis=3) + 1
-            max_prob[ind] = 0
-            # ?max_prob = imfill(max_prob,'holes');
-
-        del img_data_spams
-
         # debug_file = '/home/localadmin/~/Desktop/parcellation_tests/sub-A006_ses-20160520161029_T1w_brain_class-thalamus_maxprobL.nii.gz'
         # print("Save output image to %s" % debug_file)
         # img = ni.Nifti1Image(max_prob_l, img_atlas.get_affine(), hdr2)
@@ -2065,6 +1555,10 @@ class ParcellateInputSpec(BaseInterfaceInputSpec):
 
     erode_masks = traits.Bool(False, desc="If `True` erode the masks")
 
+    number_of_threads = traits.Int(1, usedefault=True,
+                                   desc="Number of FreeSurfer commands run concurrently "
+                                        "to generate the Lausanne2018 scales")
+
 
 class ParcellateOutputSpec(TraitedSpec):
     # roi_files = OutputMultiPath(File(exists=True),desc='Region of Interest files for connectivity mapping')
@@ -2148,7 +1642,8 @@ class Parcellate(BaseInterface):
             create_T1_and_Brain(self.inputs.subject_id,
                                 self.inputs.subjects_dir)
             # create_annot_label(self.inputs.subject_id, self.inputs.subjects_dir)
-            create_roi_v2(self.inputs.subject_id, self.inputs.subjects_dir)
+            create_roi_v2(self.inputs.subject_id, self.inputs.subjects_dir,
+                          n_procs=self.inputs.number_of_threads)
             create_wm_mask_v2(self.inputs.subject_id, self.inputs.subjects_dir)
             if self.inputs.erode_masks:
                 erode_mask(fsdir, op.join(fsdir, 'mri', 'fsmask_1mm.nii.gz'))
@@ -2368,6 +1863,267 @@ def get_parcellation(parcel="NativeFreesurfer"):
                 }
 
 
+def compute_roi_stats(roi_data, zooms):
+    """Computes the centroid and the volume of all the ROIs of a parcellation in one pass.
+
+    Parameters
+    ----------
+    roi_data : numpy.array
+        Parcellation volume where each ROI is labeled by a positive integer
+
+    zooms : tuple
+        Voxel size of the parcellation volume
+
+    Returns
+    -------
+    roi_stats : dict
+        Dictionary of arrays indexed by label with the `voxel_count`,
+        the `volume_mm3` and the `centroid` (mean voxel coordinates) of each ROI.
+        Labels without any voxel have a null volume and a NaN centroid.
+    """
+    roi_data = np.asarray(roi_data)
+    labels = roi_data.astype(np.int64).ravel()
+    # Discard the background and the voxels whose value is not an integer label
+    labeled = labels > 0
+    if not np.issubdtype(roi_data.dtype, np.integer):
+        labeled &= labels == roi_data.ravel()
+    idx = np.flatnonzero(labeled)
+    labels = labels[idx]
+
+    n_labels = int(labels.max()) + 1 if len(labels) > 0 else 1
+    voxel_count = np.bincount(labels, minlength=n_labels)
+    centroid = np.zeros((n_labels, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for axis, coords in enumerate(np.unravel_index(idx, roi_data.shape)[:3]):
+            centroid[:, axis] = np.bincount(labels, weights=coords, minlength=n_labels) / voxel_count
+
+    voxel_dimX, voxel_dimY, voxel_dimZ = zooms[:3]
+    voxel_volume = voxel_dimX * voxel_dimY * voxel_dimZ
+
+    return {'voxel_count': voxel_count,
+            'volume_mm3': voxel_count * voxel_volume,
+            'centroid': centroid}
+
+
+def get_roi_stats(roi_fname, roi_data=None, use_cache=False):
+    """Returns the centroid and the volume of all the ROIs of a parcellation file.
+
+    If `use_cache` is True, the table computed by :func:`compute_roi_stats` is cached in
+    a ``_roistats.npz`` file next to the parcellation file, with the MD5 of the parcellation
+    file, so that the scripts using the same parcellation do not have to scan it again.
+    It is disabled by default as the parcellation files used by the interfaces are usually
+    in the working directory of another node.
+
+    Parameters
+    ----------
+    roi_fname : string
+        Path to the parcellation file
+
+    roi_data : numpy.array
+        Parcellation data if it is already loaded
+
+    use_cache : bool
+        If True, read the table from the cache if valid and write it otherwise
+        (Default: False)
+
+    Returns
+    -------
+    roi_stats : dict
+        Dictionary of arrays indexed by label (see :func:`compute_roi_stats`)
+    """
+    from nipype.utils.filemanip import hash_infile, split_filename
+
+    path, base, _ = split_filename(roi_fname)
+    cache_fname = op.join(path, base + '_roistats.npz')
+
+    md5 = hash_infile(roi_fname) if use_cache else None
+    if use_cache and op.exists(cache_fname):
+        try:
+            with np.load(cache_fname) as cached:
+                if str(cached['md5']) == md5:
+                    return {'voxel_count': cached['voxel_count'],
+                            'volume_mm3': cached['volume_mm3'],
+                            'centroid': cached['centroid']}
+        except (OSError, KeyError, ValueError):
+            pass
+
+    roi = ni.load(roi_fname)
+    if roi_data is None:
+        roi_data = roi.get_data()
+    roi_stats = compute_roi_stats(roi_data, roi.header.get_zooms())
+
+    if use_cache:
+        try:
+            tmp_fname = op.join(path, '%s_roistats.%i.tmp.npz' % (base, os.getpid()))
+            np.savez(tmp_fname, md5=md5, **roi_stats)
+            os.replace(tmp_fname, cache_fname)
+        except OSError:
+            # The directory of the parcellation might not be writable
+            pass
+
+    return roi_stats
+
+
+def get_roi_stats_of_label(roi_stats, label):
+    """Returns the centroid, the voxel count and the volume (mm3) of a ROI.
+
+    Parameters
+    ----------
+    roi_stats : dict
+        Table returned by :func:`get_roi_stats` or :func:`compute_roi_stats`
+
+    label : int
+        Label of the ROI
+
+    Returns
+    -------
+    (centroid, voxel_count, volume_mm3) : tuple
+        Centroid as a tuple of voxel coordinates, NaN if the ROI is empty
+    """
+    label = int(label)
+    if 0 < label < len(roi_stats['voxel_count']):
+        return (tuple(roi_stats['centroid'][label]),
+                roi_stats['voxel_count'][label],
+                roi_stats['volume_mm3'][label])
+    return ((np.nan, np.nan, np.nan),
+            roi_stats['voxel_count'].dtype.type(0),
+            roi_stats['volume_mm3'].dtype.type(0))
+
+
+def _integer_labels(data):
+    """Returns a segmentation volume as C-ordered non-negative integer labels (0 for negative or non-integer values)."""
+    data = np.asarray(data)
+    # Same memory layout as the volumes created by numpy, for the lookups of :func:`relabel_volume`
+    labels = data.astype(np.int32, order='C')
+    invalid = labels < 0
+    if not np.issubdtype(data.dtype, np.integer):
+        invalid |= labels != data
+    labels[invalid] = 0
+    return labels
+
+
+def _present_labels(labels):
+    """Returns the sorted labels having at least one voxel in a volume of non-negative integer labels."""
+    return np.flatnonzero(np.bincount(labels.ravel()))
+
+
+def _bounding_box(mask):
+    """Returns the tuple of slices of the bounding box of the non-zero voxels of a mask (None if empty)."""
+    slices = ndimage.find_objects(np.asarray(mask, dtype=np.int8))
+    return slices[0] if len(slices) > 0 else None
+
+
+def _jacobian_corrected_maps(prob_maps, jacobian, prob_max, bbox, thresh):
+    """Returns the thresholded jacobian-corrected probability maps in a bounding box.
+
+    Parameters
+    ----------
+    prob_maps : numpy.array
+        4D volume of probability maps
+
+    jacobian : numpy.array
+        3D volume of the jacobian determinant of the deformation
+
+    prob_max : list of float
+        Maximum of each jacobian-corrected map over the whole volume, used for normalization
+
+    bbox : tuple of slice
+        3D bounding box where the maps are computed
+
+    thresh : float
+        Normalized probabilities below `thresh` are set to 0
+
+    Returns
+    -------
+    prob_maps_bbox : numpy.array
+        4D array of the corrected maps in the bounding box
+    """
+    prob_maps_bbox = np.stack([np.multiply(prob_maps[bbox + (i,)], jacobian[bbox]) / prob_max[i]
+                               for i in range(prob_maps.shape[3])], axis=3)
+    prob_maps_bbox[prob_maps_bbox < thresh] = 0
+    return prob_maps_bbox
+
+
+def _max_probability_labels(prob_maps, support):
+    """Returns the 1-based index of the map of highest probability in each voxel of a support mask.
+
+    Parameters
+    ----------
+    prob_maps : numpy.array
+        4D volume of probability maps
+
+    support : numpy.array
+        Boolean mask of the voxels to label
+
+    Returns
+    -------
+    max_prob : numpy.array
+        3D volume of map indices, 0 outside the support mask
+    """
+    max_prob = np.zeros(support.shape, dtype=np.int64)
+    bbox = _bounding_box(support)
+    if bbox is not None:
+        max_prob_bbox = np.argmax(prob_maps[bbox], axis=3) + 1
+        max_prob_bbox[~support[bbox]] = 0
+        max_prob[bbox] = max_prob_bbox
+    return max_prob
+
+
+def relabel_volume(shape, layers, dtype=np.int16):
+    """Combines successive relabelings of segmentation volumes with one lookup table per source volume.
+
+    Relabeling structure by structure with ``out[source == value] = label`` scans the volumes
+    once per label. Here the layers reading the same source volume are gathered in a lookup
+    table (``lut[source]``), so that each source volume is read once, and each voxel takes the
+    label of the last layer covering it, as with the successive assignments.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the relabeled volume
+
+    layers : list of tuple
+        Ordered list of ``(source, values, labels)`` where `source` is a volume of non-negative
+        integer labels and its voxels equal to ``values[i]`` are relabeled ``labels[i]``
+
+    dtype : numpy.dtype
+        Data type of the relabeled volume
+
+    Returns
+    -------
+    out : numpy.array
+        Relabeled volume (0 for the voxels not covered by any layer)
+    """
+    # Layers grouped by source volume, with their rank in the list
+    sources = []
+    for rank, (source, values, labels) in enumerate(layers, 1):
+        for source_layers in sources:
+            if source_layers[0] is source:
+                break
+        else:
+            source_layers = (source, [])
+            sources.append(source_layers)
+        source_layers[1].append((rank, np.asarray(values, dtype=np.int64), np.asarray(labels)))
+
+    out = np.zeros(shape, dtype=dtype)
+    out_rank = np.zeros(shape, dtype=np.int16)
+    for source, source_layers in sources:
+        # The last entry of the tables stays null for the values above the relabeled ones
+        lut_size = max([int(values.max()) for _, values, _ in source_layers if values.shape[0] > 0] + [0]) + 2
+        label_lut = np.zeros(lut_size, dtype=dtype)
+        rank_lut = np.zeros(lut_size, dtype=np.int16)
+        for rank, values, labels in source_layers:
+            label_lut[values] = labels
+            rank_lut[values] = rank
+
+        source_rank = np.take(rank_lut, source, mode='clip')
+        update = source_rank > out_rank
+        np.copyto(out, np.take(label_lut, source, mode='clip'), where=update)
+        np.copyto(out_rank, source_rank, where=update)
+
+    return out
+
+
 def extract(Z, shape, position, fill):
     """ Extract voxel neighbourhood.
 
@@ -2415,6 +2171,175 @@ def extract(Z, shape, position, fill):
     return R
 
 
+def _nearest_label_in_neighbourhood(labels, position, dist):
+    """Returns the label of the nearest labeled voxel in the neighbourhood of a voxel.
+
+    Voxel-wise search used by :func:`assign_nearest_labels` for the few voxels
+    it cannot resolve with the distance transform.
+    """
+    local = extract(labels, dist.shape, position=position, fill=0)
+    mask = local.copy()
+    mask[np.nonzero(local > 0)] = 1
+    thisdist = np.multiply(dist, mask)
+    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
+    value = np.int_(local[np.nonzero(thisdist == np.amin(thisdist))])
+    if value.size > 1:
+        counts = np.bincount(value)
+        value = np.argmax(counts)
+    return np.ravel(value)[0]
+
+
+def assign_nearest_labels(labels, positions, radius=12):
+    """Returns for each voxel the label of the nearest labeled voxel within a given radius.
+
+    It gives the same result as the voxel-wise search in the ``(2 * radius + 1)^3``
+    neighbourhood extracted with :func:`extract`: the most frequent label among the
+    nearest labeled voxels (the smallest one in case of a tie), 0 if there is none.
+    The distance to the nearest labeled voxel is given by a Euclidean distance
+    transform of the volume and the labels at that distance are gathered for all
+    the voxels at once, shell by shell. The voxel-wise search is only kept for
+    the voxels that are themselves labeled, or farther than ``radius`` from any
+    labeled voxel, or whose neighbourhood has all its labeled voxels at the same distance.
+
+    Parameters
+    ----------
+    labels : numpy.array
+        3D volume of labels (0 for unlabeled voxels)
+
+    positions : tuple of numpy.array
+        Voxel coordinates ``(xx, yy, zz)`` of the voxels to label
+
+    radius : int
+        Half width of the neighbourhood in voxels
+
+    Returns
+    -------
+    values : numpy.array
+        Label assigned to each voxel
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape(3, -1)
+    values = np.zeros(positions.shape[1], dtype=labels.dtype)
+    if positions.shape[1] == 0:
+        return values
+
+    # Nearest labeled voxel in the bounding box of the voxels extended by the radius
+    shape = np.array(labels.shape[:3])
+    lo = np.maximum(positions.min(axis=1) - radius, 0)
+    hi = np.minimum(positions.max(axis=1) + radius + 1, shape)
+    crop = labels[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    indices = ndimage.distance_transform_edt(crop == 0, return_distances=False, return_indices=True)
+    local = positions - lo[:, np.newaxis]
+    nearest = indices[:, local[0], local[1], local[2]]
+    d2 = np.sum((nearest - local) ** 2, axis=0)
+    del indices
+
+    # Number of labeled voxels in the neighbourhood of each voxel, from a summed volume table
+    width = 2 * radius + 1
+    counts = np.pad(labels > 0, radius).astype(np.int32)
+    counts = counts.cumsum(axis=0).cumsum(axis=1).cumsum(axis=2)
+    counts = np.pad(counts, ((1, 0), (1, 0), (1, 0)))
+    x0, y0, z0 = positions
+    x1, y1, z1 = positions + width
+    n_neighbourhood = (counts[x1, y1, z1] - counts[x0, y1, z1] - counts[x1, y0, z1] - counts[x1, y1, z0] +
+                       counts[x0, y0, z1] + counts[x0, y1, z0] + counts[x1, y0, z0] - counts[x0, y0, z0])
+    del counts
+
+    # Offsets of the neighbourhood within the radius
+    grid = np.arange(-radius, radius + 1)
+    offsets = np.stack(np.meshgrid(grid, grid, grid, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets_d2 = np.sum(offsets ** 2, axis=1)
+
+    resolved = np.zeros(positions.shape[1], dtype=bool)
+    candidates = (d2 > 0) & (d2 <= radius ** 2)
+    for shell_d2 in np.unique(d2[candidates]):
+        sel = np.flatnonzero(candidates & (d2 == shell_d2))
+        shell = offsets[offsets_d2 == shell_d2]
+        coords = positions[:, sel, np.newaxis] + shell.T[:, np.newaxis, :]
+        inside = np.all((coords >= 0) & (coords < shape[:, np.newaxis, np.newaxis]), axis=0)
+        coords = np.where(inside, coords, 0)
+        shell_labels = np.where(inside, labels[coords[0], coords[1], coords[2]], 0).astype(np.int64)
+        # Most frequent non-zero label, the smallest one in case of a tie
+        label_counts = np.sum(shell_labels[:, :, np.newaxis] == shell_labels[:, np.newaxis, :], axis=2)
+        label_counts[shell_labels == 0] = -1
+        best = np.argmax(label_counts * (np.iinfo(np.int32).max + 1) - shell_labels, axis=1)
+        values[sel] = shell_labels[np.arange(len(sel)), best]
+        # If all the labeled voxels of the neighbourhood are at the same distance,
+        # the voxel-wise search also counts the unlabeled voxels
+        resolved[sel] = np.sum(shell_labels > 0, axis=1) < n_neighbourhood[sel]
+
+    dist = np.sqrt(np.sum((np.indices((width, width, width)) - radius) ** 2, axis=0)).astype('float32')
+    for j in np.flatnonzero(~resolved):
+        values[j] = _nearest_label_in_neighbourhood(labels, tuple(positions[:, j]), dist)
+
+    return values
+
+
+def read_label_coordinates(label_file):
+    """Reads the coordinates of the vertices of a FreeSurfer ``.label`` file.
+
+    ``nibabel.freesurfer.io.read_label()`` only returns the vertex indices,
+    the coordinates (tkregister RAS) are read from the same ascii format.
+
+    Parameters
+    ----------
+    label_file : string
+        Path to the ``.label`` file
+
+    Returns
+    -------
+    coords : numpy.array
+        Array of size [#vertices, 3]
+    """
+    return np.loadtxt(label_file, skiprows=2, usecols=(1, 2, 3), ndmin=2)
+
+
+def rasterize_labels(label_files, values, template_file):
+    """Maps FreeSurfer ``.label`` files to the voxels of a template volume in one pass.
+
+    It reproduces ``mri_label2vol --label <label_file> --temp <template_file> --identity``:
+    each vertex is mapped to the voxel given by the inverse of the tkregister
+    vox2ras matrix of the template, rounded to the nearest integer as FreeSurfer
+    does (half away from zero), and a voxel belongs to a label as soon
+    as one of its vertices falls into it.
+
+    Parameters
+    ----------
+    label_files : list of string
+        Paths to the ``.label`` files
+
+    values : list of int
+        Value assigned to the voxels of each label. Where labels
+        overlap, the value of the last label in the list is kept
+
+    template_file : string
+        Path to the template volume (Typically ``mri/orig.mgz``)
+
+    Returns
+    -------
+    volume : numpy.array
+        Volume of the labels with the same dimensions as the template
+    """
+    template = ni.load(template_file)
+    ras2vox = np.linalg.inv(template.header.get_vox2ras_tkr())
+    shape = template.shape[:3]
+
+    coords = [read_label_coordinates(f) for f in label_files]
+    label_values = np.repeat(np.asarray(values, dtype=np.int64), [len(c) for c in coords])
+    coords = np.concatenate(coords) if coords else np.zeros((0, 3))
+    vox = coords @ ras2vox[:3, :3].T + ras2vox[:3, 3]
+    vox = np.trunc(vox + np.copysign(0.5, vox)).astype(np.int64)
+    inside = np.all((vox >= 0) & (vox < shape), axis=1)
+    flat_idx = np.ravel_multi_index(tuple(vox[inside].T), shape)
+    label_values = label_values[inside]
+
+    # keep the last label mapped to each voxel
+    _, last = np.unique(flat_idx[::-1], return_index=True)
+    last = len(flat_idx) - 1 - last
+    volume = np.zeros(shape, dtype=np.int64)
+    volume.flat[flat_idx[last]] = label_values[last]
+    return volume
+
+
 def create_T1_and_Brain(subject_id, subjects_dir):
     """Generates T1, T1 masked and aseg+aparc Freesurfer images in NIFTI format.
 
@@ -2574,7 +2499,7 @@ def create_annot_label(subject_id, subjects_dir):
     print("[ DONE ]")
 
 
-def create_roi(subject_id, subjects_dir):
+def create_roi(subject_id, subjects_dir, use_mri_label2vol=False):
     """ Iteratively creates the ROI_%s.nii.gz files using the given Lausanne2008 parcellation information from networks.
 
     Parameters
@@ -2585,6 +2510,10 @@ def create_roi(subject_id, subjects_dir):
     subjects_dir : string
         Freesurfer subjects dir
         (Typically ``/path/to/output_dir/freesurfer``)
+
+    use_mri_label2vol : Boolean
+        If True, map each cortical label to the volume with one ``mri_label2vol`` call
+        instead of :func:`rasterize_labels` (slow, kept for validation)
     """
 
     print("Create the ROIs:")
@@ -2601,18 +2530,8 @@ def create_roi(subject_id, subjects_dir):
     yy = np.concatenate((idxr[1], idxl[1]))
     zz = np.concatenate((idxr[2], idxl[2]))
 
-    # initialize variables necessary for cortical ROIs dilation
-    # dimensions of the neighbourhood for rois labels assignment (choose odd dimensions!)
-    shape = (25, 25, 25)
-    center = np.array(shape) // 2
-    # dist: distances from the center of the neighbourhood
-    dist = np.zeros(shape, dtype='float32')
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            for z in range(shape[2]):
-                distxyz = center - [x, y, z]
-                dist[x, y, z] = math.sqrt(
-                    np.sum(np.multiply(distxyz, distxyz)))
+    # radius of the neighbourhood for rois labels assignment
+    radius = 12
 
     # LOOP throughout all the SCALES
     # (from the one with the highest number of region to the one with the lowest number of regions)
@@ -2636,8 +2555,12 @@ def create_roi(subject_id, subjects_dir):
         # each node represents a brain region
         # create a big 256^3 volume for storage of all ROIs
         rois = np.zeros((256, 256, 256), dtype=np.int16)  # numpy.ndarray
+        # rank of the node that last set each voxel, so that the cortical labels
+        # rasterized at once after the loop overlap the subcortical regions in the node order
+        rois_rank = np.zeros((256, 256, 256), dtype=np.int32)
+        cortical_labels = []
 
-        for brk, brv in pg.nodes(data=True):  # slow loop
+        for rank, (brk, brv) in enumerate(pg.nodes(data=True), 1):
 
             if brv['dn_hemisphere'] == 'left':
                 hemi = 'lh'
@@ -2654,6 +2577,7 @@ def create_roi(subject_id, subjects_dir):
                 # if it is subcortical, retrieve roi from aseg
                 idx = np.where(asegd == int(brv['dn_fs_aseg_val']))
                 rois[idx] = int(brv['dn_correspondence_id'])
+                rois_rank[idx] = rank
 
             elif brv['dn_region'] == 'cortical':
                 print("---------------------")
@@ -2667,6 +2591,11 @@ def create_roi(subject_id, subjects_dir):
                 # construct .label file name
                 fname = '%s.%s.label' % (hemi, brv['dn_fsname'])
 
+                if not use_mri_label2vol:
+                    # rasterized with all the cortical labels of the scale after the loop
+                    cortical_labels.append((op.join(labelpath, fname), int(brv['dn_correspondence_id']), rank))
+                    continue
+
                 # execute fs mri_label2vol to generate volume roi from the label file
                 # store it in temporary file to be overwritten for each region (slow!)
                 # mri_cmd = 'mri_label2vol --label "%s" --temp "%s" --o "%s" --identity' % (op.join(labelpath, fname),
@@ -2683,6 +2612,16 @@ def create_roi(subject_id, subjects_dir):
                 idx = np.where(tmpd == 1)
                 rois[idx] = int(brv['dn_correspondence_id'])
 
+        if cortical_labels:
+            print("Rasterize %i cortical labels" % len(cortical_labels))
+            label_files, label_ids, label_ranks = zip(*cortical_labels)
+            cortical_rank = rasterize_labels(label_files, label_ranks, op.join(fs_dir, 'mri', 'orig.mgz'))
+            rank_to_id = np.zeros(pg.number_of_nodes() + 1, dtype=np.int16)
+            rank_to_id[list(label_ranks)] = label_ids
+            idx = np.where(cortical_rank > rois_rank)
+            rois[idx] = rank_to_id[cortical_rank[idx]]
+        del rois_rank
+
         newrois = rois.copy()
         # store scale500 volume for correction on multi-resolution consistency
         if i == 0:
@@ -2696,29 +2635,12 @@ def create_roi(subject_id, subjects_dir):
         else:
             print("Adapt cortical surfaces...")
             # adaptstart = time()
-            idxRois = np.where(rois > 0)
-            xxRois = idxRois[0]
-            yyRois = idxRois[1]
-            zzRois = idxRois[2]
             # correct voxels labeled in current resolution, but not labeled in highest resolution
-            for j in range(xxRois.size):
-                if roisMax[xxRois[j], yyRois[j], zzRois[j]] == 0:
-                    newrois[xxRois[j], yyRois[j], zzRois[j]] = 0
+            newrois[(rois > 0) & (roisMax == 0)] = 0
             # correct voxels not labeled in current resolution, but labeled in highest resolution
-            for j in range(xxMax.size):
-                if newrois[xxMax[j], yyMax[j], zzMax[j]] == 0:
-                    local = extract(rois, shape, position=(
-                        xxMax[j], yyMax[j], zzMax[j]), fill=0)
-                    mask = local.copy()
-                    mask[np.nonzero(local > 0)] = 1
-                    thisdist = np.multiply(dist, mask)
-                    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                    value = np.int_(
-                        local[np.nonzero(thisdist == np.amin(thisdist))])
-                    if value.size > 1:
-                        counts = np.bincount(value)
-                        value = np.argmax(counts)
-                    newrois[xxMax[j], yyMax[j], zzMax[j]] = value
+            idx = np.where(newrois[xxMax, yyMax, zzMax] == 0)[0]
+            newrois[xxMax[idx], yyMax[idx], zzMax[idx]] = assign_nearest_labels(
+                rois, (xxMax[idx], yyMax[idx], zzMax[idx]), radius)
             # print("Cortical ROIs adaptation took %s seconds to process." % (time()-adaptstart))
 
         # store volume eg in ROI_scale33.nii.gz
@@ -2734,21 +2656,9 @@ def create_roi(subject_id, subjects_dir):
         # dilate cortical regions
         print("Dilating cortical regions...")
         # dilatestart = time()
-        # loop throughout all the voxels belonging to the aseg GM volume
-        for j in range(xx.size):
-            if newrois[xx[j], yy[j], zz[j]] == 0:
-                local = extract(rois, shape, position=(
-                    xx[j], yy[j], zz[j]), fill=0)
-                mask = local.copy()
-                mask[np.nonzero(local > 0)] = 1
-                thisdist = np.multiply(dist, mask)
-                thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                value = np.int_(
-                    local[np.nonzero(thisdist == np.amin(thisdist))])
-                if value.size > 1:
-                    counts = np.bincount(value)
-                    value = np.argmax(counts)
-                newrois[xx[j], yy[j], zz[j]] = value
+        # label the voxels of the aseg GM volume still unlabeled
+        idx = np.where(newrois[xx, yy, zz] == 0)[0]
+        newrois[xx[idx], yy[idx], zz[idx]] = assign_nearest_labels(rois, (xx[idx], yy[idx], zz[idx]), radius)
         # print("Cortical ROIs dilation took %s seconds to process." % (time()-dilatestart))
 
         # Create Gray Matter mask
@@ -2888,6 +2798,28 @@ def define_atlas_variables():
     return paths, comp, pardic, parkeys
 
 
+def run_freesurfer_command(mri_cmd, v=True):
+    """Runs a shell command calling a FreeSurfer tool.
+
+    Parameters
+    ----------
+    mri_cmd : string
+        Shell command
+
+    v : Boolean
+        Verbose mode (the outputs of the command are shown only if ``v == 2``)
+
+    Returns
+    -------
+    status : int
+        Return code of the command
+    """
+    if v == 2:
+        return subprocess.call(mri_cmd, shell=True)
+    with open(os.devnull, 'w') as FNULL:
+        return subprocess.call(mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+
+
 def generate_single_parcellation(v, i, fs_string, subject_dir, subject_id):
     """Generates the volumetric parcellation from the annotation file for one scale of Lausanne2018 parcellation.
 
@@ -3016,7 +2948,7 @@ def generate_single_parcellation(v, i, fs_string, subject_dir, subject_id):
     return 1
 
 
-def create_roi_v2(subject_id, subjects_dir, v=True):
+def create_roi_v2(subject_id, subjects_dir, v=True, n_procs=1):
     """Iteratively creates the ROI_%s.nii.gz files using the given Lausanne2018 parcellation information from networks.
 
     Parameters
@@ -3030,6 +2962,10 @@ def create_roi_v2(subject_id, subjects_dir, v=True):
 
     v : Boolean
         Verbose mode
+
+    n_procs : int
+        Maximal number of FreeSurfer commands run concurrently
+        (the commands of the different scales and hemispheres are independent)
     """
 
     freesurfer_subj = os.path.abspath(subjects_dir)
@@ -3080,23 +3016,13 @@ def create_roi_v2(subject_id, subjects_dir, v=True):
     yy = np.concatenate((idxr[1], idxl[1]))
     zz = np.concatenate((idxr[2], idxl[2]))
 
-    # initialize variables necessary for cortical ROIs dilation
-    # dimensions of the neighbourhood for rois labels assignment (choose odd dimensions!)
-    shape = (25, 25, 25)
-    center = np.array(shape) // 2
-    # dist: distances from the center of the neighbourhood
-    dist = np.zeros(shape, dtype='float32')
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            for z in range(shape[2]):
-                distxyz = center - [x, y, z]
-                dist[x, y, z] = math.sqrt(
-                    np.sum(np.multiply(distxyz, distxyz)))
-
-        # Check existence of tmp folder in input subject folder
-        this_dir = os.path.join(subject_dir, 'tmp')
-        if not (os.path.isdir(this_dir)):
-            os.makedirs(this_dir)
+    # radius of the neighbourhood for rois labels assignment
+    radius = 12
+
+    # Check existence of tmp folder in input subject folder
+    this_dir = os.path.join(subject_dir, 'tmp')
+    if not (os.path.isdir(this_dir)):
+        os.makedirs(this_dir)
 
     # Loop over parcellation scales
     if v:
@@ -3117,53 +3043,47 @@ def create_roi_v2(subject_id, subjects_dir, v=True):
                     'ROIv_scale3_Lausanne2018.nii.gz', 'ROIv_scale4_Lausanne2018.nii.gz',
                     'ROIv_scale5_Lausanne2018.nii.gz']
 
-    FNULL = open(os.devnull, 'w')
+    # The FreeSurfer commands of the different scales are independent until the correction
+    # for multi-resolution consistency, they are run concurrently by a pool of workers
+    # starting with the highest resolution used as reference by the other scales
+    n_workers = max(1, n_procs)
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    if v:
+        print(' ... run the FreeSurfer commands of the {} scales with {} workers'.format(nscales, n_workers))
 
+    # 1. Resample fsaverage CorticalSurface onto SUBJECT_ID CorticalSurface and map annotation for each scale
+    #    (left and right hemispheres)
+    surf2surf_futures = {}
     for i in reversed(list(range(0, nscales))):
-
-        if v:
-            print(' ... working on multiscale parcellation, SCALE {}'.format(i + 1))
-
-        # 1. Resample fsaverage CorticalSurface onto SUBJECT_ID CorticalSurface and map annotation for current scale
-        # Left hemisphere
-        if v:
-            print(
-                '     > resample fsaverage CorticalSurface to individual CorticalSurface')
-        mri_cmd = fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi lh --sval-annot %s --tval %s' % (
-            subject_id,
-            pkg_resources.resource_filename('cmtklib',
-                                            op.join('data', 'parcellation', 'lausanne2018', lh_annot_files[i])),
-            os.path.join(subject_dir, 'label', lh_annot_files[i]))
-        if v == 2:
-            status = subprocess.call(mri_cmd, shell=True)
-        else:
-            status = subprocess.call(
-                mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-        # Right hemisphere
-        mri_cmd = fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi rh --sval-annot %s --tval %s' % (
-            subject_id,
-            pkg_resources.resource_filename('cmtklib',
-                                            op.join('data', 'parcellation', 'lausanne2018', rh_annot_files[i])),
-            os.path.join(subject_dir, 'label', rh_annot_files[i]))
-        if v == 2:
-            status = subprocess.call(mri_cmd, shell=True)
-        else:
-            status = subprocess.call(
-                mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-
-        # 2. Generate Nifti volume from annotation
-        #    Note: change here --wmparc-dmax (FS default 5mm) to dilate cortical regions toward the WM
-        if v:
-            print('     > generate Nifti volume from annotation')
+        surf2surf_futures[i] = []
+        for hemi, annot_files in [('lh', lh_annot_files), ('rh', rh_annot_files)]:
+            mri_cmd = fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi %s --sval-annot %s --tval %s' % (
+                subject_id,
+                hemi,
+                pkg_resources.resource_filename('cmtklib',
+                                                op.join('data', 'parcellation', 'lausanne2018', annot_files[i])),
+                os.path.join(subject_dir, 'label', annot_files[i]))
+            surf2surf_futures[i].append(executor.submit(run_freesurfer_command, mri_cmd, v))
+
+    # 2. Generate Nifti volume from annotation, as soon as both hemispheres of the scale are resampled
+    #    Note: change here --wmparc-dmax (FS default 5mm) to dilate cortical regions toward the WM
+    aparc2aseg_futures = {}
+    for i in reversed(list(range(0, nscales))):
+        wait(surf2surf_futures[i])
         mri_cmd = fs_string + '; mri_aparc2aseg --s %s --annot %s --wmparc-dmax 0 --labelwm --hypo-as-wm --new-ribbon --o %s' % (
             subject_id,
             annot[i],
             os.path.join(subject_dir, 'tmp', rois_output[i]))
-        if v == 2:
-            status = subprocess.call(mri_cmd, shell=True)
-        else:
-            status = subprocess.call(
-                mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+        aparc2aseg_futures[i] = executor.submit(run_freesurfer_command, mri_cmd, v)
+
+    # the conversions to mgz run in the background while the next scales are processed
+    mri_convert_futures = []
+
+    for i in reversed(list(range(0, nscales))):
+
+        if v:
+            print(' ... working on multiscale parcellation, SCALE {}'.format(i + 1))
+        aparc2aseg_futures[i].result()
 
         # 3. Update numerical IDs of cortical and subcortical regions
         # Load Nifti volume
@@ -3190,29 +3110,12 @@ def create_roi_v2(subject_id, subjects_dir, v=True):
         else:
             print("     > adapt cortical surfaces")
             # adaptstart = time()
-            idxRois = np.where(vol > 0)
-            xxRois = idxRois[0]
-            yyRois = idxRois[1]
-            zzRois = idxRois[2]
             # correct voxels labeled in current resolution, but not labeled in highest resolution
-            for j in range(xxRois.size):
-                if roisMax[xxRois[j], yyRois[j], zzRois[j]] == 0:
-                    newrois[xxRois[j], yyRois[j], zzRois[j]] = 0
+            newrois[(vol > 0) & (roisMax == 0)] = 0
             # correct voxels not labeled in current resolution, but labeled in highest resolution
-            for j in range(xxMax.size):
-                if newrois[xxMax[j], yyMax[j], zzMax[j]] == 0:
-                    local = extract(vol, shape, position=(
-                        xxMax[j], yyMax[j], zzMax[j]), fill=0)
-                    mask = local.copy()
-                    mask[np.nonzero(local > 0)] = 1
-                    thisdist = np.multiply(dist, mask)
-                    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                    value = np.int_(
-                        local[np.nonzero(thisdist == np.amin(thisdist))])
-                    if value.size > 1:
-                        counts = np.bincount(value)
-                        value = np.argmax(counts)
-                    newrois[xxMax[j], yyMax[j], zzMax[j]] = value
+            idx = np.where(newrois[xxMax, yyMax, zzMax] == 0)[0]
+            newrois[xxMax[idx], yyMax[idx], zzMax[idx]] = assign_nearest_labels(
+                vol, (xxMax[idx], yyMax[idx], zzMax[idx]), radius)
             # print("Cortical ROIs adaptation took %s seconds to process." % (time()-adaptstart))
         if v:
             print('     ... save output volumes')
@@ -3224,21 +3127,9 @@ def create_roi_v2(subject_id, subjects_dir, v=True):
         if v:
             print("     > dilating cortical regions")
         # dilatestart = time()
-        # loop throughout all the voxels belonging to the aseg GM volume
-        for j in range(xx.size):
-            if newrois[xx[j], yy[j], zz[j]] == 0:
-                local = extract(vol, shape, position=(
-                    xx[j], yy[j], zz[j]), fill=0)
-                mask = local.copy()
-                mask[np.nonzero(local > 0)] = 1
-                thisdist = np.multiply(dist, mask)
-                thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                value = np.int_(
-                    local[np.nonzero(thisdist == np.amin(thisdist))])
-                if value.size > 1:
-                    counts = np.bincount(value)
-                    value = np.argmax(counts)
-                newrois[xx[j], yy[j], zz[j]] = value
+        # label the voxels of the aseg GM volume still unlabeled
+        idx = np.where(newrois[xx, yy, zz] == 0)[0]
+        newrois[xx[idx], yy[idx], zz[idx]] = assign_nearest_labels(vol, (xx[idx], yy[idx], zz[idx]), radius)
 
         # 5. Save Nifti and mgz volumes
         if v:
@@ -3250,11 +3141,7 @@ def create_roi_v2(subject_id, subjects_dir, v=True):
         mri_cmd = fs_string + '; mri_convert -i %s -o %s' % (
             this_out,
             os.path.join(subject_dir, 'mri', roivs_output[i][0:-4] + '.mgz'))
-        if v == 2:
-            status = subprocess.call(mri_cmd, shell=True)
-        else:
-            status = subprocess.call(
-                mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+        mri_convert_futures.append(executor.submit(run_freesurfer_command, mri_cmd, v))
         # os.remove(os.path.join(subject_dir, 'tmp', rois_output[i]))
 
         # Create Gray Matter mask
@@ -3268,6 +3155,10 @@ def create_roi_v2(subject_id, subjects_dir, v=True):
             img = ni.Nifti1Image(gmMask, this_nifti.affine, hdr2)
             ni.save(img, out_mask)
 
+    for future in mri_convert_futures:
+        future.result()
+    executor.shutdown()
+
     mri_cmd = ['mri_convert', '-i', op.join(subject_dir, 'mri', 'ribbon.mgz'), '-o',
                op.join(subject_dir, 'mri', 'ribbon.nii.gz')]
     subprocess.check_call(mri_cmd)
@@ -3447,14 +3338,11 @@ def create_wm_mask(subject_id, subjects_dir):
 
         pg = nx.read_graphml(parval['node_information_graphml'])
 
-        for brk, brv in pg.nodes(data=True):
-
-            if brv['dn_region'] == 'cortical':
-                print("Subtracting region %s with intensity value %s" %
-                      (brv['dn_region'], brv['dn_correspondence_id']))
-
-                idx = np.where(roid == int(brv['dn_correspondence_id']))
-                wmmask[idx] = 0
+        cortical_ids = [int(brv['dn_correspondence_id']) for brk, brv in pg.nodes(data=True)
+                        if brv['dn_region'] == 'cortical']
+        print("Subtracting %i cortical regions with intensity values %s" %
+              (len(cortical_ids), cortical_ids))
+        wmmask[np.isin(roid, cortical_ids)] = 0
 
     # Extract cortical gray matter mask
     # remove remaining structure, e.g. brainstem
@@ -258,6 +258,38 @@ def length(xyz, along=False):
     return np.sum(dists)
 
 
+def length_packed(xyz, offsets):
+    """Euclidean length of many track lines packed in a single array.
+
+    Parameters
+    ----------
+    xyz : array-like shape (N,3)
+        Array representing x,y,z of the points of all the tracks, one after the other
+
+    offsets : array-like shape (M+1,)
+        Start of each of the M tracks in `xyz`, followed by N
+
+    Returns
+    -------
+    L : numpy.array shape (M,)
+        Total length of each track, 0 for tracks with less than 2 points
+
+    See Also
+    --------
+    length
+    """
+    xyz = np.asarray(xyz)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if len(xyz) < 2:
+        return np.zeros(len(offsets) - 1, dtype=xyz.dtype)
+    dists = np.sqrt((np.diff(xyz, axis=0) ** 2).sum(axis=1))
+    cumdists = np.concatenate(([0], np.cumsum(dists, dtype=np.float64)))
+    # Empty tracks get the same start and end
+    starts = np.minimum(offsets[:-1], len(xyz) - 1)
+    ends = np.maximum(np.minimum(offsets[1:] - 1, len(xyz) - 1), starts)
+    return (cumdists[ends] - cumdists[starts]).astype(xyz.dtype)
+
+
 def magn(xyz, n=1):
     """Returns the vector magnitude
 
@@ -313,14 +345,72 @@ def mean_curvature(xyz):
     n_pts = xyz.shape[0]
     if n_pts == 0:
         raise ValueError('xyz array cannot be empty')
+    if n_pts == 1:
+        raise ValueError('xyz array must contain at least 2 points')
+
+    return mean_curvature_packed(xyz, np.array([0, n_pts]))[0]
+
+
+def _segment_gradient(xyz, offsets):
+    """Gradient along the first axis computed independently in each segment.
+
+    It gives the same values as ``np.gradient(xyz[start:end])[0]`` for each segment,
+    i.e. central differences for the inner points and one-sided differences
+    for the first and last points. Segments must contain at least 2 points.
+    """
+    grad = np.empty_like(xyz)
+    if len(xyz) > 2:
+        grad[1:-1] = (xyz[2:] - xyz[:-2]) / 2.0
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1
+    grad[starts] = xyz[starts + 1] - xyz[starts]
+    grad[ends] = xyz[ends] - xyz[ends - 1]
+    return grad
+
+
+def mean_curvature_packed(xyz, offsets):
+    """Calculates the mean curvature of many curves packed in a single array.
+
+    Parameters
+    ----------
+    xyz : array-like shape (N,3)
+        Array representing x,y,z of the points of all the curves, one after the other
+
+    offsets : array-like shape (M+1,)
+        Start of each of the M curves in `xyz`, followed by N
+
+    Returns
+    -------
+    m : numpy.array shape (M,)
+        Mean curvature of each curve, NaN for curves with less than 2 points
+
+    See Also
+    --------
+    mean_curvature
+    """
+    xyz = np.asarray(xyz)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_pts = np.diff(offsets)
+    valid = n_pts >= 2
+
+    m = np.full(len(n_pts), np.nan, dtype=np.float64)
+    if not np.any(valid):
+        return m
+
+    if not np.all(valid):
+        # Keep only the points of the curves long enough
+        point_segments = np.repeat(np.arange(len(n_pts)), n_pts)
+        xyz = xyz[valid[point_segments]]
+        offsets = np.concatenate(([0], np.cumsum(n_pts[valid])))
 
-    dxyz = np.gradient(xyz)[0]
-    ddxyz = np.gradient(dxyz)[0]
+    dxyz = _segment_gradient(xyz, offsets)
+    ddxyz = _segment_gradient(dxyz, offsets)
 
     # Curvature
-    k = magn(np.cross(dxyz, ddxyz), 1) / (magn(dxyz, 1) ** 3)
+    k = magn(np.cross(dxyz, ddxyz), 1)[:, 0] / (magn(dxyz, 1)[:, 0] ** 3)
 
-    return np.mean(k)
+    m[valid] = np.add.reduceat(k.astype(np.float64), offsets[:-1]) / n_pts[valid]
+    return m
 
 
 def extract_freesurfer_subject_dir(reconall_report, local_output_dir=None, debug=False):
@@ -0,0 +1,80 @@
+"""Benchmark of the fiber endpoints, length and curvature computation.
+
+It compares the fiber-wise loops previously used by ``cmtklib.connectome``
+with the implementation working on packed fiber points,
+on a synthetic tractogram (1M fibers by default).
+
+Usage: python benchmark_fiber_features.py [number_of_fibers]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from cmtklib.connectome import pack_fibers, create_endpoints_array_packed, compute_curvature_array_packed
+from cmtklib.util import length_packed, magn
+
+
+def create_synthetic_fibers(n_fibers, min_points=10, max_points=60, seed=0):
+    """Create random walk fibers in the same format as ``nibabel.trackvis.read()``."""
+    rng = np.random.RandomState(seed)
+    npoints = rng.randint(min_points, max_points + 1, size=n_fibers)
+    steps = rng.normal(0, 1, size=(npoints.sum(), 3)).astype(np.float32)
+    offsets = np.concatenate(([0], np.cumsum(npoints)))
+    starts = rng.uniform(20, 200, size=(n_fibers, 3)).astype(np.float32)
+    fib = []
+    for i in range(n_fibers):
+        fib.append((starts[i] + np.cumsum(steps[offsets[i]:offsets[i + 1]], axis=0), None, None))
+    return fib
+
+
+def loop_features(fib, voxelSize):
+    """Fiber-wise computation as done before the packed implementation."""
+    n = len(fib)
+    endpoints = np.zeros((n, 2, 3))
+    endpointsmm = np.zeros((n, 2, 3))
+    lengths = np.zeros(n, dtype=np.float32)
+    meancurv = np.zeros((n, 1))
+    for i, fi in enumerate(fib):
+        f = fi[0]
+        endpointsmm[i, 0, :] = f[0, :]
+        endpointsmm[i, 1, :] = f[-1, :]
+        for j in range(3):
+            endpoints[i, 0, j] = int(endpointsmm[i, 0, j] / float(voxelSize[j]))
+            endpoints[i, 1, j] = int(endpointsmm[i, 1, j] / float(voxelSize[j]))
+        lengths[i] = np.sum(np.sqrt((np.diff(f, axis=0) ** 2).sum(axis=1)))
+        dxyz = np.gradient(f)[0]
+        ddxyz = np.gradient(dxyz)[0]
+        meancurv[i, 0] = np.mean(magn(np.cross(dxyz, ddxyz), 1) / (magn(dxyz, 1) ** 3))
+    return endpoints, endpointsmm, lengths, meancurv
+
+
+def packed_features(fib, voxelSize):
+    """Computation on the packed fiber points."""
+    points, offsets = pack_fibers(fib)
+    endpoints, endpointsmm = create_endpoints_array_packed(points, offsets, voxelSize)
+    lengths = length_packed(points, offsets)
+    meancurv = compute_curvature_array_packed(points, offsets)
+    return endpoints, endpointsmm, lengths, meancurv
+
+
+if __name__ == '__main__':
+    n_fibers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    voxelSize = (1.0, 1.0, 1.0)
+
+    print('Create %i synthetic fibers ...' % n_fibers)
+    fib = create_synthetic_fibers(n_fibers)
+
+    t0 = time.time()
+    loop_res = loop_features(fib, voxelSize)
+    t_loop = time.time() - t0
+    print('Fiber-wise loops : %.2f s' % t_loop)
+
+    t0 = time.time()
+    packed_res = packed_features(fib, voxelSize)
+    t_packed = time.time() - t0
+    print('Packed arrays    : %.2f s (x%.1f)' % (t_packed, t_loop / t_packed))
+
+    for name, a, b in zip(['endpoints', 'endpointsmm', 'lengths', 'meancurvature'], loop_res, packed_res):
+        print('%s: max relative difference %g' % (name, np.max(np.abs(a - b) / np.maximum(np.abs(a), 1e-12))))
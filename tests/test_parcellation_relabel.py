@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def sequential_relabel(shape, layers, dtype=np.int16):
+    """Relabels structure by structure, as CombineParcellations did before the lookup tables."""
+    out = np.zeros(shape, dtype=dtype)
+    for source, values, labels in layers:
+        for value, label in zip(values, labels):
+            out[source == value] = label
+    return out
+
+
+def test_relabel_volume():
+    from cmtklib.parcellation import relabel_volume
+
+    rng = np.random.RandomState(42)
+    shape = (23, 17, 11)
+    # Synthetic cortical/subcortical segmentation, hippocampal subfields and thalamic nuclei
+    aseg = rng.randint(0, 3000, size=shape)
+    aseg[rng.rand(*shape) < 0.3] = 0
+    subfields = rng.randint(0, 250, size=shape)
+    nuclei = rng.randint(0, 15, size=shape).astype(np.uint8)
+
+    layers = [(aseg, [10, 49, 1035, 2035], [1, 2, 3, 4]),
+              (subfields, [203, 204, 205], [5, 6, 7]),
+              # same source again: covers the previous layers
+              (aseg, [1035, 17], [8, 9]),
+              (nuclei, np.arange(1, 15), np.arange(100, 114)),
+              # empty layer and values absent from the volume
+              (subfields, [], []),
+              (aseg, [5000, 10], [10, 11])]
+
+    for dtype in (np.int16, np.int32):
+        out = relabel_volume(shape, layers, dtype=dtype)
+        assert out.dtype == dtype
+        np.testing.assert_array_equal(out, sequential_relabel(shape, layers, dtype=dtype))
+
+
+if __name__ == '__main__':
+    test_relabel_volume()
+    print('relabel_volume matches the sequential relabeling')